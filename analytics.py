@@ -0,0 +1,217 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from database import check_group, default_station, incident_groups, typecodes, weather_mask
+
+# The per-day counts held by the engine, in column order
+count_columns = ["crashes"] + ["injured_" + group.lower() for group in incident_groups] \
+                + ["killed_" + group.lower() for group in incident_groups]
+
+# Layout of the snapshot file: one record per day at each weather station
+snapshot_dtype = np.dtype([("date", "datetime64[D]"), ("station", "U11"), ("mask", np.int32),
+                           ("counts", np.int64, (len(count_columns),))])
+
+
+class WeatherDays:
+    """
+    Every array the queries are answered from, built together from one set of per-day records and
+    never changed afterwards, so that a query holding one never sees half of a reload
+    """
+
+    def __init__(self, days):
+        """
+        Builds the arrays
+        :param days: The structured array of per-day records
+        """
+        self.dates = days["date"]
+        self.stations = days["station"]
+        self.masks = days["mask"]
+        self.counts = days["counts"]
+        # One row per day, one column per weather type, 1 where that type occurred that day
+        self.flags = (self.masks[:, None] >> np.arange(len(typecodes))) & 1
+        # Every ranking at once: totals of each count (columns) over the days with each weather
+        # type (rows)
+        self.totals = self.flags.T @ self.counts
+        # Days are counted at the default station, like Database.most_common_weather()
+        self.type_days = self.flags[self.stations == default_station].sum(axis=0)
+        # Days before or after the collision data don't count toward combinations
+        self.has_crashes = self.counts[:, 0] > 0
+        for array in (self.dates, self.stations, self.masks, self.counts, self.flags, self.totals,
+                      self.type_days, self.has_crashes):
+            # Views of a memory mapped snapshot are read-only already
+            if array.flags.writeable:
+                array.flags.writeable = False
+
+
+class WeatherAnalytics:
+    """
+    Answers the weather rankings and weather combination queries in memory. The per-day weather
+    types and crash counts are loaded into NumPy arrays once, after which every answer is a
+    vectorized operation over a few thousand days rather than a round trip to the database.
+    A reload builds a new WeatherDays and swaps it in, so every query takes it once and works on
+    that alone.
+    """
+
+    def __init__(self, database=None, snapshot_path=None, refresh_interval=60):
+        """
+        Constructor for the engine
+        :param database: The Database to load from. May be None when only a snapshot is used.
+        :param snapshot_path: A .npy file to start from (memory mapped) and to save to after loading
+        :param refresh_interval: How many seconds to go between checks for newly loaded data
+        """
+        if database is None and snapshot_path is None:
+            raise ValueError("Either a database or a snapshot is needed")
+        self._database = database
+        self._snapshot_path = Path(snapshot_path) if snapshot_path is not None else None
+        self._refresh_interval = refresh_interval
+        self._refresh_lock = threading.Lock()
+        self._last_check = 0
+        self.generation = None
+        self.days = None
+
+        if self._snapshot_path is not None and self._snapshot_path.exists():
+            self._load_snapshot()
+        else:
+            self.refresh(force=True)
+
+    def _generation_path(self):
+        return self._snapshot_path.with_suffix(".json")
+
+    def _load_snapshot(self):
+        """
+        Memory maps the snapshot file, so startup costs nothing until the arrays are touched
+        :return: None
+        """
+        self.days = WeatherDays(np.load(self._snapshot_path, mmap_mode="r"))
+        self.generation = json.loads(self._generation_path().read_text())["generation"]
+        self._last_check = time.monotonic()
+
+    def _save_snapshot(self, days):
+        """
+        Writes the per-day records and the generation they came from next to each other
+        :param days: The structured array of per-day records
+        :return: None
+        """
+        # Write to the side and swap it in, since the old file may still be memory mapped
+        temporary_path = self._snapshot_path.with_name(self._snapshot_path.name + ".tmp")
+        with open(temporary_path, "wb") as snapshot_file:
+            np.save(snapshot_file, days)
+        os.replace(temporary_path, self._snapshot_path)
+        self._generation_path().write_text(json.dumps({"generation": self.generation}))
+
+    def _fetch_days(self):
+        """
+        Reads every station's daily weather bitmask, and the counts of the crashes nearest to it,
+        from the database
+        :return: A structured array laid out as snapshot_dtype
+        """
+        query = """
+        SELECT w0.date, w0.station, w0.mask, {}
+        FROM Wtypes w0
+        LEFT JOIN (SELECT "date", station, {}
+                    FROM CrashDaily
+                    GROUP BY "date", station) AS d0 ON d0.date = w0.date AND d0.station = w0.station
+        ORDER BY w0.date, w0.station
+        """.format(", ".join("COALESCE(d0.{0}, 0)".format(column) for column in count_columns),
+                   ", ".join("SUM({0}) AS {0}".format(column) for column in count_columns))
+        rows = self._database.execute_query(query)[1]
+
+        days = np.zeros(len(rows), dtype=snapshot_dtype)
+        if rows:
+            columns = list(zip(*rows))
+            days["date"] = np.array(columns[0], dtype="datetime64[D]")
+            days["station"] = columns[1]
+            days["mask"] = np.array([mask or 0 for mask in columns[2]], dtype=np.int32)
+            days["counts"] = np.array(columns[3:], dtype=np.int64).T
+        return days
+
+    def current_generation(self):
+        """
+        Asks the database which load its data comes from
+        :return: The generation number written by post_load.sql
+        """
+        return self._database.execute_query("SELECT generation FROM DataGeneration")[1][0][0]
+
+    def refresh(self, force=False):
+        """
+        Reloads the arrays if the database has been reloaded since they were built. Outside of a
+        forced refresh, the database is asked at most once every refresh_interval seconds.
+        :param force: Check immediately, and reload even if the generation is unchanged
+        :return: True if the arrays were reloaded
+        """
+        if self._database is None:
+            return False
+        if not force and time.monotonic() - self._last_check < self._refresh_interval:
+            return False
+
+        with self._refresh_lock:
+            self._last_check = time.monotonic()
+            generation = self.current_generation()
+            if not force and generation == self.generation:
+                return False
+            days = self._fetch_days()
+            self.generation = generation
+            if self._snapshot_path is not None:
+                self._save_snapshot(days)
+            # A single reference to swap, so readers get either the old arrays or the new ones
+            self.days = WeatherDays(days)
+        return True
+
+    def snapshot(self):
+        """
+        Refreshes the arrays if that's due, then hands back the ones to answer a query from
+        :return: The current WeatherDays
+        """
+        self.refresh()
+        return self.days
+
+    def _ranking(self, values):
+        """
+        Pairs each weather type with its value, in the same form as the Database rankings
+        :param values: One value per weather type, in typecodes order
+        :return: [code, value] pairs sorted in descending order of value
+        """
+        ranking = [[code, int(value)] for code, value in zip(typecodes, values)]
+        ranking.sort(key=lambda t: t[1], reverse=True)
+        return ranking
+
+    def most_common_weather(self):
+        return self._ranking(self.snapshot().type_days)
+
+    def crashes_by_weather(self):
+        return self._ranking(self.snapshot().totals[:, count_columns.index("crashes")])
+
+    def deadliest_weather(self, group_selection="total"):
+        column = count_columns.index("killed_" + check_group(group_selection))
+        return self._ranking(self.snapshot().totals[:, column])
+
+    def most_injuries_weather(self, group_selection="total"):
+        column = count_columns.index("injured_" + check_group(group_selection))
+        return self._ranking(self.snapshot().totals[:, column])
+
+    def crashes_in_weather(self, include=(), exclude=(), group="total"):
+        """
+        Totals crashes on the days that had all of the included weather types and none of the
+        excluded ones. Matches Database.crashes_in_weather().
+        :param include: Weather type codes that must all have occurred
+        :param exclude: Weather type codes that must not have occurred
+        :param group: The group whose injuries and deaths are counted
+        :return: A dict with the number of matching "days" and their "crashes", "injuries" and "deaths"
+        """
+        include_mask, exclude_mask = weather_mask(include), weather_mask(exclude)
+        group = check_group(group)
+        days = self.snapshot()
+
+        selected = ((days.masks & include_mask) == include_mask) & ((days.masks & exclude_mask) == 0) \
+                   & days.has_crashes
+        totals = days.counts[selected].sum(axis=0)
+        # A day can match at several stations but only counts once
+        return {"days": int(np.unique(days.dates[selected]).size),
+                "crashes": int(totals[count_columns.index("crashes")]),
+                "injuries": int(totals[count_columns.index("injured_" + group)]),
+                "deaths": int(totals[count_columns.index("killed_" + group)])}
@@ -1,23 +1,132 @@
-from database import Database
+import argparse
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
-app = Database()  # Object to interface with the database
+from database import incident_groups, typecodes
+from embedded import open_database
+from export import json_value
+import telemetry
 
-# List of query options and their corresponding function objects
+
+def print_formatted_weather_ranking(result, describing_noun):
+    """
+    Prints the ranking of weather conditions in a reusable code chunk
+    :param result: The [type code, value] pairs returned by one of the weather rankings
+    :param describing_noun: The trailing noun describing the data
+    :return: None
+    """
+    current_rank = 1
+    for weather_type in result:
+        print("{} {}: {} {}".format("{}.".format(current_rank) if current_rank >= 10 else "{}. ".format(current_rank),
+                                     typecodes[weather_type[0].lower()], weather_type[1], describing_noun))
+        current_rank += 1 # Python depreciating ++ is a disgrace - Your friendly neighborhood python hater
+
+
+def select_group(flag):
+    """
+    Reusable code to prompt the user to select a kind of group
+    :param flag: The set of word(s) describing the type of incident
+    :return: the selected group
+    """
+    print("{} for which group?\n".format(flag))
+    current_number = 1
+    for group in incident_groups:
+        print("{}. {}".format(current_number, incident_groups[current_number - 1]))
+        current_number += 1
+    try:
+        group_selected_identifier = int(input("\nSelection: "))
+        if group_selected_identifier < 1:
+            raise IndexError
+        return incident_groups[group_selected_identifier - 1].lower()
+    except (ValueError, IndexError):
+        print("Error Invalid Selection")
+        raise ValueError
+
+
+##### Menu front end #####
+
+def crashes_by_date(app):
+    print("Selected number of crashes on inputted date")
+    input_date = input("Please enter a date (YYYY/MM/DD): ")
+    crash_total = app.crashes_by_date(input_date)
+    print("There were " + str(crash_total) + " crashes on the date of " + str(input_date) + ".\n")
+
+
+def weather_by_date(app):
+    date = input("Enter a date (YYYY/MM/DD) to gather the weather data: ")
+    weather = app.weather_by_date(date)
+    if weather is None:
+        print("Date has no weather data")
+        return
+
+    print("High Temperature ......  {}°F".format(weather["maxtemp"]))
+    print("Low Temperature .......  {}°F".format(weather["mintemp"]))
+    print("Total precipitation ...  {}".format(weather["precip"]))
+    print("Total snow ............  {}".format(weather["snow"]))
+    print("Snow depth ............  {}".format(weather["snowdepth"]))
+    print("Average Wind ..........  {}".format(weather["avgwind"]))
+
+    print("\nWeather events:")
+    for event in weather["events"]:
+        print("- {}".format(typecodes[event]))
+
+
+def most_common_weather(app):
+    print("Most common weather conditions (descending):")
+    print_formatted_weather_ranking(app.most_common_weather(), "occurrence(s)")
+
+
+def crashes_by_weather(app):
+    print("Selected most crashed in weather conditions")
+    result = app.crashes_by_weather()
+    print("Most Crashed In Weather Conditions(Descending):")
+    print_formatted_weather_ranking(result, "crash(es)")
+
+
+def deadliest_weather(app):
+    print("Selected deadliest weather conditions")
+    try:
+        group_selection = select_group("Deadliest")
+    except ValueError:
+        return
+    result = app.deadliest_weather(group_selection)
+    print("Deadliest Weather Conditions ({}, Descending):".format(group_selection))
+    print_formatted_weather_ranking(result, "death(s)")
+
+
+def most_injuries_weather(app):
+    print("Selected most injured in weather conditions")
+    try:
+        group_selection = select_group("Most injuries")
+    except ValueError:
+        return
+    result = app.most_injuries_weather(group_selection)
+    print("Most injured in Weather Conditions ({}, Descending):".format(group_selection))
+    print_formatted_weather_ranking(result, "injury(s)")
+
+
+def crashes_by_borough(app):
+    for borough, crashes in app.crashes_by_borough():
+        print("{}: {}".format(borough if borough != "" else "No Borough", crashes))
+
+
+# List of query options: ("option name", menu function, Database method, the spec fields it takes)
 query_options = [
-    ("Crashes by date", app.crashes_by_date),
-    ("Weather by date", app.weather_by_date),
-    ("Most common weather", app.most_common_weather),
-    ("Most crashed-in weather", app.crashes_by_weather),
-    ("Deadliest weather", app.deadliest_weather),
-    ("Most injurious weather", app.most_injuries_weather),
-    ("Crashes by borough", app.crashes_by_borough)
+    ("Crashes by date", crashes_by_date, "crashes_by_date", ("date",)),
+    ("Weather by date", weather_by_date, "weather_by_date", ("date",)),
+    ("Most common weather", most_common_weather, "most_common_weather", ()),
+    ("Most crashed-in weather", crashes_by_weather, "crashes_by_weather", ()),
+    ("Deadliest weather", deadliest_weather, "deadliest_weather", ("group",)),
+    ("Most injurious weather", most_injuries_weather, "most_injuries_weather", ("group",)),
+    ("Crashes by borough", crashes_by_borough, "crashes_by_borough", ())
 ]
 
 
 def print_query_options(options):
     """
     Prints out numbered list of query options
-    :param options: options is a list of tuples of the form ("option name", function object)
+    :param options: options is a list of tuples of the form ("option name", function object, ...)
     :return:null
     """
     current = 1
@@ -28,12 +137,117 @@ def print_query_options(options):
     print("\nType quit to stop, or help to list the options again.")
 
 
+##### Batch mode #####
+
+def find_option(option):
+    """
+    Looks up a query option by its menu number, its name or the name of its Database method
+    :param option: The option given in a query spec
+    :return: the matching entry of query_options
+    """
+    for number, entry in enumerate(query_options, 1):
+        if option == number or str(option).lower() in (str(number), entry[0].lower(), entry[2]):
+            return entry
+    raise ValueError("Unknown option: {}".format(option))
+
+
+def run_spec(app, spec):
+    """
+    Runs a single query spec
+    :param app: The Database to query
+    :param spec: A dict with an "option", plus a "date" or "group" if the option needs one
+    :return: A dict holding the spec and either its "result" or an "error"
+    """
+    try:
+        entry = find_option(spec.get("option"))
+        args = []
+        for field in entry[3]:
+            if field == "group":
+                args.append(spec.get("group", "total"))
+            elif field not in spec:
+                raise ValueError("Option \"{}\" needs a {}".format(entry[0], field))
+            else:
+                args.append(spec[field])
+        return {"spec": spec, "result": getattr(app, entry[2])(*args)}
+    except Exception as e:
+        return {"spec": spec, "error": "{}: {}".format(type(e).__name__, e)}
+
+
+def read_specs(spec_file):
+    """
+    Reads query specs from either a JSON list or JSON Lines (one spec per line)
+    :param spec_file: The open file of specs
+    :return: the list of specs
+    """
+    text = spec_file.read()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def run_batch(app, specs, workers):
+    """
+    Runs every spec, several at once, sharing the Database's connections
+    :param app: The Database to query
+    :param specs: The query specs
+    :param workers: How many queries may run at the same time
+    :return: One result dict per spec, in the same order as the specs
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda spec: run_spec(app, spec), specs))
+
+
+def batch_main(args):
+    """
+    Runs the query specs in args.batch and writes their results as JSON
+    :return: 0 if every spec succeeded, 1 otherwise
+    """
+    if args.batch == "-":
+        specs = read_specs(sys.stdin)
+    else:
+        with open(args.batch, "r") as spec_file:
+            specs = read_specs(spec_file)
+
+    app = open_database(args.embedded, args.workers, **telemetry.database_options(args))
+    try:
+        results = run_batch(app, specs, args.workers)
+        if args.query_stats is not None:
+            app.dump_query_stats(args.query_stats)
+    finally:
+        app.close()
+
+    output = json.dumps(results, indent=2, default=json_value)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    return 1 if any("error" in result for result in results) else 0
+
+
 def main():
     """
     Print options and execute user selections until quit is entered
     This should not be run until retrieve_data.py, and load_data.py have been run (in that order)
     :return:null
     """
+    parser = argparse.ArgumentParser(description="Query the crash and weather database.")
+    parser.add_argument("--batch", metavar="SPECS",
+                        help="run the query specs in this JSON file (- for stdin) instead of the menu")
+    parser.add_argument("--output", help="write batch results to this file instead of stdout")
+    parser.add_argument("--workers", type=int, default=4, help="batch queries to run at the same time")
+    parser.add_argument("--query-stats", metavar="PATH",
+                        help="write per-query latency, rows and bytes to this JSON file after the batch")
+    parser.add_argument("--embedded", metavar="PATH",
+                        help="query this DuckDB file from load_data_async.py --embedded instead of Postgres")
+    telemetry.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.batch is not None:
+        sys.exit(batch_main(args))
+
+    app = open_database(args.embedded, **telemetry.database_options(args))  # Object to interface with the database
+
     print("Enter the number of the query you would like to execute:")
 
     print_query_options(query_options)
@@ -62,7 +276,7 @@ def main():
             continue
 
         # Execute selected query function
-        query_options[user_query_selection - 1][1]()
+        query_options[user_query_selection - 1][1](app)
         print("\n")
 
 
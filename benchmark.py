@@ -0,0 +1,377 @@
+#!/usr/bin/python3
+# benchmark.py
+
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+from pathlib import Path
+from argparse import ArgumentParser
+from datetime import date, timedelta
+from time import perf_counter
+from math import ceil
+import json
+import os
+import random
+import sys
+import psycopg2
+from database import Database, incident_groups
+import load_data_async
+from streets import flush_streets
+
+# Type aliases
+# (name, query, arguments, whether it's a prepared statement)
+Statement = Tuple[str, str, Tuple[Any, ...], bool]
+Call = Tuple[Callable[..., Any], Tuple[Any, ...]]
+
+# Plan keys that change from run to run without the plan itself changing. They're dropped from the
+# stored plans so that diffs between two result files only show real differences.
+VOLATILE_PLAN_KEYS = ("Actual Startup Time", "Actual Total Time", "Planning Time",
+    "Execution Time", "I/O Read Time", "I/O Write Time")
+
+# Rough chance of each weather type being reported on a given day in NYC, used for synthetic data.
+WEATHER_TYPE_ODDS = (0.20, 0.04, 0.06, 0.01, 0.01, 0.12, 0.01, 0.05, 0.03, 0.30, 0.07, 0.01, 0.01)
+BOROUGHS = ("BROOKLYN", "QUEENS", "MANHATTAN", "BRONX", "STATEN ISLAND", "")
+STREETS = ("BROADWAY", "ATLANTIC AVENUE", "NORTHERN BOULEVARD", "QUEENS BOULEVARD",
+    "GRAND CONCOURSE", "FLATBUSH AVENUE", "3 AVENUE", "BELT PARKWAY", "HYLAN BOULEVARD", "")
+FACTORS = ("Driver Inattention/Distraction", "Unspecified", "Following Too Closely",
+    "Failure to Yield Right-of-Way", "Pavement Slippery", "Unsafe Speed", "")
+VEHICLES = ("Sedan", "Station Wagon/Sport Utility Vehicle", "Taxi", "Pick-up Truck", "Bus",
+    "Bike", "")
+# Tables whose size & scan time are reported, to compare storage layouts between runs
+COLLISION_TABLES = ("crash", "location", "injuries", "deaths", "vehiclesfactors")
+# Weather stations to generate weather for, laid out like lines of the station list
+STATIONS = (("USW00094728", "NY CITY CENTRAL PARK, NY US", "40.77898", "-73.96925"),
+    ("USW00014732", "LAGUARDIA AIRPORT, NY US", "40.7792", "-73.88"),
+    ("USW00094789", "JFK INTERNATIONAL AIRPORT, NY US", "40.6386", "-73.7622"))
+
+
+
+##### Synthetic dataset #####
+
+# Build a row laid out like a line of the NOAA weather CSV after csv_split()
+def synthetic_weather_row(rng: random.Random, station: str, day: date) -> List[str]:
+    wet = rng.random() < 0.35
+    row = [station, day.isoformat(), f"{rng.uniform(2, 15):.2f}", "",
+        f"{rng.uniform(0, 2):.2f}" if wet else "0.00", f"{rng.uniform(0, 6):.1f}" if wet
+        and day.month in (12, 1, 2, 3) else "0.0", "0.0", "", str(rng.randint(20, 95)), "", ""]
+    row[9] = str(int(row[8]) - rng.randint(5, 20))
+    row.extend("1" if rng.random() < odds else "" for odds in WEATHER_TYPE_ODDS)
+    return row
+
+# Build a row laid out like a line of the NYC collision CSV after csv_split()
+def synthetic_collision_row(rng: random.Random, day: date, collision_id: int) -> List[str]:
+    latitude, longitude = rng.uniform(40.50, 40.91), rng.uniform(-74.25, -73.70)
+    pedestrians, cyclists, motorists = (rng.choices((0, 1, 2), (90, 8, 2))[0] for i in range(3))
+    killed = rng.choices((0, 1), (998, 2))[0]
+    return [day.strftime("%m/%d/%Y"), f"{rng.randint(0, 23)}:{rng.randint(0, 59):02d}",
+        rng.choice(BOROUGHS), str(rng.randint(10001, 11697)), f"{latitude:.6f}",
+        f"{longitude:.6f}", f"({latitude:.6f}, {longitude:.6f})", rng.choice(STREETS),
+        rng.choice(STREETS), "", str(pedestrians + cyclists + motorists), str(killed),
+        str(pedestrians), str(killed), str(cyclists), "0", str(motorists), "0",
+        *(rng.choice(FACTORS) for i in range(5)), str(collision_id),
+        *(rng.choice(VEHICLES) for i in range(5))]
+
+# Create the schema and fill it with a synthetic dataset using the loader's own executors and
+# post-load step, so that the benchmark database is shaped exactly like a real one.
+def load_synthetic_dataset(dsn: str, schema_path: Path, post_load_path: Path, first_day: date,
+        days: int, crashes_per_day: int, seed: int) -> None:
+    rng = random.Random(seed)
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    with open(schema_path, "r") as schema_file:
+        cur.execute(schema_file.read())
+    for station in STATIONS:
+        load_data_async.insert_station_line(list(station), cur)
+    # The stations & partitions may differ from a previous load in the same process
+    load_data_async.station_lookup = None
+    load_data_async.partition_years = None
+
+    collision_id = 4000000
+    for offset in range(days):
+        day = first_day + timedelta(days = offset)
+        for station in STATIONS:
+            load_data_async.insert_weather_line(synthetic_weather_row(rng, station[0], day), cur)
+        # Vary the number of crashes per day so that per-day aggregates aren't all identical
+        for i in range(max(0, round(rng.gauss(crashes_per_day, crashes_per_day/5)))):
+            load_data_async.insert_collision_line(synthetic_collision_row(rng, day, collision_id),
+                cur)
+            collision_id += 1
+    flush_streets(cur)
+    for table, partition_name in load_data_async.list_partitions(cur):
+        load_data_async.prepare_partition(table, partition_name, cur)
+    with open(post_load_path, "r") as post_load_file:
+        cur.execute(post_load_file.read())
+    conn.commit()
+    conn.close()
+
+
+
+##### Measurement #####
+
+# Records every prepared statement & export query a Database method runs, so that it can be
+# EXPLAINed afterwards.
+class RecordingDatabase(Database):
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.recorded: List[Statement] = []
+
+    def execute_prepared(self, name: str, query: str, *args: Any) -> Any:
+        self.recorded.append((name, query, args, True))
+        return super().execute_prepared(name, query, *args)
+
+    # Exports stream their rows through a cursor of their own rather than a prepared statement
+    def export_query(self, query: str, path: str, file_format: str = "csv", fetch_size: int = 10000,
+            args: Tuple[Any, ...] = (), use_copy: bool = False) -> int:
+        self.recorded.append((f"export_{file_format}", query, tuple(args), False))
+        return super().export_query(query, path, file_format, fetch_size, args, use_copy)
+
+    # Run EXPLAIN (ANALYZE, BUFFERS) on a recorded statement
+    def explain(self, statement: Statement) -> Dict[str, Any]:
+        name, query, args, prepared = statement
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                if prepared:
+                    query = self._prepare(connection, cursor, name, query, args)
+                cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", args)
+                return cursor.fetchone()[0][0]
+
+# Remove timing noise from a plan tree
+def strip_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
+    out = {k: v for k, v in plan.items() if k not in VOLATILE_PLAN_KEYS and k != "Plans"}
+    if "Plans" in plan:
+        out["Plans"] = [strip_plan(p) for p in plan["Plans"]]
+    return out
+
+# Nearest-rank percentile of an already sorted list
+def percentile(ordered: Sequence[float], pct: float) -> float:
+    return ordered[min(len(ordered) - 1, max(0, ceil(pct/100*len(ordered)) - 1))]
+
+# Every Database method along with a function giving the arguments for each of its runs
+def benchmark_calls(database: Database, rng: random.Random, first_day: date,
+        days: int) -> Dict[str, Callable[[], Call]]:
+    def random_day() -> Tuple[str]:
+        return ((first_day + timedelta(days = rng.randrange(days))).strftime("%Y/%m/%d"),)
+    # Many dates at once, as a dashboard looking up a month of scattered days would ask for them
+    def random_days(count: int = 30) -> Tuple[List[str]]:
+        return ([random_day()[0] for i in range(count)],)
+    last_day = (first_day + timedelta(days = days - 1)).strftime("%Y/%m/%d")
+    whole_range = (first_day.strftime("%Y/%m/%d"), last_day)
+    first_month = (first_day.strftime("%Y/%m/%d"),
+        (first_day + timedelta(days = min(days, 31) - 1)).strftime("%Y/%m/%d"))
+    # refine_ranking() hands back a future, so it's timed until the exact answer is in
+    def refined_ranking(ranking: str, group: str = "total") -> Any:
+        return database.refine_ranking(ranking, group).result()
+    calls = {
+        "crashes_by_date": lambda: (database.crashes_by_date, random_day()),
+        "weather_by_date": lambda: (database.weather_by_date, random_day()),
+        "crashes_by_dates[30]": lambda: (database.crashes_by_dates, random_days()),
+        "weather_by_dates[30]": lambda: (database.weather_by_dates, random_days()),
+        "most_common_weather": lambda: (database.most_common_weather, ()),
+        "crashes_by_weather": lambda: (database.crashes_by_weather, ()),
+        "crashes_by_borough": lambda: (database.crashes_by_borough, ()),
+        "crash_series[day]": lambda: (database.crash_series, whole_range + ("day",)),
+        "crash_series[month]": lambda: (database.crash_series, whole_range + ("month",)),
+        "crash_series[month, borough]":
+            lambda: (database.crash_series, whole_range + ("month", "BROOKLYN")),
+        "crashes_in_weather[fog, rain, not snow]":
+            lambda: (database.crashes_in_weather, (("WT01", "WT16"), ("WT18",))),
+        "crashes_near[500m]": lambda: (database.crashes_near, (40.758, -73.9855, 500)),
+        "crashes_in_box[midtown]":
+            lambda: (database.crashes_in_box, (40.74, -74.01, 40.77, -73.96)),
+        "crash_heatmap": lambda: (database.crash_heatmap, ()),
+        "crash_heatmap[rain]": lambda: (database.crash_heatmap, whole_range + (("WT16",),)),
+        "crash_rollup[borough, hour]": lambda: (database.crash_rollup, (("borough", "hour"),)),
+        "crash_rollup[year, month]": lambda: (database.crash_rollup, (("year", "month"),)),
+        "hourly_profile[rain, brooklyn]":
+            lambda: (database.hourly_profile, (("WT16",), (), "BROOKLYN")),
+        "dangerous_intersections": lambda: (database.dangerous_intersections, ()),
+        "dangerous_intersections[queens, rain, killed]":
+            lambda: (database.dangerous_intersections, ("QUEENS", "WT16", "killed")),
+        "top_contributing_factors[snow]":
+            lambda: (database.top_contributing_factors, ("WT18",)),
+        "top_vehicle_types[rain, injured]": lambda: (database.top_vehicle_types, ("WT16", "injured")),
+        "estimate_ranking[crashes_by_weather]":
+            lambda: (database.estimate_ranking, ("crashes_by_weather",)),
+        "estimate_ranking[deadliest_weather, pedestrians]":
+            lambda: (database.estimate_ranking, ("deadliest_weather", "pedestrians")),
+        "estimate_ranking[crashes_by_borough]":
+            lambda: (database.estimate_ranking, ("crashes_by_borough",)),
+        "refine_ranking[crashes_by_weather]": lambda: (refined_ranking, ("crashes_by_weather",)),
+        # Exports are written to the null device, so only the query & the encoding of its rows
+        # count. Their query is recorded & EXPLAINed like the prepared statements.
+        "export_crashes[csv, month]":
+            lambda: (database.export_crashes, (os.devnull, "csv") + first_month),
+        "export_crashes[jsonl, month]":
+            lambda: (database.export_crashes, (os.devnull, "jsonl") + first_month),
+    }
+    for group in incident_groups:
+        group = group.lower()
+        calls[f"deadliest_weather[{group}]"] = \
+            lambda group = group: (database.deadliest_weather, (group,))
+        calls[f"most_injuries_weather[{group}]"] = \
+            lambda group = group: (database.most_injuries_weather, (group,))
+    return calls
+
+# Time repeated runs of one method, then EXPLAIN the statements it ran on its last run
+def measure(database: RecordingDatabase, next_call: Callable[[], Call], warmup: int,
+        iterations: int) -> Dict[str, Any]:
+    latencies = []
+    for i in range(warmup + iterations):
+        method, args = next_call()
+        database.recorded.clear()
+        time_start = perf_counter()
+        method(*args)
+        time_elapsed = perf_counter() - time_start
+        if i >= warmup:
+            latencies.append(time_elapsed*1000)
+    latencies.sort()
+
+    statements = []
+    for statement in database.recorded:
+        explained = database.explain(statement)
+        plan = explained["Plan"]
+        statements.append({
+            "name": statement[0],
+            "args": [str(a) for a in statement[2]],
+            "execution_ms": round(explained["Execution Time"], 3),
+            "buffers": {"hit": plan.get("Shared Hit Blocks", 0),
+                "read": plan.get("Shared Read Blocks", 0)},
+            "plan": strip_plan(plan),
+        })
+    return {
+        "latency_ms": {"min": round(latencies[0], 3), "p50": round(percentile(latencies, 50), 3),
+            "p90": round(percentile(latencies, 90), 3), "p99": round(percentile(latencies, 99), 3),
+            "max": round(latencies[-1], 3)},
+        "buffers": {"hit": sum(s["buffers"]["hit"] for s in statements),
+            "read": sum(s["buffers"]["read"] for s in statements)},
+        "statements": statements,
+    }
+
+# Size of each collision table across its partitions, and the best of a few full scans of it
+def table_stats(database: Database, scans: int = 3) -> Dict[str, Any]:
+    stats = {}
+    with database.connection() as connection:
+        with connection.cursor() as cursor:
+            # Make the scans read the table itself rather than its primary key
+            cursor.execute("SET enable_indexonlyscan = off")
+            for table in COLLISION_TABLES:
+                cursor.execute("SELECT COALESCE(SUM(pg_total_relation_size(inhrelid)), 0), "
+                    "COALESCE(SUM(pg_relation_size(inhrelid)), 0) FROM pg_inherits "
+                    "WHERE inhparent = %s::regclass", (table,))
+                total_bytes, table_bytes = cursor.fetchone()
+                timings = []
+                for i in range(scans):
+                    time_start = perf_counter()
+                    cursor.execute(f"SELECT COUNT(*) FROM {table}")
+                    cursor.fetchone()
+                    timings.append((perf_counter() - time_start)*1000)
+                stats[table] = {"total_bytes": int(total_bytes), "table_pages": int(table_bytes)//8192,
+                    "scan_ms": round(min(timings), 3)}
+            cursor.execute("RESET enable_indexonlyscan")
+    return stats
+
+
+
+##### Baseline comparison #####
+
+# List every method whose median latency or buffer usage grew by more than the threshold. Very fast
+# queries are given a little slack so that timer noise doesn't count as a regression.
+def find_regressions(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float,
+        min_latency_ms: float) -> List[str]:
+    regressions = []
+    for name, base in baseline["methods"].items():
+        if (current := results["methods"].get(name)) is None:
+            regressions.append(f"{name}: missing from this run")
+            continue
+        base_p50, p50 = base["latency_ms"]["p50"], current["latency_ms"]["p50"]
+        if p50 > max(base_p50*(1 + threshold), base_p50 + min_latency_ms):
+            regressions.append(f"{name}: p50 latency {base_p50:.3f}ms -> {p50:.3f}ms")
+        base_blocks = base["buffers"]["hit"] + base["buffers"]["read"]
+        blocks = current["buffers"]["hit"] + current["buffers"]["read"]
+        if blocks > base_blocks*(1 + threshold) and blocks - base_blocks > 8:
+            regressions.append(f"{name}: buffers touched {base_blocks} -> {blocks}")
+    return regressions
+
+# Describe how each table's size & scan time changed, e.g. after changing the storage layout
+def compare_tables(results: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    changes = []
+    for table, base in baseline.get("tables", {}).items():
+        if (current := results["tables"].get(table)) is None:
+            continue
+        changes.append(f"{table}: {base['total_bytes']/2**20:.1f}MB -> "
+            f"{current['total_bytes']/2**20:.1f}MB ({base['table_pages']} -> "
+            f"{current['table_pages']} pages), scan {base['scan_ms']:.3f}ms -> "
+            f"{current['scan_ms']:.3f}ms")
+    return changes
+
+
+
+##### MAIN #####
+
+def main() -> None:
+    this_dir = Path(__file__).parent
+
+    parser = ArgumentParser(description = "Benchmark every Database query against a synthetic "
+        "dataset and optionally compare the results against a stored baseline.")
+    parser.add_argument("--dsn", default = "host='localhost' dbname='dbms_benchmark' "
+        "user='dbms_project_user' password='dbms_password'",
+        help = "connection string of a scratch database; its tables WILL be dropped")
+    parser.add_argument("--days", type = int, default = 365, help = "days of synthetic data")
+    parser.add_argument("--crashes-per-day", type = int, default = 200)
+    parser.add_argument("--seed", type = int, default = 4380)
+    parser.add_argument("--skip-load", action = "store_true",
+        help = "reuse the data already in the database")
+    parser.add_argument("--warmup", type = int, default = 2)
+    parser.add_argument("--iterations", type = int, default = 20)
+    parser.add_argument("--only", action = "append", default = [],
+        help = "benchmark only this method (may be repeated)")
+    parser.add_argument("--output", type = Path, help = "write the results here (default: stdout)")
+    parser.add_argument("--baseline", type = Path, help = "results file to compare against")
+    parser.add_argument("--threshold", type = float, default = 0.25,
+        help = "allowed fractional growth in p50 latency or buffers before failing")
+    parser.add_argument("--min-latency-ms", type = float, default = 1.,
+        help = "latency growth below this many milliseconds is never a regression")
+    args = parser.parse_args()
+
+    first_day = date(2013, 1, 1)
+    if not args.skip_load:
+        print("### Loading synthetic dataset ###", file = sys.stderr)
+        time_start = perf_counter()
+        load_synthetic_dataset(args.dsn, this_dir.joinpath("schema.sql"),
+            this_dir.joinpath("post_load.sql"), first_day, args.days, args.crashes_per_day,
+            args.seed)
+        print(f"    (loaded in {load_data_async.duration(perf_counter() - time_start)})",
+            file = sys.stderr)
+
+    rng = random.Random(args.seed)
+    database = RecordingDatabase(args.dsn, 1, 1)
+    results = {
+        "config": {"days": args.days, "crashes_per_day": args.crashes_per_day,
+            "seed": args.seed, "warmup": args.warmup, "iterations": args.iterations},
+        "methods": {},
+    }
+    for name, next_call in benchmark_calls(database, rng, first_day, args.days).items():
+        if args.only and name.split("[")[0] not in args.only:
+            continue
+        print(f"+++ Benchmarking {name} +++", file = sys.stderr)
+        results["methods"][name] = measure(database, next_call, args.warmup, args.iterations)
+    results["tables"] = table_stats(database)
+    database.close()
+
+    output = json.dumps(results, indent = 2, sort_keys = True, default = str)
+    if args.output is None:
+        print(output)
+    else:
+        args.output.write_text(output + "\n")
+
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())
+        for change in compare_tables(results, baseline):
+            print(f"TABLE: {change}", file = sys.stderr)
+        regressions = find_regressions(results, baseline, args.threshold, args.min_latency_ms)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file = sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against baseline", file = sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+# benchmark_backends.py
+#
+# Compare the Postgres and embedded (DuckDB) backends on the same synthetic CSVs: how long each takes
+# to load them, and the latency of every query that benchmark.py runs.
+
+from typing import Any, Callable, Dict, List, Optional
+from pathlib import Path
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import csv
+import json
+import os
+import random
+import sys
+import psycopg2
+from database import Database
+from embedded import EmbeddedDatabase, load_embedded
+import benchmark
+import load_data_async
+from streets import flush_streets
+
+COLLISION_FILE = "Motor_Vehicle_Collisions_-_Crashes.csv"
+
+
+
+##### Synthetic CSVs #####
+
+# Write the station list, weather & collision CSVs that both backends load, laid out like the real
+# downloads (each with a header line). Returns the number of collisions written.
+def write_synthetic_csvs(data_dir: Path, first_day: date, days: int, crashes_per_day: int,
+        seed: int) -> int:
+    rng = random.Random(seed)
+    with open(data_dir.joinpath("stations.csv"), "w", newline = "") as station_file:
+        writer = csv.writer(station_file)
+        writer.writerow(load_data_async.STATION_SPEC.layout)
+        writer.writerows(benchmark.STATIONS)
+
+    collision_id = 4000000
+    with open(data_dir.joinpath("weather.csv"), "w", newline = "") as weather_file, \
+            open(data_dir.joinpath(COLLISION_FILE), "w", newline = "") as collision_file:
+        weather_writer, collision_writer = csv.writer(weather_file), csv.writer(collision_file)
+        weather_writer.writerow(load_data_async.WEATHER_SPEC.layout)
+        collision_writer.writerow(load_data_async.COLLISION_SPEC.layout)
+        for offset in range(days):
+            day = first_day + timedelta(days = offset)
+            for station in benchmark.STATIONS:
+                weather_writer.writerow(benchmark.synthetic_weather_row(rng, station[0], day))
+            for i in range(max(0, round(rng.gauss(crashes_per_day, crashes_per_day/5)))):
+                collision_writer.writerow(benchmark.synthetic_collision_row(rng, day, collision_id))
+                collision_id += 1
+    return collision_id - 4000000
+
+# Rows of a CSV, without its header line
+def read_rows(path: Path) -> List[List[str]]:
+    with open(path, "r", newline = "") as data_file:
+        rows = csv.reader(data_file)
+        next(rows, None)
+        return list(rows)
+
+
+
+##### Postgres #####
+
+# CHILD PROCESS: load a share of the collisions with the loader's own executor, in one transaction
+def proc_collisions(dsn: str, rows: List[List[str]]) -> None:
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    for row in rows:
+        load_data_async.insert_collision_line(row, cur)
+    flush_streets(cur)
+    conn.commit()
+    conn.close()
+
+# Load the CSVs into Postgres the way load_data_async.py does: the schema, then the stations &
+# weather, then the collisions split between processes, then the partitions' indexes & the
+# summaries. Returns how many seconds each step took, by step.
+def load_postgres(dsn: str, schema_path: Path, post_load_path: Path, data_dir: Path,
+        num_procs: int) -> Dict[str, float]:
+    timings = {}
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+
+    time_start = perf_counter()
+    cur.execute(schema_path.read_text())
+    for row in read_rows(data_dir.joinpath("stations.csv")):
+        load_data_async.insert_station_line(row, cur)
+    conn.commit()
+    timings["schema_stations"] = perf_counter() - time_start
+
+    time_start = perf_counter()
+    for row in read_rows(data_dir.joinpath("weather.csv")):
+        load_data_async.insert_weather_line(row, cur)
+    conn.commit()
+    timings["weather"] = perf_counter() - time_start
+
+    time_start = perf_counter()
+    rows = read_rows(data_dir.joinpath(COLLISION_FILE))
+    with ProcessPoolExecutor(num_procs) as pool:
+        for result in [pool.submit(proc_collisions, dsn, rows[i::num_procs])
+                for i in range(num_procs)]:
+            result.result()
+    timings["collisions"] = perf_counter() - time_start
+
+    time_start = perf_counter()
+    for table, partition_name in load_data_async.list_partitions(cur):
+        load_data_async.prepare_partition(table, partition_name, cur)
+    conn.commit()
+    timings["partitions"] = perf_counter() - time_start
+
+    time_start = perf_counter()
+    cur.execute(post_load_path.read_text())
+    conn.commit()
+    timings["summaries"] = perf_counter() - time_start
+    conn.close()
+    return timings
+
+
+
+##### Measurement #####
+
+# Time repeated runs of every query on one backend. Each backend is given its own generator with the
+# same seed, so both answer the same questions.
+def time_queries(database: Database, seed: int, first_day: date, days: int, warmup: int,
+        iterations: int, only: List[str]) -> Dict[str, Dict[str, float]]:
+    results = {}
+    calls = benchmark.benchmark_calls(database, random.Random(seed), first_day, days)
+    for name, next_call in calls.items():
+        if only and name.split("[")[0] not in only:
+            continue
+        latencies = []
+        for i in range(warmup + iterations):
+            method, args = next_call()
+            time_start = perf_counter()
+            method(*args)
+            if i >= warmup:
+                latencies.append((perf_counter() - time_start)*1000)
+        latencies.sort()
+        results[name] = {"min": round(latencies[0], 3),
+            "p50": round(benchmark.percentile(latencies, 50), 3),
+            "p99": round(benchmark.percentile(latencies, 99), 3), "max": round(latencies[-1], 3)}
+    return results
+
+# Put both backends' latencies side by side, with how many times faster the embedded one is at p50
+def compare_methods(postgres: Optional[Dict[str, Any]],
+        embedded: Dict[str, Any]) -> Dict[str, Any]:
+    methods = {}
+    for name, latency in embedded.items():
+        methods[name] = {"embedded": latency}
+        if postgres is not None and name in postgres:
+            methods[name]["postgres"] = postgres[name]
+            methods[name]["speedup_p50"] = round(postgres[name]["p50"]/max(latency["p50"], 0.001), 2)
+    return methods
+
+def print_summary(results: Dict[str, Any], out: Callable[..., None]) -> None:
+    for backend, timings in results["load_seconds"].items():
+        steps = ", ".join(f"{step} {load_data_async.duration(seconds)}"
+            for step, seconds in timings.items())
+        out(f"LOAD {backend}: {load_data_async.duration(sum(timings.values()))} ({steps})")
+    for name, methods in results["methods"].items():
+        line = f"{name}: embedded p50 {methods['embedded']['p50']:.3f}ms"
+        if "postgres" in methods:
+            line += f", postgres p50 {methods['postgres']['p50']:.3f}ms ({methods['speedup_p50']}x)"
+        out(line)
+
+
+
+##### MAIN #####
+
+def main() -> None:
+    this_dir = Path(__file__).parent
+
+    parser = ArgumentParser(description = "Load the same synthetic CSVs into Postgres and into an "
+        "embedded DuckDB file, then compare load times and the latency of every query.")
+    parser.add_argument("--dsn", default = "host='localhost' dbname='dbms_benchmark' "
+        "user='dbms_project_user' password='dbms_password'",
+        help = "connection string of a scratch database; its tables WILL be dropped")
+    parser.add_argument("--embedded", type = Path, default = Path("benchmark.duckdb"),
+        help = "DuckDB file to build; an existing one is replaced")
+    parser.add_argument("--skip-postgres", action = "store_true",
+        help = "only benchmark the embedded backend")
+    parser.add_argument("--data-dir", type = Path,
+        help = "write the synthetic CSVs here and keep them (default: a temporary directory)")
+    parser.add_argument("--days", type = int, default = 365, help = "days of synthetic data")
+    parser.add_argument("--crashes-per-day", type = int, default = 200)
+    parser.add_argument("--seed", type = int, default = 4380)
+    parser.add_argument("--procs", type = int, default = os.cpu_count() or 1,
+        help = "processes loading the collisions into Postgres")
+    parser.add_argument("--warmup", type = int, default = 2)
+    parser.add_argument("--iterations", type = int, default = 20)
+    parser.add_argument("--only", action = "append", default = [],
+        help = "benchmark only this method (may be repeated)")
+    parser.add_argument("--output", type = Path, help = "write the results here (default: stdout)")
+    args = parser.parse_args()
+
+    first_day = date(2013, 1, 1)
+    results = {
+        "config": {"days": args.days, "crashes_per_day": args.crashes_per_day, "seed": args.seed,
+            "procs": args.procs, "warmup": args.warmup, "iterations": args.iterations},
+        "load_seconds": {},
+    }
+    with TemporaryDirectory() as temp_dir:
+        data_dir = args.data_dir or Path(temp_dir)
+        data_dir.mkdir(parents = True, exist_ok = True)
+        print("### Writing synthetic CSVs ###", file = sys.stderr)
+        results["config"]["collisions"] = write_synthetic_csvs(data_dir, first_day, args.days,
+            args.crashes_per_day, args.seed)
+
+        if not args.skip_postgres:
+            print("### Loading Postgres ###", file = sys.stderr)
+            results["load_seconds"]["postgres"] = load_postgres(args.dsn,
+                this_dir.joinpath("schema.sql"), this_dir.joinpath("post_load.sql"), data_dir,
+                args.procs)
+        print("### Loading embedded ###", file = sys.stderr)
+        results["load_seconds"]["embedded"] = load_embedded(args.embedded, data_dir, (
+            load_data_async.STATION_SPEC, load_data_async.WEATHER_SPEC, load_data_async.COLLISION_SPEC))
+
+    postgres = None
+    if not args.skip_postgres:
+        print("### Querying Postgres ###", file = sys.stderr)
+        database = Database(args.dsn, 1, 1)
+        postgres = time_queries(database, args.seed, first_day, args.days, args.warmup,
+            args.iterations, args.only)
+        database.close()
+    print("### Querying embedded ###", file = sys.stderr)
+    database = EmbeddedDatabase(args.embedded)
+    embedded = time_queries(database, args.seed, first_day, args.days, args.warmup,
+        args.iterations, args.only)
+    database.close()
+    results["methods"] = compare_methods(postgres, embedded)
+
+    output = json.dumps(results, indent = 2, sort_keys = True)
+    if args.output is None:
+        print(output)
+    else:
+        args.output.write_text(output + "\n")
+    print_summary(results, lambda line: print(line, file = sys.stderr))
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,17 @@
-import psycopg2
+import asyncio
+import math
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from statistics import NormalDist
+
+from psycopg2.pool import ThreadedConnectionPool
+
+import export
+import grid
+import telemetry
 
 typecodes = {
     "wt01": "Fog, ice fog, or freezing fog (may include heavy fog)",
@@ -16,6 +29,106 @@ typecodes = {
     "wt22": "Ice fog or freezing fog"
 }
 
+# The bit each weather type occupies in Wtypes.mask
+weather_type_bits = {code: 1 << bit for bit, code in enumerate(typecodes)}
+
+# The ways crashes in CrashCube can be grouped, and the expression for each
+rollup_dimensions = {
+    "year": "extract(year FROM k0.date)::integer",
+    "month": "date_trunc('month', k0.date)::date",
+    "week": "date_trunc('week', k0.date)::date",
+    "date": "k0.date",
+    "weekday": "extract(isodow FROM k0.date)::integer",
+    "hour": "k0.hour",
+    "borough": "k0.borough",
+}
+
+# The weather station of NYC Central Park, the only station whose weather was loaded before weather
+# from several stations was supported
+default_station = "USW00094728"
+
+# The groups of people whose injuries and deaths are recorded for each crash
+incident_groups = ["Total", "Pedestrians", "Cyclists", "Motorists"]
+
+
+def weather_mask(codes):
+    """
+    Packs weather type codes into the bitmask stored in Wtypes.mask
+    :param codes: Weather type codes such as "WT16"
+    :return: the bitmask
+    """
+    mask = 0
+    for code in codes:
+        if code.lower() not in weather_type_bits:
+            raise ValueError("Unknown weather type: {}".format(code))
+        mask |= weather_type_bits[code.lower()]
+    return mask
+
+
+def check_group(group):
+    """
+    Makes sure a group passed in by a caller is one that can be safely formatted into a query
+    :param group: The group to check
+    :return: the group, lowercased
+    """
+    if group.capitalize() not in incident_groups:
+        raise ValueError("Unknown group: {}".format(group))
+    return group.lower()
+
+
+def weather_type_totals(aggregate):
+    """
+    Builds the columns of a weather ranking over CrashFact: the aggregate over the crashes on days
+    with each weather type, one column per type
+    :param aggregate: The aggregate to take, e.g. "SUM(killed_total)"
+    :return: the select list
+    """
+    return ", ".join("{} FILTER (WHERE mask & {} <> 0) AS {}".format(aggregate, bit, code)
+                     for code, bit in weather_type_bits.items())
+
+
+def stratified_estimates(value, domains):
+    """
+    Builds a query estimating totals over CrashFact from its sample in CrashSample. Each date is a
+    stratum: its sampled crashes are scaled up to all of its crashes, and the variance of the
+    estimate is the sum of the variances within the dates.
+    :param value: The value totalled for each crash, e.g. "1" or "killed_total"
+    :param domains: Column name -> the condition a crash has to meet to count towards that column
+    :return: the query, whose columns are each domain's estimate followed by its variance
+    """
+    sums = ", ".join("COALESCE(SUM(({0})::float8) FILTER (WHERE {1}), 0) AS s_{2}, "
+                     "COALESCE(SUM(({0})::float8 * ({0})) FILTER (WHERE {1}), 0) AS q_{2}".format(value, condition, name)
+                     for name, condition in domains.items())
+    estimates = ", ".join("SUM(big_n * s_{0} / small_n) AS {0}, "
+                          "SUM(big_n * (big_n - small_n) * COALESCE((q_{0} - s_{0} * s_{0} / small_n) / "
+                          "NULLIF(small_n - 1, 0), 0) / small_n) AS {0}_variance".format(name)
+                          for name in domains)
+    return """
+    SELECT {}
+    FROM (
+        SELECT MAX(stratum_size)::float8 AS big_n, COUNT(*)::float8 AS small_n, {}
+        FROM CrashSample
+        GROUP BY "date"
+    ) s0
+    """.format(estimates, sums)
+
+
+class PersistentConnectionPool(ThreadedConnectionPool):
+    """
+    A ThreadedConnectionPool that keeps every healthy connection handed back to it, where the base
+    class closes those returned once min_connections are already idle, along with the statements
+    prepared on them
+    """
+
+    def _putconn(self, conn, key=None, close=False):
+        # The base class only keeps a returned connection while fewer than minconn are idle. Callers
+        # hold the pool's lock here, so nothing else sees the raised minimum.
+        minconn, self.minconn = self.minconn, self.maxconn
+        try:
+            super()._putconn(conn, key, close)
+        finally:
+            self.minconn = minconn
+
 
 class Database:
     """
@@ -23,11 +136,64 @@ class Database:
     """
     _connection_string = "host='localhost' dbname='dbms_final_project' user='dbms_project_user' password='dbms_password'"
 
-    def __init__(self):
+    def __init__(self, connection_string=None, min_connections=1, max_connections=8, slow_query_ms=None,
+                 slow_query_log=None, explain_slow=False):
         """
         Constructor for the application
+        :param connection_string: The libpq connection string to use, defaults to the project database
+        :param min_connections: The number of connections the pool opens up front
+        :param max_connections: The most connections the pool will ever hold open at once
+        :param slow_query_ms: Queries taking at least this long are written to the slow-query log
+        :param slow_query_log: The file slow queries are appended to, as JSON Lines
+        :param explain_slow: Whether to EXPLAIN each slow query and log its plan too
+        """
+        self._pool = PersistentConnectionPool(min_connections, max_connections,
+                                              connection_string or self._connection_string)
+        # ThreadedConnectionPool raises instead of blocking when it runs dry, so callers wait here
+        self._available = threading.BoundedSemaphore(max_connections)
+        # Names of the statements already prepared on each pooled connection. An entry goes as soon as
+        # its connection is closed & dropped by the pool.
+        self._prepared = weakref.WeakKeyDictionary()
+        self._prepared_lock = threading.Lock()
+        # Latency, rows, bytes and connection wait of every query, by name
+        self.telemetry = telemetry.QueryTelemetry(slow_query_ms, slow_query_log, explain_slow)
+        # Runs exact answers in the background for refine_ranking(), started on first use
+        self._refiner = None
+        self._refiner_lock = threading.Lock()
+
+    def close(self):
+        """
+        Closes every connection held by the pool
+        :return: None
+        """
+        if self._refiner is not None:
+            self._refiner.shutdown()
+        self._pool.closeall()
+        with self._prepared_lock:
+            self._prepared.clear()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool for the duration of a with block
+        :return: A psycopg2 connection in autocommit mode
         """
-        self._connection = psycopg2.connect(self._connection_string)
+        with self._available:
+            connection = self._pool.getconn()
+            try:
+                # Every query here is a read, so there is no reason to hold a transaction open
+                # between calls. This also keeps PREPAREd statements out of rolled back transactions.
+                if not connection.autocommit:
+                    connection.autocommit = True
+                yield connection
+            except BaseException:
+                # Don't hand a possibly broken connection to the next caller
+                with self._prepared_lock:
+                    self._prepared.pop(connection, None)
+                self._pool.putconn(connection, close=True)
+                raise
+            else:
+                self._pool.putconn(connection)
 
     def execute_query(self, query, *args):
         """
@@ -36,227 +202,740 @@ class Database:
         :param args: The user inputted data to use in place of %s
         :return: The results of the query
         """
-        with self._connection.cursor() as cursor:
-            cursor.execute(query, args)
-            return cursor.description, cursor.fetchall()
+        # Ad hoc queries have no name, so they're told apart by their text
+        return self._run(" ".join(query.split())[:120], query, args)
+
+    def export_query(self, query, path, file_format="csv", fetch_size=10000, args=(), use_copy=False):
+        """
+        Streams the results of a query into a file, so that memory use stays the same however many
+        rows there are. Rows come from a server-side cursor, fetch_size at a time.
+        :param query: The query whose results are exported, any user inputted data should come in the form of %s
+        :param path: The file to write
+        :param file_format: One of "csv", "jsonl" or "parquet"
+        :param fetch_size: How many rows are held in memory at once
+        :param args: The user inputted data to use in place of %s
+        :param use_copy: For CSV, have the server write the file with COPY ... TO STDOUT instead
+        :return: The number of rows exported
+        """
+        if file_format not in export.writers:
+            raise ValueError("Unknown export format: {}".format(file_format))
+        writer_class, binary = export.writers[file_format]
+
+        with self.connection() as connection:
+            # Server-side cursors only live as long as the transaction they're declared in
+            connection.autocommit = False
+            try:
+                with open(path, "wb" if binary else "w", newline=None if binary else "") as output:
+                    if use_copy and file_format == "csv":
+                        with connection.cursor() as cursor:
+                            copy = "COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)".format(
+                                cursor.mogrify(query, args).decode())
+                            cursor.copy_expert(copy, output)
+                            return cursor.rowcount
+
+                    row_count = 0
+                    with connection.cursor(name="export_query") as cursor:
+                        cursor.itersize = fetch_size
+                        cursor.execute(query, args)
+                        rows = cursor.fetchmany(fetch_size)
+                        # A server-side cursor only has a description once something is fetched
+                        writer = writer_class(output, cursor.description)
+                        while rows:
+                            writer.write_rows(rows)
+                            row_count += len(rows)
+                            rows = cursor.fetchmany(fetch_size)
+                        writer.close()
+                    return row_count
+            finally:
+                connection.rollback()
+                connection.autocommit = True
+
+    def export_crashes(self, path, file_format="csv", start=None, end=None, fetch_size=10000):
+        """
+        Exports every crash between two dates along with that day's weather at its nearest station
+        :param path: The file to write
+        :param file_format: One of "csv", "jsonl" or "parquet"
+        :param start: The first date to export (YYYY/MM/DD), defaults to the beginning of the data
+        :param end: The last date to export (YYYY/MM/DD), defaults to the end of the data
+        :param fetch_size: How many rows are held in memory at once
+        :return: The number of rows exported
+        """
+        query = """
+        SELECT c0.id, c0.date, c0.time, c0.station, l0.borough, l0.zip, l0.latitude, l0.longitude,
+                l0.on_st, l0.cross_st, l0.off_st,
+                i0.total AS injured_total, i0.pedestrians AS injured_pedestrians,
+                i0.cyclists AS injured_cyclists, i0.motorists AS injured_motorists,
+                d0.total AS killed_total, d0.pedestrians AS killed_pedestrians,
+                d0.cyclists AS killed_cyclists, d0.motorists AS killed_motorists,
+                t0.maxtemp, t0.mintemp, p0.precip, p0.snow, p0.snowdepth, n0.avgwind, w0.mask AS weather_mask
+        FROM Crash c0
+        JOIN Location l0 ON l0.id = c0.id AND l0.date = c0.date
+        JOIN Injuries i0 ON i0.id = c0.id AND i0.date = c0.date
+        JOIN Deaths d0 ON d0.id = c0.id AND d0.date = c0.date
+        LEFT JOIN Temperature t0 ON t0.station = c0.station AND t0.date = c0.date
+        LEFT JOIN Precipitation p0 ON p0.station = c0.station AND p0.date = c0.date
+        LEFT JOIN Wind n0 ON n0.station = c0.station AND n0.date = c0.date
+        LEFT JOIN Wtypes w0 ON w0.station = c0.station AND w0.date = c0.date
+        WHERE c0.date BETWEEN %s::date AND %s::date
+        """
+        return self.export_query(query, path, file_format, fetch_size,
+                                 (start or "-infinity", end or "infinity"))
+
+    def execute_prepared(self, name, query, *args):
+        """
+        Executes a query that never changes between calls as a server-side prepared statement, so
+        it is only parsed and planned once per pooled connection
+        :param name: A name for the statement, unique to the query text
+        :param query: The query to prepare, any user inputted data should come in the form of $1, $2, ...
+        :param args: The user inputted data to use in place of $1, $2, ...
+        :return: The results of the query
+        """
+        return self._run(name, query, args, prepared=True)
+
+    def _run(self, name, query, args, prepared=False):
+        """
+        Runs a query, recording how long it waited for a connection, how long it took and how much
+        it returned under the given name, and logging it if it was slow
+        :param name: The name the query is recorded under
+        :param query: The query to run
+        :param args: The user inputted data for the query
+        :param prepared: Whether to run the query as a prepared statement called name
+        :return: The results of the query
+        """
+        requested = time.perf_counter()
+        rows = []
+        failed = True
+        with self.connection() as connection:
+            started = time.perf_counter()
+            try:
+                with connection.cursor() as cursor:
+                    statement = self._prepare(connection, cursor, name, query, args) if prepared else query
+                    cursor.execute(statement, args)
+                    description, rows = cursor.description, cursor.fetchall()
+                    failed = False
+            finally:
+                latency_ms = (time.perf_counter() - started) * 1000
+                self.telemetry.record(name, latency_ms, (started - requested) * 1000, len(rows),
+                                      telemetry.result_size(rows), failed)
+            if not failed and self.telemetry.is_slow(latency_ms):
+                plan = self._explain(connection, statement, args) if self.telemetry.explain_slow else None
+                self.telemetry.log_slow(name, query, args, latency_ms, len(rows), plan)
+        return description, rows
+
+    def _explain(self, connection, statement, args):
+        """
+        The plan PostgreSQL chose for a statement, without running it again
+        :return: The plan as JSON, or the error if it couldn't be explained
+        """
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("EXPLAIN (FORMAT JSON) " + statement, args)
+                return cursor.fetchone()[0]
+        except Exception as error:
+            return "EXPLAIN failed: {}".format(error)
+
+    def query_stats(self):
+        """
+        Statistics of every query run so far: calls, errors, latency percentiles and histogram,
+        rows, bytes and time spent waiting for a connection
+        :return: A dict of query name -> statistics, the most time consuming first
+        """
+        return self.telemetry.stats()
+
+    def dump_query_stats(self, path):
+        """
+        Writes the statistics of every query run so far to a JSON file
+        :param path: The file to write
+        :return: None
+        """
+        self.telemetry.dump(path)
+
+    def _prepare(self, connection, cursor, name, query, args):
+        """
+        PREPAREs the given statement on the connection unless that has already been done
+        :return: The EXECUTE statement for the prepared query, with a %s for each argument
+        """
+        with self._prepared_lock:
+            prepared = self._prepared.setdefault(connection, set())
+        if name not in prepared:
+            cursor.execute("PREPARE {} AS {}".format(name, query))
+            prepared.add(name)
+        return "EXECUTE {}{}".format(name, "({})".format(", ".join("%s" for _ in args)) if args else "")
 
 
     def format_weather_type_result(self, result):
         """
-        Formats the result of a query dealing with weather types in a way that can be handled by
-        print_formatted_weather_ranking()
+        Formats the result of a query dealing with weather types as [type code, value] pairs in
+        descending order of value
         :param result: the result of the query to be formatted
         :return: the formatted result
         """
         formatted_result = []
         for weather_index in range(len(result[1][0])):
-            formatted_result.append([result[0][weather_index][0], result[1][0][weather_index]])
+            formatted_result.append([result[0][weather_index][0],
+                                     int(result[1][0][weather_index] or 0)])
 
         formatted_result.sort(key=lambda t: t[1], reverse=True)
         return formatted_result
 
-
-    def print_formatted_weather_ranking(self, result, describing_noun):
+    def weather_by_date(self, date, station=default_station):
         """
-        Prints the ranking of weather conditions in a reusable code chunk
-        :param result: The results of the queries (formatted by format_weather_type_result)
-        :param describing_noun: The trailing noun describing the data
-        :return: None
+        Gathers the weather recorded on a date
+        :param date: The date (YYYY/MM/DD)
+        :param station: The weather station, defaults to Central Park
+        :return: A dict of the day's "maxtemp", "mintemp", "precip", "snow", "snowdepth" and
+        "avgwind", and the type codes of its weather "events", or None if the date has no weather data
         """
-        current_rank = 1
-        for weather_type in result:
-            print("{} {}: {} {}".format("{}.".format(current_rank) if current_rank >= 10 else "{}. ".format(current_rank),
-                                         typecodes[weather_type[0].lower()], weather_type[1], describing_noun))
-            current_rank += 1 # Python depreciating ++ is a disgrace - Your friendly neighborhood python hater
-
-
-    def weather_by_date(self):
-        date = input("Enter a date (YYYY/MM/DD) to gather the weather data: ")
-
         # Gather data across tables
         data_query = """
         SELECT maxtemp, mintemp, precip, snow, snowdepth, avgwind
         FROM Temperature, Precipitation, Wind
-        WHERE Temperature.date = %s
+        WHERE Temperature.date = $1
+        AND Temperature.station = $2
         AND Precipitation.date=Temperature.date
+        AND Precipitation.station=Temperature.station
         AND Temperature.date=Wind.date
+        AND Temperature.station=Wind.station
         """
 
-        # Gather weather type data
+        # Gather weather type data; the codes are lower case, as Postgres folds them, so that
+        # DuckDB, which keeps the case they're written in, gives the same ones
         weather_type_query = """
-        SELECT * 
+        SELECT wt01, wt02, wt03, wt04, wt06, wt08, wt11, wt13, wt14, wt16, wt18, wt19, wt22
         FROM Wtypes
-        WHERE date = %s
+        WHERE date = $1
+        AND station = $2
         """
 
         # Various data across tables
-        column_names, datapoints = self.execute_query(data_query, date)
+        column_names, datapoints = self.execute_prepared("weather_data_by_date", data_query, date, station)
         if len(datapoints)==0:
-            print("Date has no weather data")
-            return
-        datapoints=datapoints[0]
+            return None
+        weather = dict(zip([desc[0] for desc in column_names], datapoints[0]))
 
         # Weather types table
-        column_names, weather_counts = self.execute_query(weather_type_query, date)
+        column_names, weather_counts = self.execute_prepared("weather_types_by_date", weather_type_query, date, station)
         weather_types = [desc[0] for desc in column_names]
-        type_with_count = list(zip(weather_types, weather_counts))
-
-        print("High Temperature ......  {}°F".format(datapoints[0]))
-        print("Low Temperature .......  {}°F".format(datapoints[1]))
-        print("Total precipitation ...  {}".format(datapoints[2]))
-        print("Total snow ............  {}".format(datapoints[3]))
-        print("Snow depth ............  {}".format(datapoints[4]))
-        print("Average Wind ..........  {}".format(datapoints[5]))
-
-        print("\nWeather events:")
-        for twc in type_with_count[2:]:
-            # If the weather type occured on this day
-            if twc[1]:
-                print("- {}".format(typecodes[twc[0]]))
-
-    def most_common_weather(self):
+        type_with_count = list(zip(weather_types, weather_counts[0])) if weather_counts else []
+
+        # The weather types that occurred on this day
+        weather["events"] = [twc[0] for twc in type_with_count if twc[1]]
+        return weather
+
+    def most_common_weather(self, station=default_station):
+        """
+        Counts the days each weather type occurred on
+        :param station: The weather station, defaults to Central Park
+        :return: [type code, days] pairs in descending order
+        """
         # Get the count of the chosen weather type
         query = """
-        SELECT SUM(w1.WT01) AS WT01, SUM(w1.WT02) AS WT02, SUM(w1.WT03) AS WT03, SUM(w1.WT04) AS WT04,
-                SUM(w1.WT06) AS WT06, SUM(w1.WT08) AS WT08, SUM(w1.WT11) AS WT11, SUM(w1.WT13) AS WT13,
-                SUM(w1.WT14) AS WT14, SUM(w1.WT16) AS WT16, SUM(w1.WT18) AS WT18, SUM(w1.WT19) AS WT19,
-                SUM(w1.WT22) AS WT22 
-        FROM Wtypes w1;
+        SELECT SUM(w1.wt01) AS wt01, SUM(w1.wt02) AS wt02, SUM(w1.wt03) AS wt03, SUM(w1.wt04) AS wt04,
+                SUM(w1.wt06) AS wt06, SUM(w1.wt08) AS wt08, SUM(w1.wt11) AS wt11, SUM(w1.wt13) AS wt13,
+                SUM(w1.wt14) AS wt14, SUM(w1.wt16) AS wt16, SUM(w1.wt18) AS wt18, SUM(w1.wt19) AS wt19,
+                SUM(w1.wt22) AS wt22
+        FROM Wtypes w1
+        WHERE w1.station = $1;
         """
 
         # Get result of query
-        result = self.execute_query(query, ())
+        result = self.execute_prepared("most_common_weather", query, station)
 
         # Format result in a form that can be easily sorted
-        formatted_result = self.format_weather_type_result(result)
+        return self.format_weather_type_result(result)
 
-        # Print result
-        print("Most common weather conditions (descending):")
-        self.print_formatted_weather_ranking(formatted_result, "occurrence(s)")
+    def crashes_by_date(self, input_date):
+        """
+        Counts the crashes on a date
+        :param input_date: The date (YYYY/MM/DD)
+        :return: The number of crashes
+        """
+        result = self.execute_prepared("crashes_by_date", "SELECT COUNT(id) FROM Crash WHERE \"date\" = $1", input_date)
+        return result[1][0][0]
 
-    def crashes_by_date(self):
-        print("Selected number of crashes on inputted date")
-        input_date = input("Please enter a date (YYYY/MM/DD): ")
-        result = self.execute_query("SELECT COUNT(id) FROM Crash WHERE \"date\" = %s", input_date)
-        crash_total = result[1][0][0]
-        print("There were " + str(crash_total) + " crashes on the date of " + str(input_date) + ".\n")
+    def crashes_by_dates(self, dates):
+        """
+        Counts the crashes on many dates with a single query
+        :param dates: A list or array of dates (YYYY/MM/DD strings, datetime.dates or numpy datetime64[D]s)
+        :return: The number of crashes on each date, in the same order as the dates
+        """
+        query = """
+        SELECT COALESCE(SUM(c0.crashes), 0)
+        FROM unnest($1::text[]) WITH ORDINALITY d0(day, i)
+        LEFT JOIN CrashDaily c0 ON c0.date = d0.day::date
+        GROUP BY d0.i
+        ORDER BY d0.i
+        """
+        result = self.execute_prepared("crashes_by_dates", query, [str(date) for date in dates])
+        return [int(row[0]) for row in result[1]]
 
+    def weather_by_dates(self, dates, station=default_station):
+        """
+        Gathers the weather recorded on many dates with a single query
+        :param dates: A list or array of dates (YYYY/MM/DD strings, datetime.dates or numpy datetime64[D]s)
+        :param station: The weather station, defaults to Central Park
+        :return: A dict of lists aligned with the dates: "maxtemp", "mintemp", "precip", "snow",
+        "snowdepth", "avgwind" and the type codes of each day's weather "events", all None for dates
+        without weather data
+        """
+        query = """
+        SELECT t0.maxtemp, t0.mintemp, p0.precip, p0.snow, p0.snowdepth, n0.avgwind, w0.mask
+        FROM unnest($1::text[]) WITH ORDINALITY d0(day, i)
+        LEFT JOIN (Temperature t0
+            JOIN Precipitation p0 ON p0.station = t0.station AND p0.date = t0.date
+            JOIN Wind n0 ON n0.station = t0.station AND n0.date = t0.date)
+        ON t0.station = $2 AND t0.date = d0.day::date
+        LEFT JOIN Wtypes w0 ON w0.station = t0.station AND w0.date = t0.date
+        ORDER BY d0.i
+        """
+        result = self.execute_prepared("weather_by_dates", query, [str(date) for date in dates], station)
+
+        columns = ("maxtemp", "mintemp", "precip", "snow", "snowdepth", "avgwind")
+        weather = {column: [] for column in columns + ("events",)}
+        for row in result[1]:
+            found = row[0] is not None
+            for column, value in zip(columns, row):
+                weather[column].append(value)
+            weather["events"].append([code for code, bit in weather_type_bits.items() if (row[6] or 0) & bit]
+                                     if found else None)
+        return weather
+
+    async def crashes_by_dates_async(self, dates):
+        """
+        crashes_by_dates() for asyncio code: the query runs on a thread, so several batches can be
+        awaited at once, each on its own pooled connection
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.crashes_by_dates, dates)
 
-    def crashes_by_weather(self):
-        print("Selected most crashed in weather conditions")
+    async def weather_by_dates_async(self, dates, station=default_station):
+        """
+        weather_by_dates() for asyncio code: the query runs on a thread, so several batches can be
+        awaited at once, each on its own pooled connection
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.weather_by_dates, dates, station)
+
+    def crash_series(self, start, end, bucket="day", borough=None, group="total"):
+        """
+        Counts crashes, injuries and deaths between two dates (inclusive), bucketed by day, week,
+        month or year. Buckets without any crashes are included with counts of zero.
+        :param start: The first date of the range (YYYY/MM/DD)
+        :param end: The last date of the range (YYYY/MM/DD)
+        :param bucket: One of "day", "week", "month" or "year"
+        :param borough: Only count crashes in this borough ("" for crashes with no borough)
+        :param group: The group whose injuries and deaths are counted
+        :return: A dict of equal length lists: "bucket" (the first day of each bucket), "crashes",
+        "injuries" and "deaths"
+        """
+        if bucket not in ("day", "week", "month", "year"):
+            raise ValueError("Unknown bucket: {}".format(bucket))
+        group = self.check_group(group)
+
+        # Summed from the per-day summary table, so even multi-year ranges only touch a few
+        # thousand rows
         query = """
-        SELECT SUM(w1.WT01) AS WT01, SUM(w1.WT02) AS WT02, SUM(w1.WT03) AS WT03, SUM(w1.WT04) AS WT04,
-                SUM(w1.WT06) AS WT06, SUM(w1.WT08) AS WT08, SUM(w1.WT11) AS WT11, SUM(w1.WT13) AS WT13, 
-                SUM(w1.WT14) AS WT14, SUM(w1.WT16) AS WT16, SUM(w1.WT18) AS WT18, SUM(w1.WT19) AS WT19, 
-                SUM(w1.WT22) AS WT22
-        FROM (SELECT cD.count*w0.WT01 AS WT01, cD.count*w0.WT02 AS WT02, cD.count*w0.WT03 AS WT03,
-                     cD.count*w0.WT04 AS WT04, cD.count*w0.WT06 AS WT06, cD.count*w0.WT08 AS WT08, 
-                     cD.count*w0.WT11 AS WT11, cD.count*w0.WT13 AS WT13, cD.count*w0.WT14 AS WT14, 
-                     cD.count*w0.WT16 AS WT16, cD.count*w0.WT18 AS WT18, cD.count*w0.WT19 AS WT19, 
-                     cD.count*w0.WT22 AS WT22  
-                FROM (SELECT c0.date, count(c0.date)
-		        FROM Crash c0
-		        GROUP BY c0.date) AS cD,
-            Wtypes w0
-	    WHERE w0.date=cD.date) AS w1;
-        """
-        result = self.execute_query(query, ())
-        formatted_result = self.format_weather_type_result(result)
-
-        # Print results (descending)
-        print("Most Crashed In Weather Conditions(Descending):")
-        self.print_formatted_weather_ranking(formatted_result, "crash(es)")
-
-    def select_group(self, flag):
-        """
-        Reusable code to prompt the user to select a kind of group
-        :param flag: The set of word(s) describing the type of incident
-        :return: the selected group
-        """
-        print("{} for which group?\n".format(flag))
-        groups = ["Total", "Pedestrians", "Cyclists", "Motorists"]
-        current_number = 1
-        for group in groups:
-            print("{}. {}".format(current_number, groups[current_number - 1]))
-            current_number += 1
-        try:
-            group_selected_identifier = int(input("\nSelection: "))
-        except ValueError:
-            print("Error Invalid Selection")
-            raise ValueError
-        return groups[group_selected_identifier - 1].lower()
-
-    def deadliest_weather(self):
-        print("Selected deadliest weather conditions")
-        try:
-            group_selection = self.select_group("Deadliest")
-        except ValueError:
-            return
+        SELECT b0.bucket::date, COALESCE(SUM(d0.crashes), 0), COALESCE(SUM(d0.injured_{0}), 0),
+                COALESCE(SUM(d0.killed_{0}), 0)
+        FROM generate_series(date_trunc($3, $1::date::timestamp), $2::date::timestamp,
+                ('1 ' || $3)::interval) AS b0(bucket)
+        LEFT JOIN CrashDaily d0 ON d0.date >= b0.bucket AND d0.date < b0.bucket + ('1 ' || $3)::interval
+                AND d0.date BETWEEN $1::date AND $2::date {1}
+        GROUP BY b0.bucket
+        ORDER BY b0.bucket
+        """
+        if borough is None:
+            name = "crash_series_{}".format(group)
+            result = self.execute_prepared(name, query.format(group, ""), start, end, bucket)
+        else:
+            name = "crash_series_borough_{}".format(group)
+            result = self.execute_prepared(name, query.format(group, "AND d0.borough = $4"),
+                                           start, end, bucket, borough)
+
+        columns = list(zip(*result[1])) or [(), (), (), ()]
+        return {"bucket": list(columns[0]), "crashes": list(columns[1]),
+                "injuries": list(columns[2]), "deaths": list(columns[3])}
+
+    def crash_rollup(self, by=("borough",), start=None, end=None, include=(), exclude=(),
+                     borough=None, group="total"):
+        """
+        Rolls CrashCube up to any combination of its dimensions (year, month, week, date, weekday,
+        hour and borough), optionally limited to a date range, a borough and days with (or without)
+        some weather types. Drilling down is a matter of asking for more dimensions.
+        :param by: The dimensions to group by, from rollup_dimensions
+        :param start: The first date to count (YYYY/MM/DD), defaults to the beginning of the data
+        :param end: The last date to count (YYYY/MM/DD), defaults to the end of the data
+        :param include: Weather type codes that must all have occurred
+        :param exclude: Weather type codes that must not have occurred
+        :param borough: Only count crashes in this borough ("" for crashes with no borough)
+        :param group: The group whose injuries and deaths are counted
+        :return: A dict of equal length lists: one per dimension, then "days" (the number of days
+        with crashes that went into each row), "crashes", "injuries" and "deaths"
+        """
+        for dimension in by:
+            if dimension not in rollup_dimensions:
+                raise ValueError("Unknown dimension: {}".format(dimension))
+        group = self.check_group(group)
+        expressions = [rollup_dimensions[dimension] for dimension in by]
 
         query = """
-        SELECT SUM(s0.WT01) AS WT01, SUM(s0.WT02) AS WT02, SUM(s0.WT03) AS WT03, SUM(s0.WT04) AS WT04,
-                SUM(s0.WT06) AS WT06, SUM(s0.WT08) AS WT08, SUM(s0.WT11) AS WT11, SUM(s0.WT13) AS WT13, 
-                SUM(s0.WT14) AS WT14, SUM(s0.WT16) AS WT16, SUM(s0.WT18) AS WT18, SUM(s0.WT19) AS WT19, 
-                SUM(s0.WT22) AS WT22
-        FROM (SELECT deadly_crashes.date, WT01*deadly_crashes.sum AS WT01, WT02*deadly_crashes.sum AS WT02, 
-                WT03*deadly_crashes.sum AS WT03, WT04*deadly_crashes.sum AS WT04, WT06*deadly_crashes.sum AS WT06, 
-                WT08*deadly_crashes.sum AS WT08, WT11*deadly_crashes.sum AS WT11, WT13*deadly_crashes.sum AS WT13, 
-                WT14*deadly_crashes.sum AS WT14, WT16*deadly_crashes.sum AS WT16, WT18*deadly_crashes.sum AS WT18, 
-                WT19*deadly_crashes.sum AS WT19, WT22*deadly_crashes.sum AS WT22
-	        FROM (SELECT c0.date, SUM(d0.{})
-		    FROM Crash c0, Deaths d0
-		    WHERE c0.id=d0.id
-		    GROUP BY c0.date) AS deadly_crashes, 
-		    Wtypes t0
-	    WHERE t0.date=deadly_crashes.date) AS s0;
-        """.format(group_selection)
-
-        result = self.execute_query(query, ())
-        formatted_result = self.format_weather_type_result(result)
-
-        # Print results (descending)
-        print("Deadliest Weather Conditions ({}, Descending):".format(group_selection))
-        self.print_formatted_weather_ranking(formatted_result, "death(s)")
-
-    def most_injuries_weather(self):
-        print("Selected most injured in weather conditions")
-        try:
-            group_selection = self.select_group("Most injuries")
-        except ValueError:
-            return
+        SELECT {0}COUNT(DISTINCT k0.date), SUM(k0.crashes), SUM(k0.injured_{1}), SUM(k0.killed_{1})
+        FROM CrashCube k0, Wtypes w0
+        WHERE k0.date BETWEEN $1::date AND $2::date
+        AND w0.date = k0.date
+        AND w0.station = k0.station
+        AND w0.mask & $3 = $3
+        AND w0.mask & $4 = 0
+        AND ($5::varchar IS NULL OR k0.borough = $5)
+        {2}
+        {3}
+        """.format("".join(expression + ", " for expression in expressions), group,
+                   "GROUP BY " + ", ".join(expressions) if expressions else "",
+                   "ORDER BY " + ", ".join(expressions) if expressions else "")
+        result = self.execute_prepared("crash_rollup_{}_{}".format("_".join(by), group), query,
+                                       start or "-infinity", end or "infinity", weather_mask(include),
+                                       weather_mask(exclude), borough)
+
+        names = list(by) + ["days", "crashes", "injuries", "deaths"]
+        columns = list(zip(*result[1])) or [()]*len(names)
+        return {name: list(column) for name, column in zip(names, columns)}
+
+    def hourly_profile(self, include=(), exclude=(), borough=None, start=None, end=None, group="total"):
+        """
+        The number of crashes in each hour of the day, e.g. on rainy days or on clear days, for the
+        whole city or one borough
+        :param include: Weather type codes that must all have occurred
+        :param exclude: Weather type codes that must not have occurred
+        :param borough: Only count crashes in this borough ("" for crashes with no borough)
+        :param start: The first date to count (YYYY/MM/DD), defaults to the beginning of the data
+        :param end: The last date to count (YYYY/MM/DD), defaults to the end of the data
+        :param group: The group whose injuries and deaths are counted
+        :return: A dict with the number of matching "days" and lists of 24 "crashes", "injuries"
+        and "deaths" counts, one per hour starting at midnight
+        """
+        rollup = self.crash_rollup(("hour",), start, end, include, exclude, borough, group)
+        days = self.crash_rollup((), start, end, include, exclude, borough, group)["days"]
+        profile = {"days": days[0] if days else 0}
+        for measure in ("crashes", "injuries", "deaths"):
+            profile[measure] = [0]*24
+            for hour, value in zip(rollup["hour"], rollup[measure]):
+                if hour is not None:
+                    profile[measure][hour] = value
+        return profile
+
+    def crashes_in_weather(self, include=(), exclude=(), group="total"):
+        """
+        Totals crashes on the days that had all of the included weather types and none of the
+        excluded ones, e.g. fog and rain but not snow
+        :param include: Weather type codes that must all have occurred
+        :param exclude: Weather type codes that must not have occurred
+        :param group: The group whose injuries and deaths are counted
+        :return: A dict with the number of matching "days" and their "crashes", "injuries" and "deaths"
+        """
+        group = self.check_group(group)
+        include_mask, exclude_mask = weather_mask(include), weather_mask(exclude)
+
+        query = """
+        SELECT COUNT(DISTINCT w0.date), COALESCE(SUM(d0.crashes), 0),
+                COALESCE(SUM(d0.injured_{0}), 0), COALESCE(SUM(d0.killed_{0}), 0)
+        FROM Wtypes w0, CrashDaily d0
+        WHERE w0.mask & $1 = $1
+        AND w0.mask & $2 = 0
+        AND d0.date = w0.date
+        AND d0.station = w0.station
+        """.format(group)
+        result = self.execute_prepared("crashes_in_weather_{}".format(group), query,
+                                       include_mask, exclude_mask)
+        days, crashes, injuries, deaths = result[1][0]
+        return {"days": days, "crashes": crashes, "injuries": injuries, "deaths": deaths}
+
+    def crashes_near(self, latitude, longitude, radius, start=None, end=None):
+        """
+        Totals the crashes within a distance of a point, optionally between two dates
+        :param latitude: Latitude of the point
+        :param longitude: Longitude of the point
+        :param radius: The distance from the point in meters
+        :param start: The first date to count (YYYY/MM/DD), defaults to the beginning of the data
+        :param end: The last date to count (YYYY/MM/DD), defaults to the end of the data
+        :return: A dict with the number of "crashes", "injuries" and "deaths"
+        """
+        # Only the crashes in grid cells that overlap the circle are measured
+        cells = grid.cells_in_box(*grid.box_around(latitude, longitude, radius))
+        query = """
+        SELECT COUNT(*), COALESCE(SUM(f0.injured_total), 0), COALESCE(SUM(f0.killed_total), 0)
+        FROM CrashFact f0
+        WHERE f0.cell = ANY($1::integer[])
+        AND power((f0.latitude - $2::float8)*111320, 2)
+            + power((f0.longitude - $3::float8)*111320*cos(radians($2::float8)), 2) <= power($4::float8, 2)
+        AND f0.date BETWEEN $5::date AND $6::date
+        """
+        result = self.execute_prepared("crashes_near", query, cells, latitude, longitude, radius,
+                                       start or "-infinity", end or "infinity")
+        crashes, injuries, deaths = result[1][0]
+        return {"crashes": crashes, "injuries": injuries, "deaths": deaths}
+
+    def crashes_in_box(self, south, west, north, east, start=None, end=None):
+        """
+        Totals the crashes inside a box of coordinates, optionally between two dates. Grid cells
+        entirely inside the box are counted from the per-cell summary; only the cells on its edge
+        have their crashes checked one by one.
+        :param south: The southern edge of the box (latitude)
+        :param west: The western edge of the box (longitude)
+        :param north: The northern edge of the box (latitude)
+        :param east: The eastern edge of the box (longitude)
+        :param start: The first date to count (YYYY/MM/DD), defaults to the beginning of the data
+        :param end: The last date to count (YYYY/MM/DD), defaults to the end of the data
+        :return: A dict with the number of "crashes", "injuries" and "deaths"
+        """
+        inner_cells, edge_cells = [], []
+        for cell in grid.cells_in_box(south, west, north, east):
+            cell_south, cell_west, cell_north, cell_east = grid.cell_bounds(cell)
+            if south <= cell_south and west <= cell_west and cell_north <= north and cell_east <= east:
+                inner_cells.append(cell)
+            else:
+                edge_cells.append(cell)
+
+        query = """
+        SELECT SUM(crashes), SUM(injured), SUM(killed)
+        FROM (SELECT COALESCE(SUM(s0.crashes), 0) AS crashes, COALESCE(SUM(s0.injured), 0) AS injured,
+                    COALESCE(SUM(s0.killed), 0) AS killed
+                FROM CellDaily s0
+                WHERE s0.cell = ANY($1::integer[])
+                AND s0.date BETWEEN $7::date AND $8::date
+            UNION ALL
+            SELECT COUNT(*), COALESCE(SUM(f0.injured_total), 0), COALESCE(SUM(f0.killed_total), 0)
+                FROM CrashFact f0
+                WHERE f0.cell = ANY($2::integer[])
+                AND f0.latitude BETWEEN $3::float8 AND $5::float8
+                AND f0.longitude BETWEEN $4::float8 AND $6::float8
+                AND f0.date BETWEEN $7::date AND $8::date) AS parts
+        """
+        result = self.execute_prepared("crashes_in_box", query, inner_cells, edge_cells, south, west,
+                                       north, east, start or "-infinity", end or "infinity")
+        crashes, injuries, deaths = result[1][0]
+        return {"crashes": crashes, "injuries": injuries, "deaths": deaths}
 
+    def crash_heatmap(self, start=None, end=None, include=(), exclude=()):
+        """
+        Counts crashes per grid cell, optionally between two dates and only on days with (or
+        without) some weather types. Answered entirely from the per-cell summary.
+        :param start: The first date to count (YYYY/MM/DD), defaults to the beginning of the data
+        :param end: The last date to count (YYYY/MM/DD), defaults to the end of the data
+        :param include: Weather type codes that must all have occurred
+        :param exclude: Weather type codes that must not have occurred
+        :return: A dict of equal length lists: "cell", "latitude" and "longitude" (of the middle of
+        the cell), "crashes", "injuries" and "deaths"
+        """
+        query = """
+        SELECT s0.cell, SUM(s0.crashes), SUM(s0.injured), SUM(s0.killed)
+        FROM CellDaily s0, Wtypes w0
+        WHERE s0.date BETWEEN $1::date AND $2::date
+        AND w0.date = s0.date
+        AND w0.station = s0.station
+        AND w0.mask & $3 = $3
+        AND w0.mask & $4 = 0
+        GROUP BY s0.cell
+        ORDER BY s0.cell
+        """
+        result = self.execute_prepared("crash_heatmap", query, start or "-infinity", end or "infinity",
+                                       weather_mask(include), weather_mask(exclude))
+
+        columns = list(zip(*result[1])) or [(), (), (), ()]
+        centers = [grid.cell_center(cell) for cell in columns[0]]
+        return {"cell": list(columns[0]), "latitude": [center[0] for center in centers],
+                "longitude": [center[1] for center in centers], "crashes": list(columns[1]),
+                "injuries": list(columns[2]), "deaths": list(columns[3])}
+
+    def dangerous_intersections(self, borough=None, weather=None, by="crashes", limit=10):
+        """
+        Finds the intersections with the most crashes, injuries or deaths, reading only the top
+        entries of an index on IntersectionStats
+        :param borough: Only count crashes in this borough, None for every borough
+        :param weather: Only count crashes on days with this weather type code, None for any weather
+        :param by: What to rank the intersections by: "crashes", "injured" or "killed"
+        :param limit: How many intersections to return
+        :return: A list of dicts of each intersection's two "streets" and its "crashes", "injured"
+        and "killed", in descending order of the ranked count
+        """
+        if by not in ("crashes", "injured", "killed"):
+            raise ValueError("Unknown ranking: {}".format(by))
         query = """
-        SELECT SUM(s0.WT01) AS WT01, SUM(s0.WT02) AS WT02, SUM(s0.WT03) AS WT03, SUM(s0.WT04) AS WT04,
-                SUM(s0.WT06) AS WT06, SUM(s0.WT08) AS WT08, SUM(s0.WT11) AS WT11, SUM(s0.WT13) AS WT13,
-                SUM(s0.WT14) AS WT14, SUM(s0.WT16) AS WT16, SUM(s0.WT18) AS WT18, SUM(s0.WT19) AS WT19,
-                SUM(s0.WT22) AS WT22
-                FROM (SELECT injury_crashes.date, WT01*injury_crashes.sum AS WT01, WT02*injury_crashes.sum AS WT02,
-                        WT03*injury_crashes.sum AS WT03, WT04*injury_crashes.sum AS WT04, WT06*injury_crashes.sum AS WT06,
-                        WT08*injury_crashes.sum AS WT08, WT11*injury_crashes.sum AS WT11, WT13*injury_crashes.sum AS WT13,
-                        WT14*injury_crashes.sum AS WT14, WT16*injury_crashes.sum AS WT16, WT18*injury_crashes.sum AS WT18,
-                        WT19*injury_crashes.sum AS WT19, WT22*injury_crashes.sum AS WT22
-	                    FROM (SELECT c0.date, SUM(i0.{})
-		                        FROM Crash c0, Injuries i0
-		                        WHERE c0.id=i0.id
-		                        GROUP BY c0.date) AS injury_crashes, 
-		                Wtypes t0
-	            WHERE t0.date=injury_crashes.date) AS s0;
-        """.format(group_selection)
-        result = self.execute_query(query, ())
-        formatted_result = self.format_weather_type_result(result)
-
-        # Print results (descending)
-        print("Most injured in Weather Conditions ({}, Descending):".format(group_selection))
-        self.print_formatted_weather_ranking(formatted_result, "injury(s)")
+        SELECT a0.name, b0.name, s0.crashes, s0.injured, s0.killed
+        FROM IntersectionStats s0
+        JOIN Street a0 ON a0.id = s0.street_a
+        JOIN Street b0 ON b0.id = s0.street_b
+        WHERE s0.borough = $1
+        AND s0.weather = $2
+        ORDER BY s0.{} DESC
+        LIMIT $3
+        """.format(by)
+        result = self.execute_prepared("dangerous_intersections_{}".format(by), query,
+                                       "*" if borough is None else borough.upper(),
+                                       0 if weather is None else weather_mask([weather]), int(limit))
+        return [{"streets": [street_a, street_b], "crashes": crashes, "injured": injured, "killed": killed}
+                for street_a, street_b, crashes, injured, killed in result[1]]
+
+    def _vehicle_factor_ranking(self, kind, weather, by, limit):
+        """
+        Ranks the vehicle types or contributing factors from the totals in VehicleFactorStats
+        :param kind: "vehicle" or "factor"
+        :return: A list of dicts of each one's "name", "crashes", "injured" and "killed"
+        """
+        if by not in ("crashes", "injured", "killed"):
+            raise ValueError("Unknown ranking: {}".format(by))
+        query = """
+        SELECT name, crashes, injured, killed
+        FROM VehicleFactorStats
+        WHERE kind = $1
+        AND weather = $2
+        ORDER BY {} DESC
+        LIMIT $3
+        """.format(by)
+        result = self.execute_prepared("vehicle_factor_ranking_{}".format(by), query, kind,
+                                       0 if weather is None else weather_mask([weather]), int(limit))
+        return [{"name": name, "crashes": crashes, "injured": injured, "killed": killed}
+                for name, crashes, injured, killed in result[1]]
+
+    def top_contributing_factors(self, weather=None, by="crashes", limit=10):
+        """
+        Finds the contributing factors listed for the most crashes, injuries or deaths
+        :param weather: Only count crashes on days with this weather type code, None for any weather
+        :param by: What to rank the factors by: "crashes", "injured" or "killed"
+        :param limit: How many factors to return
+        :return: A list of dicts of each factor's "name" (upper case) and its "crashes", "injured"
+        and "killed", in descending order of the ranked count
+        """
+        return self._vehicle_factor_ranking("factor", weather, by, limit)
+
+    def top_vehicle_types(self, weather=None, by="crashes", limit=10):
+        """
+        Finds the vehicle types involved in the most crashes, injuries or deaths
+        :param weather: Only count crashes on days with this weather type code, None for any weather
+        :param by: What to rank the vehicle types by: "crashes", "injured" or "killed"
+        :param limit: How many vehicle types to return
+        :return: A list of dicts of each vehicle type's "name" (upper case) and its "crashes",
+        "injured" and "killed", in descending order of the ranked count
+        """
+        return self._vehicle_factor_ranking("vehicle", weather, by, limit)
+
+    def crashes_by_weather(self):
+        """
+        Totals the crashes on the days each weather type occurred on
+        :return: [type code, crashes] pairs in descending order
+        """
+        # One pass over the crashes, which already have their day's weather attached
+        query = "SELECT {} FROM CrashFact".format(weather_type_totals("COUNT(*)"))
+        result = self.execute_prepared("crashes_by_weather", query)
+        return self.format_weather_type_result(result)
+
+    def check_group(self, group):
+        """
+        Makes sure a group passed in by a caller is one that can be safely formatted into a query
+        :param group: The group to check
+        :return: the group, lowercased
+        """
+        return check_group(group)
+
+    def deadliest_weather(self, group_selection="total"):
+        """
+        Totals the deaths of a group on the days each weather type occurred on
+        :param group_selection: The group whose deaths are counted
+        :return: [type code, deaths] pairs in descending order
+        """
+        group_selection = self.check_group(group_selection)
+        query = "SELECT {} FROM CrashFact".format(weather_type_totals("SUM(killed_{})".format(group_selection)))
+        result = self.execute_prepared("deadliest_weather_{}".format(group_selection), query)
+        return self.format_weather_type_result(result)
+
+    def most_injuries_weather(self, group_selection="total"):
+        """
+        Totals the injuries of a group on the days each weather type occurred on
+        :param group_selection: The group whose injuries are counted
+        :return: [type code, injuries] pairs in descending order
+        """
+        group_selection = self.check_group(group_selection)
+        query = "SELECT {} FROM CrashFact".format(weather_type_totals("SUM(injured_{})".format(group_selection)))
+        result = self.execute_prepared("most_injuries_weather_{}".format(group_selection), query)
+        return self.format_weather_type_result(result)
 
     def crashes_by_borough(self):
+        """
+        Counts the crashes in each borough ("" for crashes with no borough)
+        :return: [borough, crashes] pairs in descending order
+        """
         query = """
-        SELECT l0.borough, COUNT(c0.id)
-        FROM Crash c0, Location l0
-        WHERE c0.id=l0.id
-        GROUP BY l0.borough;
+        SELECT borough, SUM(crashes)
+        FROM CrashDaily
+        GROUP BY borough
+        ORDER BY SUM(crashes) DESC;
         """
-        results = self.execute_query(query, ())
+        results = self.execute_prepared("crashes_by_borough", query)
+        return [[result[0], int(result[1])] for result in results[1]]
 
-        for result in results[1]:
-            print("{}: {}".format(result[0] if result[0] != "" else "No Borough", result[1]))
+    def estimate_ranking(self, ranking, group="total", confidence=0.95):
+        """
+        Estimates one of the rankings from the date-stratified sample of the crashes in CrashSample,
+        which reads about a twentieth of what the exact ranking does
+        :param ranking: "crashes_by_weather", "deadliest_weather", "most_injuries_weather" or
+        "crashes_by_borough"
+        :param group: The group whose deaths or injuries are counted
+        :param confidence: How likely the exact values are to fall within the margins, e.g. 0.95
+        :return: [type code or borough, estimate, margin] triples in descending order of estimate,
+        the exact value lying within estimate +/- margin with the given confidence
+        """
+        if not 0 < confidence < 1:
+            raise ValueError("Confidence must be between 0 and 1")
+        if ranking == "crashes_by_borough":
+            query = """
+            WITH strata AS (
+                SELECT "date", MAX(stratum_size)::float8 AS big_n, COUNT(*)::float8 AS small_n
+                FROM CrashSample
+                GROUP BY "date"
+            ), hits AS (
+                SELECT "date", borough, COUNT(*)::float8 AS hits
+                FROM CrashSample
+                GROUP BY "date", borough
+            )
+            SELECT h0.borough, SUM(s0.big_n * h0.hits / s0.small_n),
+                SUM(s0.big_n * (s0.big_n - s0.small_n) *
+                    COALESCE((h0.hits - h0.hits * h0.hits / s0.small_n) / NULLIF(s0.small_n - 1, 0), 0) / s0.small_n)
+            FROM hits h0
+            JOIN strata s0 ON s0."date" = h0."date"
+            GROUP BY h0.borough
+            """
+            estimates = self.execute_prepared("estimate_crashes_by_borough", query)[1]
+        else:
+            values = {"crashes_by_weather": "1", "deadliest_weather": "killed_{}",
+                      "most_injuries_weather": "injured_{}"}
+            if ranking not in values:
+                raise ValueError("Unknown ranking: {}".format(ranking))
+            group = self.check_group(group)
+            query = stratified_estimates(values[ranking].format(group),
+                                         {code: "mask & {} <> 0".format(bit) for code, bit in weather_type_bits.items()})
+            name = "estimate_{}".format(ranking if ranking == "crashes_by_weather" else ranking + "_" + group)
+            row = self.execute_prepared(name, query)[1][0]
+            estimates = [(code, row[2*i], row[2*i + 1]) for i, code in enumerate(weather_type_bits)]
+
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        ranked = [[key, int(round(estimate or 0)), round(z * math.sqrt(max(variance or 0, 0)), 1)]
+                  for key, estimate, variance in estimates]
+        ranked.sort(key=lambda t: t[1], reverse=True)
+        return ranked
+
+    def refine_ranking(self, ranking, group="total"):
+        """
+        Starts working out the exact answer of a ranking in the background, e.g. to replace an
+        estimate from estimate_ranking() once it's ready
+        :param ranking: "crashes_by_weather", "deadliest_weather", "most_injuries_weather" or
+        "crashes_by_borough"
+        :param group: The group whose deaths or injuries are counted
+        :return: A concurrent.futures.Future of the ranking's [type code or borough, value] pairs
+        """
+        if ranking in ("crashes_by_weather", "crashes_by_borough"):
+            args = ()
+        elif ranking in ("deadliest_weather", "most_injuries_weather"):
+            args = (self.check_group(group),)
+        else:
+            raise ValueError("Unknown ranking: {}".format(ranking))
+        with self._refiner_lock:
+            if self._refiner is None:
+                self._refiner = ThreadPoolExecutor(max_workers=2, thread_name_prefix="refine")
+        return self._refiner.submit(getattr(self, ranking), *args)
@@ -0,0 +1,435 @@
+import csv
+import re
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import export
+import grid
+import streets
+import telemetry
+from database import Database, weather_type_bits
+
+# The station crashes are attributed to when they have no location, or when there's no station list
+default_station = ("USW00094728", "NY CITY CENTRAL PARK, NY US", 40.77898, -73.96925)
+
+# Conversions the loaders apply to every value, as DuckDB macros: text is trimmed with runs of
+# spaces collapsed, and numbers that can't be parsed (or aren't finite) become NULL
+conversion_macros = """
+CREATE OR REPLACE TEMP MACRO clean(x) AS regexp_replace(trim(COALESCE(x, '')), '  +', ' ', 'g');
+CREATE OR REPLACE TEMP MACRO num(x) AS
+    CASE WHEN isfinite(TRY_CAST(x AS DOUBLE)) THEN TRY_CAST(x AS DOUBLE) END;
+CREATE OR REPLACE TEMP MACRO coordinate(x) AS nullif(num(x), 0);
+CREATE OR REPLACE TEMP MACRO wtype(x) AS CAST(clean(x) <> '' AS SMALLINT);
+CREATE OR REPLACE TEMP MACRO grid_cell(latitude, longitude) AS
+    CASE WHEN floor((latitude - {0})/{2}) BETWEEN 0 AND {4} - 1
+        AND floor((longitude - {1})/{3}) BETWEEN 0 AND {5} - 1
+    THEN CAST(floor((latitude - {0})/{2})*{5} + floor((longitude - {1})/{3}) AS INTEGER) END;
+""".format(grid.ORIGIN[0], grid.ORIGIN[1], grid.CELL_DEGREES[0], grid.CELL_DEGREES[1], grid.ROWS, grid.COLUMNS)
+
+weather_tables = """
+CREATE OR REPLACE TEMP TABLE raw_weather AS
+SELECT clean(station) AS station, TRY_CAST(clean("date") AS DATE) AS "date", * EXCLUDE (station, "date")
+FROM {source};
+DELETE FROM raw_weather WHERE "date" IS NULL;
+
+CREATE OR REPLACE TABLE Weather AS SELECT station, "date" FROM raw_weather;
+CREATE OR REPLACE TABLE Wind AS SELECT station, "date", CAST(num(avgwind) AS REAL) AS avgwind FROM raw_weather;
+CREATE OR REPLACE TABLE Precipitation AS
+SELECT station, "date", CAST(num(precip) AS REAL) AS precip, CAST(num(snow) AS REAL) AS snow,
+    CAST(num(snowdepth) AS REAL) AS snowdepth
+FROM raw_weather;
+CREATE OR REPLACE TABLE Temperature AS
+SELECT station, "date", TRY_CAST(clean(maxtemp) AS SMALLINT) AS maxtemp,
+    TRY_CAST(clean(mintemp) AS SMALLINT) AS mintemp
+FROM raw_weather;
+CREATE OR REPLACE TABLE Wtypes AS
+SELECT station, "date", {types}, CAST({mask} AS INTEGER) AS mask
+FROM raw_weather;
+DROP TABLE raw_weather;
+"""
+
+collision_tables = """
+CREATE OR REPLACE TEMP TABLE raw_collisions AS
+SELECT TRY_CAST(clean(id) AS INTEGER) AS id,
+    COALESCE(TRY_CAST(try_strptime(clean("date"), '%m/%d/%Y') AS DATE), TRY_CAST(clean("date") AS DATE))
+        AS "date",
+    TRY_CAST(lpad(clean("time"), 5, '0') AS TIME) AS "time",
+    coordinate(latitude) AS latitude, coordinate(longitude) AS longitude,
+    * EXCLUDE (id, "date", "time", latitude, longitude)
+FROM {source};
+-- Like the loaders, skip rows without a usable ID
+DELETE FROM raw_collisions WHERE id IS NULL;
+ALTER TABLE raw_collisions ADD COLUMN cell INTEGER;
+UPDATE raw_collisions SET cell = grid_cell(latitude, longitude);
+"""
+
+collision_inserts = """
+CREATE OR REPLACE TABLE Crash AS
+SELECT r0.id, r0."date", r0."time", COALESCE(s0.station, '{default}') AS station
+FROM raw_collisions r0
+LEFT JOIN CellStation s0 ON s0.cell = r0.cell;
+
+CREATE OR REPLACE TABLE Location AS
+SELECT r0.id, r0."date", r0.latitude, r0.longitude, a0.id AS on_street, b0.id AS cross_street,
+    c0.id AS off_street, r0.cell, clean(r0.borough) AS borough, clean(r0.zip) AS zip,
+    clean(r0.on_st) AS on_st, clean(r0.cross_st) AS cross_st, clean(r0.off_st) AS off_st
+FROM raw_collisions r0
+LEFT JOIN StreetName a0 ON a0.raw = clean(r0.on_st)
+LEFT JOIN StreetName b0 ON b0.raw = clean(r0.cross_st)
+LEFT JOIN StreetName c0 ON c0.raw = clean(r0.off_st);
+
+CREATE OR REPLACE TABLE Injuries AS
+SELECT id, "date", TRY_CAST(clean(injured_total) AS SMALLINT) AS total,
+    TRY_CAST(clean(injured_pedestrians) AS SMALLINT) AS pedestrians,
+    TRY_CAST(clean(injured_cyclists) AS SMALLINT) AS cyclists,
+    TRY_CAST(clean(injured_motorists) AS SMALLINT) AS motorists
+FROM raw_collisions;
+
+CREATE OR REPLACE TABLE Deaths AS
+SELECT id, "date", TRY_CAST(clean(killed_total) AS SMALLINT) AS total,
+    TRY_CAST(clean(killed_pedestrians) AS SMALLINT) AS pedestrians,
+    TRY_CAST(clean(killed_cyclists) AS SMALLINT) AS cyclists,
+    TRY_CAST(clean(killed_motorists) AS SMALLINT) AS motorists
+FROM raw_collisions;
+
+CREATE OR REPLACE TABLE VehiclesFactors AS
+SELECT id, "date", clean(type_vehicle1) AS type_vehicle1, clean(type_vehicle2) AS type_vehicle2,
+    clean(type_vehicle3) AS type_vehicle3, clean(type_vehicle4) AS type_vehicle4,
+    clean(type_vehicle5) AS type_vehicle5, clean(contrib_factor1) AS contrib_factor1,
+    clean(contrib_factor2) AS contrib_factor2, clean(contrib_factor3) AS contrib_factor3,
+    clean(contrib_factor4) AS contrib_factor4, clean(contrib_factor5) AS contrib_factor5
+FROM raw_collisions;
+
+DROP TABLE raw_collisions;
+"""
+
+
+def import_duckdb():
+    """
+    Imports DuckDB, which is only needed for the embedded backend
+    :return: the duckdb module
+    """
+    try:
+        import duckdb
+    except ImportError:
+        raise RuntimeError("The embedded backend requires DuckDB (pip install duckdb)")
+    return duckdb
+
+
+def sql_string(value):
+    """
+    Quotes a value as an SQL string literal
+    """
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def sql_list(values):
+    """
+    Formats values as a DuckDB list literal of strings
+    """
+    return "[{}]".format(", ".join(sql_string(value) for value in values))
+
+
+def csv_source(path, spec):
+    """
+    Matches a CSV's header against the spec the loaders read that file with, so that every field is
+    read from the column the loaders would read it from, wherever the file has it
+    :param path: The CSV file
+    :param spec: The loaders' DatasetSpec for the file
+    :return: An SQL table expression with a text column named after each field of the spec. Optional
+    fields the file lacks are NULL, which the conversion macros turn into the loaders' defaults
+    :raises ValueError: If the file has no column for a required field
+    """
+    with open(path, newline="") as file:
+        header = next(csv.reader(file), [])
+    resolved = spec.resolve(header)
+    names = ["_{}".format(i) for i in range(resolved.width)]
+    for name, position in resolved.positions.items():
+        if position is not None:
+            names[position] = name
+    absent = "".join(', CAST(NULL AS VARCHAR) AS "{}"'.format(name) for name in resolved.absent())
+    return "(SELECT *{} FROM read_csv({}, header = true, all_varchar = true, ignore_errors = true, " \
+           "names = {}))".format(absent, sql_string(path), sql_list(names))
+
+
+def duckdb_args(args):
+    """
+    Rewrites YYYY/MM/DD dates, which Postgres reads but DuckDB doesn't, as YYYY-MM-DD
+    """
+    return [arg.replace("/", "-") if isinstance(arg, str) and re.fullmatch(r"\d{4}/\d\d?/\d\d?", arg)
+            else arg for arg in args]
+
+
+def real_value(value):
+    """
+    A REAL as psycopg2 gives it: Postgres sends the shortest decimal that reads back as the same
+    4-byte float, where DuckDB hands over the float itself, e.g. 0.15000000596046448 for 0.15
+    """
+    if value is None:
+        return None
+    # Every decimal of up to 6 digits survives the trip through a 4-byte float, and 9 always suffice
+    for digits in range(6, 10):
+        rounded = float("{:.{}g}".format(value, digits))
+        if struct.unpack("f", struct.pack("f", rounded))[0] == value:
+            return rounded
+    return value
+
+
+def round_reals(description, rows):
+    """
+    Rounds the values of a result's REAL columns as psycopg2 would have
+    :param description: The columns of the result
+    :param rows: The rows of the result
+    :return: The rows, with real_value() applied to every REAL
+    """
+    reals = [i for i, column in enumerate(description) if str(column[1]) == "FLOAT"]
+    if not reals:
+        return rows
+    rounded = []
+    for row in rows:
+        row = list(row)
+        for i in reals:
+            row[i] = real_value(row[i])
+        rounded.append(tuple(row))
+    return rounded
+
+
+def load_embedded(database_path, data_dir, specs, post_load_path=None, threads=None, memory_limit_mb=None):
+    """
+    Builds a DuckDB database file holding the same tables as the Postgres database, straight from
+    the CSVs. DuckDB reads each CSV with all of its threads at once and converts whole columns at a
+    time, so there is no per-row work in Python.
+    :param database_path: The database file to create; an existing one is replaced
+    :param data_dir: The directory holding weather.csv, Motor_Vehicle_Collisions_-_Crashes.csv and
+    optionally stations.csv
+    :param specs: The loaders' station, weather and collision DatasetSpecs, which find each column
+    by its header
+    :param post_load_path: The summary table script, defaults to embedded_post_load.sql next to this file
+    :param threads: How many threads DuckDB may use, defaults to one per core
+    :param memory_limit_mb: Most memory DuckDB may use while loading, in megabytes; beyond it, DuckDB
+    spills to temporary files. Defaults to DuckDB's own limit
+    :return: How many seconds each step took, by step
+    :raises ValueError: If a CSV has no column for a required field
+    """
+    duckdb = import_duckdb()
+    station_spec, weather_spec, collision_spec = specs
+    data_dir = Path(data_dir)
+    post_load_path = Path(post_load_path or Path(__file__).with_name("embedded_post_load.sql"))
+    database_path = Path(database_path)
+    if database_path.exists():
+        database_path.unlink()
+
+    timings = {}
+    connection = duckdb.connect(str(database_path))
+    try:
+        if threads is not None:
+            connection.execute("SET threads = {}".format(int(threads)))
+        if memory_limit_mb is not None:
+            connection.execute("SET memory_limit = '{}MB'".format(int(memory_limit_mb)))
+        connection.execute(conversion_macros)
+
+        started = time.perf_counter()
+        station_path = data_dir.joinpath("stations.csv")
+        if station_path.exists():
+            connection.execute("""
+            CREATE TABLE Station AS
+            SELECT DISTINCT ON (clean(station)) clean(station) AS station, clean(name) AS name,
+                coordinate(latitude) AS latitude, coordinate(longitude) AS longitude
+            FROM {}
+            """.format(csv_source(station_path, station_spec)))
+        else:
+            connection.execute("CREATE TABLE Station AS SELECT ? AS station, ? AS name, ? AS latitude, "
+                               "? AS longitude", default_station)
+        timings["stations"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        types = ", ".join("wtype({0}) AS {0}".format(code) for code in weather_type_bits)
+        mask = " | ".join("(wtype({}) << {})".format(code, bit) for bit, code in enumerate(weather_type_bits))
+        weather_source = csv_source(data_dir.joinpath("weather.csv"), weather_spec)
+        connection.execute(weather_tables.format(source=weather_source, types=types, mask=mask))
+        timings["weather"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        connection.execute(collision_tables.format(source=csv_source(
+            data_dir.joinpath("Motor_Vehicle_Collisions_-_Crashes.csv"), collision_spec)))
+        timings["read_collisions"] = time.perf_counter() - started
+
+        # The nearest station to each cell the crashes are in, measured the same way as
+        # grid.nearest_lookup(), and the normalized spelling of each distinct street name
+        started = time.perf_counter()
+        connection.execute("""
+        CREATE TABLE CellStation AS
+        SELECT c0.cell, arg_min(s0.station, (s0.latitude - c0.latitude)**2
+            + cos(radians(c0.latitude))**2 * (s0.longitude - c0.longitude)**2) AS station
+        FROM (
+            SELECT DISTINCT cell, {0} + (cell // {3} + 0.5)*{1} AS latitude,
+                {2} + (cell % {3} + 0.5)*{4} AS longitude
+            FROM raw_collisions
+            WHERE cell IS NOT NULL
+        ) c0, Station s0
+        WHERE s0.latitude IS NOT NULL AND s0.longitude IS NOT NULL
+        AND s0.station IN (SELECT station FROM Weather)
+        GROUP BY c0.cell
+        """.format(grid.ORIGIN[0], grid.CELL_DEGREES[0], grid.ORIGIN[1], grid.COLUMNS, grid.CELL_DEGREES[1]))
+
+        connection.create_function("normalize_street", streets.normalize_street, ["VARCHAR"], "VARCHAR")
+        connection.create_function("street_key", streets.street_key, ["VARCHAR"], "BIGINT")
+        connection.execute("""
+        CREATE TABLE StreetName AS
+        SELECT raw, normalize_street(raw) AS name
+        FROM (
+            SELECT clean(on_st) AS raw FROM raw_collisions
+            UNION SELECT clean(cross_st) FROM raw_collisions
+            UNION SELECT clean(off_st) FROM raw_collisions
+        )
+        WHERE raw <> '';
+        DELETE FROM StreetName WHERE name IS NULL;
+        ALTER TABLE StreetName ADD COLUMN id BIGINT;
+        UPDATE StreetName SET id = street_key(name);
+        CREATE TABLE Street AS SELECT DISTINCT id, name FROM StreetName;
+        """)
+        timings["lookups"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        connection.execute(collision_inserts.format(default=default_station[0]))
+        connection.execute("DROP TABLE CellStation; DROP TABLE StreetName")
+        timings["collisions"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        connection.execute(post_load_path.read_text())
+        timings["summaries"] = time.perf_counter() - started
+    finally:
+        connection.close()
+    return timings
+
+
+class EmbeddedDatabase(Database):
+    """
+    Runs the same queries as Database on a DuckDB file built by load_embedded(), in-process and
+    without a server. Queries written for Postgres run unchanged: DuckDB takes $1, $2, ... itself,
+    and %s placeholders are swapped for ?.
+    """
+
+    def __init__(self, database_path="motorweather.duckdb", threads=None, slow_query_ms=None,
+                 slow_query_log=None, explain_slow=False):
+        """
+        Constructor for the embedded database
+        :param database_path: The DuckDB file built by load_embedded()
+        :param threads: How many threads each query may use, defaults to one per core
+        :param slow_query_ms: Queries taking at least this long are written to the slow-query log
+        :param slow_query_log: The file slow queries are appended to, as JSON Lines
+        :param explain_slow: Whether to EXPLAIN each slow query and log its plan too
+        """
+        duckdb = import_duckdb()
+        self._duckdb = duckdb.connect(str(database_path), read_only=True)
+        if threads is not None:
+            self._duckdb.execute("SET threads = {}".format(int(threads)))
+        self._local = threading.local()
+        self._prepared = {}
+        self._prepared_lock = threading.Lock()
+        self.telemetry = telemetry.QueryTelemetry(slow_query_ms, slow_query_log, explain_slow)
+        self._refiner = None
+        self._refiner_lock = threading.Lock()
+
+    def close(self):
+        """
+        Closes the database file
+        :return: None
+        """
+        if self._refiner is not None:
+            self._refiner.shutdown()
+        self._duckdb.close()
+
+    @contextmanager
+    def connection(self):
+        """
+        The calling thread's own cursor on the database file, which DuckDB needs for queries to run
+        from several threads at once
+        :return: A DuckDB connection
+        """
+        cursor = getattr(self._local, "cursor", None)
+        if cursor is None:
+            cursor = self._local.cursor = self._duckdb.cursor()
+        yield cursor
+
+    def _run(self, name, query, args, prepared=False):
+        """
+        Runs a query, recording it just like Database does
+        :return: The results of the query
+        """
+        if not prepared:
+            query = query.replace("%s", "?").replace("%%", "%")
+        args = duckdb_args(args)
+        requested = time.perf_counter()
+        rows = []
+        failed = True
+        with self.connection() as connection:
+            started = time.perf_counter()
+            try:
+                connection.execute(query, args)
+                description, rows = connection.description, connection.fetchall()
+                failed = False
+            finally:
+                latency_ms = (time.perf_counter() - started) * 1000
+                self.telemetry.record(name, latency_ms, (started - requested) * 1000, len(rows),
+                                      telemetry.result_size(rows), failed)
+            if self.telemetry.is_slow(latency_ms):
+                plan = self._explain(connection, query, args) if self.telemetry.explain_slow else None
+                self.telemetry.log_slow(name, query, args, latency_ms, len(rows), plan)
+        return description, round_reals(description, rows)
+
+    def _explain(self, connection, statement, args):
+        """
+        The plan DuckDB chose for a statement, as text
+        """
+        try:
+            return "\n".join(row[1] for row in connection.execute("EXPLAIN " + statement, args).fetchall())
+        except Exception as error:
+            return "EXPLAIN failed: {}".format(error)
+
+    def export_query(self, query, path, file_format="csv", fetch_size=10000, args=(), use_copy=False):
+        """
+        Streams the results of a query into a file, fetch_size rows at a time
+        :param query: The query whose results are exported, any user inputted data should come in the form of %s
+        :param path: The file to write
+        :param file_format: One of "csv", "jsonl" or "parquet"
+        :param fetch_size: How many rows are held in memory at once
+        :param args: The user inputted data to use in place of %s
+        :param use_copy: Ignored; DuckDB rows are always streamed
+        :return: The number of rows exported
+        """
+        if file_format not in export.writers:
+            raise ValueError("Unknown export format: {}".format(file_format))
+        writer_class, binary = export.writers[file_format]
+        args = duckdb_args(args)
+
+        with self.connection() as connection:
+            with open(path, "wb" if binary else "w", newline=None if binary else "") as output:
+                connection.execute(query.replace("%s", "?").replace("%%", "%"), args)
+                writer = writer_class(output, connection.description)
+                row_count = 0
+                rows = connection.fetchmany(fetch_size)
+                while rows:
+                    writer.write_rows(round_reals(connection.description, rows))
+                    row_count += len(rows)
+                    rows = connection.fetchmany(fetch_size)
+                writer.close()
+                return row_count
+
+
+def open_database(embedded_path=None, max_connections=None, **options):
+    """
+    The database the applications query: the Postgres one, or the embedded one if given its file
+    :param embedded_path: The DuckDB file built by load_embedded(), or None for Postgres
+    :param max_connections: How many Postgres connections to pool, or the embedded threads per query
+    :param options: The telemetry options, from telemetry.database_options()
+    :return: A Database or an EmbeddedDatabase
+    """
+    if embedded_path is not None:
+        return EmbeddedDatabase(embedded_path, threads=max_connections, **options)
+    if max_connections is None:
+        return Database(**options)
+    return Database(max_connections=max_connections, **options)
@@ -0,0 +1,127 @@
+-- The summary tables of post_load.sql for the embedded (DuckDB) backend, built by load_embedded()
+-- once the CSVs have been read. Every table has the same columns as in schema.sql, so Database's
+-- queries run on them unchanged. DuckDB keeps min/max statistics for every block of every column,
+-- which serve the date range filters that the Postgres indexes do, so no indexes are built.
+
+-- Crash Cube
+
+CREATE OR REPLACE TABLE CrashCube AS
+SELECT c0."date", CAST(extract(hour FROM c0."time") AS SMALLINT) AS hour,
+    COALESCE(l0.borough, '') AS borough, c0.station, CAST(COUNT(*) AS INTEGER) AS crashes,
+    CAST(SUM(i0.total) AS INTEGER) AS injured_total,
+    CAST(SUM(i0.pedestrians) AS INTEGER) AS injured_pedestrians,
+    CAST(SUM(i0.cyclists) AS INTEGER) AS injured_cyclists,
+    CAST(SUM(i0.motorists) AS INTEGER) AS injured_motorists,
+    CAST(SUM(d0.total) AS INTEGER) AS killed_total,
+    CAST(SUM(d0.pedestrians) AS INTEGER) AS killed_pedestrians,
+    CAST(SUM(d0.cyclists) AS INTEGER) AS killed_cyclists,
+    CAST(SUM(d0.motorists) AS INTEGER) AS killed_motorists
+FROM Crash c0
+JOIN Location l0 ON l0.id = c0.id AND l0."date" = c0."date"
+JOIN Injuries i0 ON i0.id = c0.id AND i0."date" = c0."date"
+JOIN Deaths d0 ON d0.id = c0.id AND d0."date" = c0."date"
+WHERE c0."date" IS NOT NULL
+GROUP BY c0."date", extract(hour FROM c0."time"), COALESCE(l0.borough, ''), c0.station
+ORDER BY c0."date";
+
+CREATE OR REPLACE TABLE CrashDaily AS
+SELECT "date", borough, station, CAST(SUM(crashes) AS INTEGER) AS crashes,
+    CAST(SUM(injured_total) AS INTEGER) AS injured_total,
+    CAST(SUM(injured_pedestrians) AS INTEGER) AS injured_pedestrians,
+    CAST(SUM(injured_cyclists) AS INTEGER) AS injured_cyclists,
+    CAST(SUM(injured_motorists) AS INTEGER) AS injured_motorists,
+    CAST(SUM(killed_total) AS INTEGER) AS killed_total,
+    CAST(SUM(killed_pedestrians) AS INTEGER) AS killed_pedestrians,
+    CAST(SUM(killed_cyclists) AS INTEGER) AS killed_cyclists,
+    CAST(SUM(killed_motorists) AS INTEGER) AS killed_motorists
+FROM CrashCube
+GROUP BY "date", borough, station
+ORDER BY "date";
+
+-- Crash Facts
+
+CREATE OR REPLACE TABLE CrashFact AS
+SELECT c0."time", l0.latitude, l0.longitude, c0.id, c0."date", l0.cell, w0.mask, p0.precip, p0.snow,
+    p0.snowdepth, n0.avgwind, t0.maxtemp, t0.mintemp,
+    i0.total AS injured_total, i0.pedestrians AS injured_pedestrians,
+    i0.cyclists AS injured_cyclists, i0.motorists AS injured_motorists,
+    d0.total AS killed_total, d0.pedestrians AS killed_pedestrians,
+    d0.cyclists AS killed_cyclists, d0.motorists AS killed_motorists,
+    COALESCE(l0.borough, '') AS borough, c0.station
+FROM Crash c0
+JOIN Location l0 ON l0.id = c0.id AND l0."date" = c0."date"
+JOIN Injuries i0 ON i0.id = c0.id AND i0."date" = c0."date"
+JOIN Deaths d0 ON d0.id = c0.id AND d0."date" = c0."date"
+LEFT JOIN Temperature t0 ON t0.station = c0.station AND t0."date" = c0."date"
+LEFT JOIN Precipitation p0 ON p0.station = c0.station AND p0."date" = c0."date"
+LEFT JOIN Wind n0 ON n0.station = c0.station AND n0."date" = c0."date"
+LEFT JOIN Wtypes w0 ON w0.station = c0.station AND w0."date" = c0."date"
+ORDER BY c0."date";
+
+CREATE OR REPLACE TABLE CrashSample AS
+SELECT "date", stratum_size, mask, injured_total, injured_pedestrians, injured_cyclists,
+    injured_motorists, killed_total, killed_pedestrians, killed_cyclists, killed_motorists, borough
+FROM (
+    SELECT f0.*, CAST(COUNT(*) OVER (PARTITION BY f0."date") AS INTEGER) AS stratum_size,
+        row_number() OVER (PARTITION BY f0."date" ORDER BY random()) AS drawn
+    FROM CrashFact f0
+    WHERE f0."date" IS NOT NULL
+) s0
+WHERE drawn <= ceil(stratum_size * 0.05)
+ORDER BY "date";
+
+-- Every weather type's bit of Wtypes.mask, plus 0 for any weather
+CREATE OR REPLACE TEMP TABLE WeatherBits AS
+SELECT 0 AS weather
+UNION ALL
+SELECT CAST(1 << b0.bit AS INTEGER) FROM range(13) b0(bit);
+
+CREATE OR REPLACE TABLE VehicleFactorStats AS
+SELECT v0.kind, w0.weather, v0.name, CAST(COUNT(*) AS INTEGER) AS crashes,
+    CAST(SUM(f0.injured_total) AS INTEGER) AS injured, CAST(SUM(f0.killed_total) AS INTEGER) AS killed
+FROM (
+    SELECT DISTINCT id, "date", CASE WHEN "column" LIKE 'type_vehicle%' THEN 'vehicle' ELSE 'factor' END AS kind,
+        upper(name) AS name
+    FROM (UNPIVOT VehiclesFactors ON COLUMNS('type_vehicle|contrib_factor') INTO NAME "column" VALUE name)
+    WHERE name <> ''
+) v0
+JOIN CrashFact f0 ON f0.id = v0.id AND f0."date" = v0."date"
+JOIN WeatherBits w0 ON w0.weather = 0 OR f0.mask & w0.weather <> 0
+GROUP BY v0.kind, w0.weather, v0.name;
+
+-- Crash Locations
+
+CREATE OR REPLACE TABLE CellDaily AS
+SELECT c0."date", l0.cell, c0.station, CAST(COUNT(*) AS INTEGER) AS crashes,
+    CAST(SUM(i0.total) AS INTEGER) AS injured, CAST(SUM(d0.total) AS INTEGER) AS killed
+FROM Crash c0
+JOIN Location l0 ON l0.id = c0.id AND l0."date" = c0."date"
+JOIN Injuries i0 ON i0.id = c0.id AND i0."date" = c0."date"
+JOIN Deaths d0 ON d0.id = c0.id AND d0."date" = c0."date"
+WHERE c0."date" IS NOT NULL AND l0.cell IS NOT NULL
+GROUP BY c0."date", l0.cell, c0.station
+ORDER BY c0."date";
+
+-- Intersections
+
+CREATE OR REPLACE TABLE IntersectionStats AS
+SELECT street_a, street_b, weather, CAST(COUNT(*) AS INTEGER) AS crashes,
+    CAST(SUM(injured_total) AS INTEGER) AS injured, CAST(SUM(killed_total) AS INTEGER) AS killed,
+    COALESCE(borough, '*') AS borough
+FROM (
+    SELECT least(l0.on_street, l0.cross_street) AS street_a,
+        greatest(l0.on_street, l0.cross_street) AS street_b, w0.weather, f0.injured_total,
+        f0.killed_total, f0.borough
+    FROM Location l0
+    JOIN CrashFact f0 ON f0.id = l0.id AND f0."date" = l0."date"
+    JOIN WeatherBits w0 ON w0.weather = 0 OR f0.mask & w0.weather <> 0
+    WHERE l0.on_street <> l0.cross_street
+) i0
+GROUP BY GROUPING SETS ((street_a, street_b, weather, borough), (street_a, street_b, weather));
+
+-- Data Generation
+
+CREATE OR REPLACE TABLE DataGeneration AS
+SELECT CAST(epoch_ms(now()) AS BIGINT) AS generation, CAST(now() AS TIMESTAMP) AS loaded_at;
+
+ANALYZE;
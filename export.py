@@ -0,0 +1,117 @@
+import csv
+import json
+from datetime import date, time
+from decimal import Decimal
+
+# Types of the columns that get a non-string type in Parquet files, as the Postgres type OIDs
+# psycopg2 describes columns with and the type names DuckDB does
+_integer_types = {20, 21, 23, "TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT"}
+_float_types = {700, 701, 1700, "FLOAT", "DOUBLE", "DECIMAL"}
+_date_types = {1082, "DATE"}
+
+
+def _type_key(type_code):
+    """
+    The key of a column's type in the sets above; DuckDB's types are objects, and DECIMALs carry
+    their precision and scale, e.g. DECIMAL(18,3)
+    """
+    return type_code if isinstance(type_code, int) else str(type_code).split("(")[0]
+
+
+class CsvWriter:
+    """
+    Writes rows as CSV with a header row
+    """
+
+    def __init__(self, output, description):
+        self._writer = csv.writer(output)
+        self._writer.writerow([column[0] for column in description])
+
+    def write_rows(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        pass
+
+
+class JsonLinesWriter:
+    """
+    Writes each row as a JSON object on its own line
+    """
+
+    def __init__(self, output, description):
+        self._output = output
+        self._names = [column[0] for column in description]
+
+    def write_rows(self, rows):
+        for row in rows:
+            self._output.write(json.dumps(dict(zip(self._names, row)), default=json_value))
+            self._output.write("\n")
+
+    def close(self):
+        pass
+
+
+class ParquetWriter:
+    """
+    Writes rows to a Parquet file, one row group per batch. Needs pyarrow, which is only imported
+    when a Parquet export is asked for.
+    """
+
+    def __init__(self, output, description):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Exporting to Parquet requires pyarrow (pip install pyarrow)")
+        self._pyarrow = pyarrow
+
+        # The schema comes from the column types rather than the first batch, which might be all NULL
+        fields = []
+        for column in description:
+            type_key = _type_key(column[1])
+            if type_key in _integer_types:
+                arrow_type = pyarrow.int64()
+            elif type_key in _float_types:
+                arrow_type = pyarrow.float64()
+            elif type_key in _date_types:
+                arrow_type = pyarrow.date32()
+            else:
+                arrow_type = pyarrow.string()
+            fields.append(pyarrow.field(column[0], arrow_type))
+        self._schema = pyarrow.schema(fields)
+        self._writer = pyarrow.parquet.ParquetWriter(output, self._schema)
+
+    def write_rows(self, rows):
+        columns = list(zip(*rows))
+        arrays = []
+        for field, column in zip(self._schema, columns):
+            if field.type == self._pyarrow.float64():
+                column = [float(value) if value is not None else None for value in column]
+            elif field.type == self._pyarrow.string():
+                column = [str(value) if value is not None else None for value in column]
+            arrays.append(self._pyarrow.array(column, type=field.type))
+        self._writer.write_table(self._pyarrow.Table.from_arrays(arrays, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+# The writer for each export format, and whether it writes bytes rather than text
+writers = {
+    "csv": (CsvWriter, False),
+    "jsonl": (JsonLinesWriter, False),
+    "parquet": (ParquetWriter, True),
+}
+
+
+def json_value(value):
+    """
+    Converts the values json can't handle on its own: NUMERICs to floats, dates and times to ISO 8601
+    and anything else (e.g. intervals) to its text
+    """
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return str(value)
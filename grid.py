@@ -0,0 +1,67 @@
+# grid.py
+#
+# A fixed grid of roughly 250m square cells laid over NYC. Each crash is given the number of the
+# cell it falls in when it's loaded, so spatial queries can narrow themselves down to a handful of
+# cells before looking at any coordinates.
+
+from typing import List, Optional, Tuple
+from math import cos, radians, floor
+
+# South-west corner of the grid, and the size of each cell in degrees (latitude, longitude)
+ORIGIN = (40.45, -74.30)
+CELL_DEGREES = (0.00225, 0.003)
+ROWS = COLUMNS = 256
+
+METERS_PER_DEGREE_LATITUDE = 111320.
+
+# Cell number of the given coordinates, or None if they're missing or outside the city. The
+# collision data uses 0 for unknown coordinates, which falls outside the grid.
+def grid_cell(latitude: Optional[float], longitude: Optional[float]) -> Optional[int]:
+    if latitude is None or longitude is None:
+        return None
+    row = floor((latitude - ORIGIN[0])/CELL_DEGREES[0])
+    column = floor((longitude - ORIGIN[1])/CELL_DEGREES[1])
+    if not (0 <= row < ROWS and 0 <= column < COLUMNS):
+        return None
+    return row*COLUMNS + column
+
+# Coordinates of the middle of a cell
+def cell_center(cell: int) -> Tuple[float, float]:
+    row, column = divmod(cell, COLUMNS)
+    return (ORIGIN[0] + (row + 0.5)*CELL_DEGREES[0], ORIGIN[1] + (column + 0.5)*CELL_DEGREES[1])
+
+# Every cell that overlaps the given box
+def cells_in_box(south: float, west: float, north: float, east: float) -> List[int]:
+    first_row = max(0, floor((south - ORIGIN[0])/CELL_DEGREES[0]))
+    last_row = min(ROWS - 1, floor((north - ORIGIN[0])/CELL_DEGREES[0]))
+    first_column = max(0, floor((west - ORIGIN[1])/CELL_DEGREES[1]))
+    last_column = min(COLUMNS - 1, floor((east - ORIGIN[1])/CELL_DEGREES[1]))
+    return [row*COLUMNS + column for row in range(first_row, last_row + 1)
+        for column in range(first_column, last_column + 1)]
+
+# The box (south, west, north, east) around a circle of the given radius in meters
+def box_around(latitude: float, longitude: float, radius: float) -> Tuple[float, float, float,
+        float]:
+    lat_delta = radius/METERS_PER_DEGREE_LATITUDE
+    lon_delta = radius/(METERS_PER_DEGREE_LATITUDE*cos(radians(latitude)))
+    return (latitude - lat_delta, longitude - lon_delta, latitude + lat_delta,
+        longitude + lon_delta)
+
+# The box (south, west, north, east) covered by a cell
+def cell_bounds(cell: int) -> Tuple[float, float, float, float]:
+    row, column = divmod(cell, COLUMNS)
+    south, west = ORIGIN[0] + row*CELL_DEGREES[0], ORIGIN[1] + column*CELL_DEGREES[1]
+    return (south, west, south + CELL_DEGREES[0], west + CELL_DEGREES[1])
+
+# For every cell, the name of the point nearest to its middle. Points are (name, latitude,
+# longitude); at city scale a flat approximation of distance is plenty.
+def nearest_lookup(points: List[Tuple[str, float, float]]) -> List[str]:
+    lookup = []
+    for row in range(ROWS):
+        latitude = ORIGIN[0] + (row + 0.5)*CELL_DEGREES[0]
+        scale = cos(radians(latitude))**2
+        for column in range(COLUMNS):
+            longitude = ORIGIN[1] + (column + 0.5)*CELL_DEGREES[1]
+            lookup.append(min(points, key = lambda p: (p[1] - latitude)**2
+                + scale*(p[2] - longitude)**2)[0])
+    return lookup
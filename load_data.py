@@ -3,8 +3,9 @@
 
 DEBUG = False
 
-from typing import Sequence, Callable, Union, List, Tuple
+from typing import Sequence, Union, List, Tuple
 from pathlib import Path
+from argparse import ArgumentParser
 import sys
 import os
 from time import perf_counter
@@ -12,37 +13,30 @@ import psycopg2
 from mmap import mmap, ACCESS_READ
 from collections.abc import Sequence as Sequence_class
 import re
-from math import isfinite
+from streets import flush_streets
+from specs import DatasetSpec
+from metrics import WorkerMetrics, MetricsReport, stage_summary, add_arguments, report_from_args
+from windows import WindowedFile, DEFAULT_MEMORY_LIMIT_MB, window_size, add_memory_argument
+import load_data_async
 
 # Type aliases
 Connection = psycopg2.extensions.connection
 Cursor = psycopg2.extensions.cursor
-Executor = Callable[[List[str], Cursor], None]
 
 
 
 ##### Helpers for executors #####
 
-def numeric(val: str) -> float:
-    try:
-        out = float(val)
-        return out if isfinite(out) else None
-    except Exception:
-        return None
-
-def integer(val: str) -> int:
-    try:
-        return int(val)
-    except Exception:
-        return None
-
-def wtype(val: str) -> int:
-    return 1 if len(val) != 0 else 0
+# Metrics of the file being loaded. insert_str() adds its time spent waiting on the database to
+# them.
+worker_metrics = WorkerMetrics("", "")
 
 # Insert values into a PostgreSQL table
 def insert_str(cur: Cursor, table: str, *insertions) -> None:
     vals = ", ".join(("%s" for i in range(len(insertions))))
+    time_start = perf_counter()
     cur.execute(f"INSERT INTO {table} VALUES ({vals})", insertions)
+    worker_metrics.seconds["execute"] += perf_counter() - time_start
 
 # Split the string by commas while disregarding commas surrounded by quotes.
 def csv_split(line: str) -> List[str]:
@@ -59,14 +53,6 @@ def csv_split(line: str) -> List[str]:
         row[c] = re.sub("  +", " ", row[c].strip("\"").strip())
     return row
 
-# Ensure that the list obtained from csv_split is the correct length
-def data_length_check(row: List[str], expected_length: int) -> None:
-    # For some ungodly reason, whenever the last element isn't blank, the length of the list is
-    # one greater than it should be, but whenever you try popping it, it actually pops two
-    # items. Why it does this, I do not know, but it seems relatively harmless so.
-    assert len(row) == expected_length or len(row) == expected_length + 1 \
-        and len(row[expected_length]) == 0
-
 
 
 ##### Progress bar functions #####
@@ -125,62 +111,42 @@ def init_progress_bar(total: int, length: int, precision: int = 0) -> None:
 
 
 
-##### Executors #####
+##### Dataset specs #####
 
-def insert_weather_line(row: List[str], cur: Cursor) -> None:
-    data_length_check(row, 24)
+# The specs of load_data_async.py, so that both loaders find their columns by the same headers, but
+# inserting through this loader's insert_str() so that its time shows up in this loader's metrics.
+# There's no verification step here, so collisions aren't checksummed.
+STATION_SPEC = load_data_async.STATION_SPEC.rebind(insert_str)
+WEATHER_SPEC = load_data_async.WEATHER_SPEC.rebind(insert_str)
+COLLISION_SPEC = load_data_async.COLLISION_SPEC.rebind(insert_str)
 
-    # Save date, since as the primary key it'll be passed to every table. This should already be in
-    # ISO format.
-    w_date = row[1]
 
-    # Actual insertions:
-    insert_str(cur, "Weather", row[0], w_date)
-    insert_str(cur, "Wind", w_date, numeric(row[2]))
-    insert_str(cur, "Precipitation", w_date, numeric(row[4]), numeric(row[5]), numeric(row[6]))
-    insert_str(cur, "Temperature", w_date, integer(row[8]), integer(row[9]))
-    insert_str(cur, "Wtypes", w_date, wtype(row[11]), wtype(row[12]), wtype(row[13]),
-        wtype(row[14]), wtype(row[15]), wtype(row[16]), wtype(row[17]), wtype(row[18]),
-        wtype(row[19]), wtype(row[20]), wtype(row[21]), wtype(row[22]), wtype(row[23]))
 
-def insert_collision_line(row: List[str], cur: Cursor) -> None:
-    data_length_check(row, 29)
+##### Collision partitions #####
 
-    # Save ID since it'll be reused several times
-    id_col = row[23]
-    # Restructure date string to match ISO format
-    date_match = re.fullmatch(r"(\d\d)/(\d\d)/(\d{4})", row[0])
-    c_date = "-".join((date_match.group(3), date_match.group(1), date_match.group(2))) \
-        if date_match else row[0]
-    # Zero-pad the time if necessary
-    c_time = row[1] if len(row[1]) == 5 else "".join(("0", row[1]))
+# Indexes built on each partition once it's loaded, by column list. They match the indexes that
+# post_load.sql creates on the partitioned tables, which adopt them instead of building their own.
+PARTITION_INDEXES = {"crash": (("date",), ("station", "date")), "location": (("cell",),)}
 
-    # Actual insertions:
-    insert_str(cur, "Crash", id_col, c_date, c_time)
-    insert_str(cur, "Location", id_col, row[2], row[3], numeric(row[4]), numeric(row[5]), row[7],
-        row[8], row[9])
-    insert_str(cur, "Injuries", id_col, integer(row[10]), integer(row[12]), integer(row[14]),
-        integer(row[16]))
-    insert_str(cur, "Deaths", id_col, integer(row[11]), integer(row[13]), integer(row[15]),
-        integer(row[17]))
-    insert_str(cur, "VehiclesFactors", id_col, row[24], row[25], row[26], row[27], row[28], row[18],
-        row[19], row[20], row[21], row[22])
+# Every partition of the collision tables as (partitioned table, partition), largest first
+def list_partitions(cur: Cursor) -> List[Tuple[str, str]]:
+    cur.execute("SELECT p0.relname, c0.relname FROM pg_inherits i0 "
+        "JOIN pg_class c0 ON c0.oid = i0.inhrelid JOIN pg_class p0 ON p0.oid = i0.inhparent "
+        "WHERE p0.relname IN ('crash', 'location', 'injuries', 'deaths', 'vehiclesfactors') "
+        "ORDER BY pg_relation_size(c0.oid) DESC")
+    return cur.fetchall()
 
+# Build the indexes of a single partition & gather its statistics
+def prepare_partition(table: str, partition_name: str, cur: Cursor) -> None:
+    for columns in PARTITION_INDEXES.get(table, ()):
+        index_name = "_".join((partition_name, *columns, "idx"))
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {partition_name} ({column_list})")
+    cur.execute(f"ANALYZE {partition_name}")
 
 
-##### Helpers for read loop #####
 
-def estimated_line_count(mm: mmap, start_position: int = 0) -> int:
-    position = start_position
-    count = 1
-    # ":=" operator only available in Python 3.8
-    while (new_position := mm.find(b"\n", position)) != -1:
-        count += 1
-        position = new_position + 1
-    # Don't count an empty line at the end of the file
-    if position == mm.size():
-        count = max(0, count - 1)
-    return count
+##### Helpers for read loop #####
 
 # Converts seconds to formatted ?h?m?s string, removing h and m if they're 0
 def duration(seconds: float) -> str:
@@ -199,64 +165,109 @@ def duration(seconds: float) -> str:
 
 ##### Read loop functions #####
 
-# Load the given file into memory & perform the given executor function upon each line of it.
+# Load the given file into memory & perform the executor compiled from the given spec upon each line
+# of it. Data files are read through a window that slides along them, so no more than memory_limit
+# bytes of one are mapped at a time.
 def process_file(data_path: Path, open_flags: int, conn: Connection, cur: Cursor,
-        executor: Executor = None, prog_config: Tuple[int, int] = None) -> int:
-    # Use os.open instead of the built-in open() to avoid any unnecessary overhead in the creation
-    # of a file object.
-    fd = os.open(data_path, open_flags)
+        spec: DatasetSpec = None, prog_config: Tuple[int, int] = None,
+        report: MetricsReport = None, memory_limit: int = DEFAULT_MEMORY_LIMIT_MB << 20) -> int:
+    global worker_metrics
     line_count = 0
-    data_size = data_path.stat().st_size
-    # Use a memory map to reduce the number of I/O operations:
-    with mmap(fd, 0, access = ACCESS_READ) as mm:
-        # For schema, just read the whole file at once.
-        if executor == None:
+    # For schema, just read the whole file at once.
+    if spec == None:
+        # Use os.open instead of the built-in open() to avoid any unnecessary overhead in the
+        # creation of a file object.
+        fd = os.open(data_path, open_flags)
+        with mmap(fd, 0, access = ACCESS_READ) as mm:
             cur.execute(mm.read())
-        # Otherwise, loop through the given dataset
-        else:
-            # Disregard the given CSV file's header row
-            mm.seek(mm.find(b"\n") + 1)
-            init_progress_bar(estimated_line_count(mm, mm.tell()), *prog_config)
-            # LOOP
-            while len(line := mm.readline()) != 0:
-                try:
-                    # Strip any carriage returns due to Windows-style line endings, then convert to
-                    # proper encoded text
-                    row = csv_split(line.rstrip(b"\r").decode())
-                    executor(row, cur)
-                    line_count += 1
-                    # Reprint progress bar over itself
-                    progress_bar()
-                except BaseException as e:
-                    # We need to make a distinction between actual exceptions (class Exception) and
-                    # any cause of unnatural of program termination, e.g. the user pressing CTRL+C
-                    # (class BaseException).
-                    if isinstance(e, Exception):
-                        if isinstance(e, AssertionError):
-                            # TO DO: If the row length is less than expected, save the row & try to
-                            # splice it with the next one.
-                            # For now, just don't insert it, and continue the loop without raising
-                            # the exception.
-                            pass
-                        else:
-                            if DEBUG:
-                                print("\n<DEBUG>Row contents:", file = sys.stderr)
-                                for c in range(len(row)):
-                                    print
-                                    print(f"  [{c}]: \"{row[c]}\"", file = sys.stderr)
-                                print(f"  Length: {len(row)}", file = sys.stderr)
-                            raise e
+        os.close(fd)
+    # Otherwise, loop through the given dataset
+    else:
+        data_file = WindowedFile(data_path, open_flags, window_size(memory_limit, 1))
+        # Find each of the spec's columns in the CSV file's header row, then disregard it
+        header, data_start = data_file.first_line()
+        try:
+            resolved = spec.resolve(csv_split(header.rstrip(b"\r").decode()))
+        except ValueError as e:
+            print(f"ERROR: {e}!", file = sys.stderr)
+            sys.exit(1)
+        if absent := resolved.absent():
+            print(f"(no {', '.join(absent)} column{'s' if len(absent) != 1 else ''}; using defaults)")
+        if DEBUG:
+            print("<DEBUG>Executor:", resolved.source()[0], sep = "\n")
+        executor = resolved.compile()
+        init_progress_bar(data_file.count_lines(data_start, data_file.size), *prog_config)
+        worker_metrics = metrics = WorkerMetrics(data_path.name, "main", report.profile_interval)
+        stage_seconds = metrics.seconds
+        last_report = perf_counter()
+        time_read = perf_counter()
+        # LOOP
+        for line in data_file.lines(data_start, data_file.size):
+            # Plus the line ending the window doesn't include
+            metrics.bytes += len(line) + 1
+            try:
+                # Strip any carriage returns due to Windows-style line endings, then convert to
+                # proper encoded text
+                line = line.rstrip(b"\r").decode()
+                time_tokenize = perf_counter()
+                stage_seconds["read"] += time_tokenize - time_read
+                row = csv_split(line)
+                time_convert = perf_counter()
+                stage_seconds["tokenize"] += time_convert - time_tokenize
+
+                execute_before = stage_seconds["execute"]
+                executor(row, cur)
+                # Whatever the executor didn't spend waiting on the database went to converting
+                time_done = perf_counter()
+                stage_seconds["convert"] += time_done - time_convert \
+                    - (stage_seconds["execute"] - execute_before)
+                metrics.rows += 1
+                if time_done - last_report >= report.interval:
+                    report.update(metrics.snapshot())
+                    last_report = time_done
+                line_count += 1
+                # Reprint progress bar over itself
+                progress_bar()
+            except BaseException as e:
+                # We need to make a distinction between actual exceptions (class Exception) and
+                # any cause of unnatural of program termination, e.g. the user pressing CTRL+C
+                # (class BaseException).
+                if isinstance(e, Exception):
+                    if isinstance(e, AssertionError):
+                        # TO DO: If the row length is less than expected, save the row & try to
+                        # splice it with the next one.
+                        # For now, just don't insert it, and continue the loop without raising
+                        # the exception.
+                        metrics.errors += 1
                     else:
-                        sys.exit(1)
-            print() # Newline to get us past the progress bar
-    os.close(fd)
+                        if DEBUG:
+                            print("\n<DEBUG>Row contents:", file = sys.stderr)
+                            for c in range(len(row)):
+                                print
+                                print(f"  [{c}]: \"{row[c]}\"", file = sys.stderr)
+                            print(f"  Length: {len(row)}", file = sys.stderr)
+                        raise e
+                else:
+                    sys.exit(1)
+            # Reading the next line starts now
+            time_read = perf_counter()
+        data_file.close()
+        print() # Newline to get us past the progress bar
+    time_start = perf_counter()
+    # The names of the streets the rows were on go in with the rows themselves
+    flush_streets(cur)
     conn.commit()
+    if spec != None:
+        stage_seconds["commit"] += perf_counter() - time_start
+        metrics.close()
+        report.update(metrics.snapshot())
     return line_count
 
 # Wrapper for processing data files
 def import_routine(data: Union[Path, Sequence[Path]], open_flags: int, conn: Connection,
-        cur: Cursor, executor: Executor, prog_config: Tuple[int, int]) -> int:
-    args = (open_flags, conn, cur, executor, prog_config)
+        cur: Cursor, spec: DatasetSpec, prog_config: Tuple[int, int],
+        report: MetricsReport, memory_limit: int) -> int:
+    args = (open_flags, conn, cur, spec, prog_config, report, memory_limit)
     if isinstance(data, Sequence_class):
         total_line_count = 0
         for d in data:
@@ -268,6 +279,7 @@ def import_routine(data: Union[Path, Sequence[Path]], open_flags: int, conn: Con
             total_line_count += line_count
             print(f"+++ Finished parsing \"{data_name}\" +++")
             print(f"    (processed {line_count} lines in {duration(time_elapsed)})")
+            print(f"    ({stage_summary(report.snapshots(d.name))})")
         return total_line_count
     else:
         data_name = str(data)
@@ -276,6 +288,7 @@ def import_routine(data: Union[Path, Sequence[Path]], open_flags: int, conn: Con
         line_count = process_file(data, *args)
         time_elapsed = perf_counter() - time_start
         print(f"+++ Finished parsing \"{data_name}\" +++")
+        print(f"    ({stage_summary(report.snapshots(data.name))})")
         return line_count
 
 
@@ -303,6 +316,13 @@ def main() -> None:
         "password='dbms_password'")
     cur = conn.cursor()
 
+    parser = ArgumentParser(description = "Load the weather & collision datasets into the database.")
+    add_arguments(parser)
+    add_memory_argument(parser)
+    args = parser.parse_args()
+    report = report_from_args(args)
+    memory_limit = args.memory_limit << 20
+
     ### SET UP TABLES ###
 
     schema_file = this_dir.joinpath("schema.sql")
@@ -318,6 +338,26 @@ def main() -> None:
 
     data_dir = this_dir.joinpath("datasets")
 
+    ### LOAD STATION DATA ###
+
+    print()
+    station_data = data_dir.joinpath("stations.csv")
+    print("### Importing station data ###")
+    time_start = perf_counter()
+    if station_data.exists():
+        line_count = import_routine(station_data, open_flags, conn, cur, STATION_SPEC,
+            (32, 0), report, memory_limit)
+    else:
+        default_station = load_data_async.DEFAULT_STATION
+        print(f"No station list at \"{str(station_data)}\"; using {default_station[1]} only")
+        STATION_SPEC.executor()([default_station[0], default_station[1], str(default_station[2]),
+            str(default_station[3])], cur)
+        conn.commit()
+        line_count = 1
+    time_elapsed = perf_counter() - time_start
+    print("### Finished importing station data ###")
+    print(f"    (processed {line_count} lines in {duration(time_elapsed)})")
+
     ### LOAD WEATHER DATA ###
 
     print()
@@ -327,7 +367,8 @@ def main() -> None:
         sys.exit(1)
     print("### Importing weather data ###")
     time_start = perf_counter()
-    line_count = import_routine(weather_data, open_flags, conn, cur, insert_weather_line, (32, 0))
+    line_count = import_routine(weather_data, open_flags, conn, cur, WEATHER_SPEC, (32, 0),
+        report, memory_limit)
     time_elapsed = perf_counter() - time_start
     print("### Finished importing weather data ###")
     print(f"    (processed {line_count} lines in {duration(time_elapsed)})")
@@ -341,11 +382,39 @@ def main() -> None:
         sys.exit(1)
     print("### Importing collision data ###")
     time_start = perf_counter()
-    line_count = import_routine(collision_data, open_flags, conn, cur, insert_collision_line,
-        (48, 2))
+    line_count = import_routine(collision_data, open_flags, conn, cur, COLLISION_SPEC,
+        (48, 2), report, memory_limit)
+    report.write()
     time_elapsed = perf_counter() - time_start
     print("### Finished importing collision data ###")
     print(f"    (processed {line_count} lines in {duration(time_elapsed)})")
 
+    ### INDEX & ANALYZE PARTITIONS ###
+
+    print()
+    print("### Indexing & analyzing partitions ###")
+    time_start = perf_counter()
+    partitions = list_partitions(cur)
+    for table, partition_name in partitions:
+        prepare_partition(table, partition_name, cur)
+    conn.commit()
+    time_elapsed = perf_counter() - time_start
+    print("### Finished indexing & analyzing partitions ###")
+    print(f"    (processed {len(partitions)} partitions in {duration(time_elapsed)})")
+
+    ### BUILD INDEXES & SUMMARIES ###
+
+    print()
+    post_load_file = this_dir.joinpath("post_load.sql")
+    if not post_load_file.exists():
+        print(f"ERROR: Post-load file \"{str(post_load_file)}\" does not exist!", file = sys.stderr)
+        sys.exit(1)
+    print("### Building indexes & summaries ###")
+    time_start = perf_counter()
+    process_file(post_load_file, open_flags, conn, cur)
+    time_elapsed = perf_counter() - time_start
+    print("### Finished building indexes & summaries ###")
+    print(f"    (processed in {duration(time_elapsed)})")
+
 if __name__ == "__main__":
     main()
@@ -4,29 +4,30 @@ DEBUG = False
 
 from sys import platform, stdout, stderr, exit
 WINDOWS = platform.startswith("win")
-from typing import Any, Sequence, Callable, Optional, List, Tuple
+from typing import Any, Dict, Sequence, Optional, List, Tuple
 from pathlib import Path
+from argparse import ArgumentParser
 import os
 from time import perf_counter
-from mmap import mmap
-if WINDOWS:
-    from mmap import ACCESS_READ
-    from msvcrt import get_osfhandle
-else:
-    from mmap import MAP_SHARED, PROT_READ
-from multiprocessing import Process, Lock as LockFactory
+from multiprocessing import Process, Pipe, Lock as LockFactory
 from multiprocessing.sharedctypes import RawValue
 from multiprocessing.synchronize import Lock
-from multiprocessing.connection import wait
+from multiprocessing.connection import wait, Connection as MetricsPipe
 import psycopg2
 from psycopg2.extensions import connection as Connection, cursor as Cursor
 from ctypes import c_size_t, c_float, c_ubyte, c_bool
 import re
 from math import isfinite
 from traceback import print_exc
-
-# Type alias
-Executor = Callable[[List[str], Cursor], None]
+from grid import grid_cell, nearest_lookup
+from streets import street_id, flush_streets
+from embedded import load_embedded
+from database import typecodes
+from specs import Field, Derived, Target, DatasetSpec, ResolvedSpec
+from windows import WindowedFile, window_size, add_memory_argument
+from reconcile import ChunkChecksums, LoadManifest, verify_tasks, table_aggregates, compare_ranges, \
+    range_details, describe
+from metrics import WorkerMetrics, MetricsReport, stage_summary, add_arguments, report_from_args
 
 
 
@@ -105,6 +106,11 @@ def numeric(val: str) -> Optional[float]:
     except Exception:
         return None
 
+# Coordinates of 0 mean that the location of the crash wasn't recorded
+def coordinate(val: str) -> Optional[float]:
+    out = numeric(val)
+    return out if out != 0 else None
+
 def integer(val: str) -> Optional[int]:
     try:
         return int(val)
@@ -114,104 +120,217 @@ def integer(val: str) -> Optional[int]:
 def wtype(val: str) -> int:
     return 1 if len(val) != 0 else 0
 
+# Pack the weather type columns into one integer, with bit i set when the i-th type (WT01 first)
+# was reported
+def wtype_mask(*vals: int) -> int:
+    mask = 0
+    for i, val in enumerate(vals):
+        mask |= val << i
+    return mask
+
+# Metrics of the worker running in this process. insert_str() adds its time spent waiting on the
+# database to them.
+worker_metrics = WorkerMetrics("", "")
+# Counts & checksums of the collisions written by the worker running in this process, by range of IDs
+worker_checksums = ChunkChecksums("", "")
+
 # Insert values into a PostgreSQL table
 def insert_str(cur: Cursor, table: str, *insertions: Any) -> None:
     vals = ", ".join("%s" for i in insertions)
+    time_start = perf_counter()
     cur.execute(f"INSERT INTO {table} VALUES ({vals})", insertions)
-
-# Ensure that the list obtained from csv_split is the correct length
-def data_length_check(row: List[str], expected_length: int) -> None:
-    # For some ungodly reason, whenever the last element isn't blank, the length of the list is
-    # one greater than it should be, but whenever you try popping it, it actually pops two
-    # items. Why it does this, I do not know, but it seems relatively harmless.
-    assert len(row) == expected_length or len(row) == expected_length + 1 \
-        and len(row[expected_length]) == 0
-
-
-
-##### Executors #####
-
-def insert_weather_line(row: List[str], cur: Cursor) -> None:
-    data_length_check(row, 24)
-
-    # Save date, since as the primary key it'll be passed to every table. This should already be in
-    # ISO format.
-    w_date = row[1]
-
-    # Actual insertions:
-    insert_str(cur, "Weather", row[0], w_date)
-    insert_str(cur, "Wind", w_date, numeric(row[2]))
-    insert_str(cur, "Precipitation", w_date, numeric(row[4]), numeric(row[5]), numeric(row[6]))
-    insert_str(cur, "Temperature", w_date, integer(row[8]), integer(row[9]))
-    insert_str(cur, "Wtypes", w_date, wtype(row[11]), wtype(row[12]), wtype(row[13]),
-        wtype(row[14]), wtype(row[15]), wtype(row[16]), wtype(row[17]), wtype(row[18]),
-        wtype(row[19]), wtype(row[20]), wtype(row[21]), wtype(row[22]), wtype(row[23]))
-
-def insert_collision_line(row: List[str], cur: Cursor) -> None:
-    data_length_check(row, 29)
-
-    # Save ID since it'll be reused several times
-    id_col = row[23]
-    # Restructure date string to match ISO format
-    date_match = re.fullmatch(r"(\d\d)/(\d\d)/(\d{4})", row[0])
-    c_date = "-".join((date_match.group(3), date_match.group(1), date_match.group(2))) \
-        if date_match else row[0]
-    # Zero-pad the time if necessary
-    c_time = row[1] if len(row[1]) == 5 else "0" + row[1]
-
-    # Actual insertions:
-    insert_str(cur, "Crash", id_col, c_date, c_time)
-    insert_str(cur, "Location", id_col, row[2], row[3], numeric(row[4]), numeric(row[5]), row[7],
-        row[8], row[9])
-    insert_str(cur, "Injuries", id_col, integer(row[10]), integer(row[12]), integer(row[14]),
-        integer(row[16]))
-    insert_str(cur, "Deaths", id_col, integer(row[11]), integer(row[13]), integer(row[15]),
-        integer(row[17]))
-    insert_str(cur, "VehiclesFactors", id_col, row[24], row[25], row[26], row[27], row[28], row[18],
-        row[19], row[20], row[21], row[22])
+    worker_metrics.seconds["execute"] += perf_counter() - time_start
+
+
+
+
+##### Weather stations #####
+
+# Crashes with no known location are given the weather of NYC Central Park, which is also the only
+# station loaded when there's no station list.
+DEFAULT_STATION = ("USW00094728", "NY CITY CENTRAL PARK, NY US", 40.77898, -73.96925)
+
+# The nearest weather station to each grid cell. Every process builds its own copy the first time
+# it loads a crash, once all of the weather data is in.
+station_lookup = None
+
+def nearest_station(cell: Optional[int], cur: Cursor) -> str:
+    global station_lookup
+    if station_lookup is None:
+        # Only stations that actually have weather data are worth attributing crashes to
+        cur.execute("SELECT station, latitude, longitude FROM Station WHERE latitude IS NOT NULL "
+            "AND longitude IS NOT NULL AND station IN (SELECT DISTINCT station FROM Weather)")
+        stations = [(name, float(lat), float(lon)) for name, lat, lon in cur.fetchall()]
+        station_lookup = nearest_lookup(stations) if stations else []
+    if cell is None or len(station_lookup) == 0:
+        return DEFAULT_STATION[0]
+    return station_lookup[cell]
+
+
+
+##### Collision partitions #####
+
+# The years that have their own partition of the collision tables. Every process looks them up the
+# first time it loads a crash.
+partition_years = None
+
+# Name of the partition of a collision table that a crash on the given date belongs in, so rows can
+# be inserted straight into it rather than being routed through the partitioned table
+def partition(table: str, c_date: str, cur: Cursor) -> str:
+    global partition_years
+    if partition_years is None:
+        cur.execute("SELECT c0.relname FROM pg_inherits i0 JOIN pg_class c0 ON c0.oid = i0.inhrelid "
+            "WHERE i0.inhparent = 'crash'::regclass")
+        partition_years = {name[len("crash_"):] for (name,) in cur.fetchall()}
+    year = c_date[:4]
+    return f"{table}_{year}" if year in partition_years else f"{table}_default"
+
+# Indexes built on each partition once it's loaded, by column list. They match the indexes that
+# post_load.sql creates on the partitioned tables, which adopt them instead of building their own.
+PARTITION_INDEXES = {"crash": (("date",), ("station", "date")), "location": (("cell",),)}
+
+# Every partition of the collision tables as (partitioned table, partition), largest first
+def list_partitions(cur: Cursor) -> List[Tuple[str, str]]:
+    cur.execute("SELECT p0.relname, c0.relname FROM pg_inherits i0 "
+        "JOIN pg_class c0 ON c0.oid = i0.inhrelid JOIN pg_class p0 ON p0.oid = i0.inhparent "
+        "WHERE p0.relname IN ('crash', 'location', 'injuries', 'deaths', 'vehiclesfactors') "
+        "ORDER BY pg_relation_size(c0.oid) DESC")
+    return cur.fetchall()
+
+# Build the indexes of a single partition & gather its statistics
+def prepare_partition(table: str, partition_name: str, cur: Cursor) -> None:
+    for columns in PARTITION_INDEXES.get(table, ()):
+        index_name = "_".join((partition_name, *columns, "idx"))
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {partition_name} ({column_list})")
+    cur.execute(f"ANALYZE {partition_name}")
+
+
+
+##### Dataset specs #####
+
+# Converters for the collision data's dates & times, which aren't in ISO format
+US_DATE = re.compile(r"(\d\d)/(\d\d)/(\d{4})")
+
+def us_date(val: str) -> str:
+    date_match = US_DATE.fullmatch(val)
+    return "-".join((date_match.group(3), date_match.group(1), date_match.group(2))) \
+        if date_match else val
+
+# Zero-pad the time if necessary
+def clock_time(val: str) -> str:
+    return val if len(val) == 5 else "0" + val
+
+def record_checksum(collision_id: int, c_date: str) -> None:
+    worker_checksums.add(collision_id, c_date)
+
+STATION_SPEC = DatasetSpec("station", {
+    "station": Field("STATION", required = True),
+    "name": Field("NAME", default = ""),
+    "latitude": Field("LATITUDE", coordinate),
+    "longitude": Field("LONGITUDE", coordinate),
+}, (Target("Station", ("station", "name", "latitude", "longitude")),), insert_str,
+    layout = ("STATION", "NAME", "LATITUDE", "LONGITUDE"))
+
+# NOAA leaves out the column of a weather type that was never reported, so those are optional. The
+# date should already be in ISO format.
+WEATHER_SPEC = DatasetSpec("weather", {
+    "station": Field("STATION", required = True),
+    "date": Field("DATE", required = True),
+    "avgwind": Field("AWND", numeric),
+    "precip": Field("PRCP", numeric),
+    "snow": Field("SNOW", numeric),
+    "snowdepth": Field("SNWD", numeric),
+    "maxtemp": Field("TMAX", integer),
+    "mintemp": Field("TMIN", integer),
+    **{code: Field(code.upper(), wtype, default = 0) for code in typecodes},
+    "mask": Derived(wtype_mask, *typecodes),
+}, (Target("Weather", ("station", "date")),
+    Target("Wind", ("station", "date", "avgwind")),
+    Target("Precipitation", ("station", "date", "precip", "snow", "snowdepth")),
+    Target("Temperature", ("station", "date", "maxtemp", "mintemp")),
+    Target("Wtypes", ("station", "date", *typecodes, "mask"))), insert_str,
+    layout = ("STATION", "DATE", "AWND", "PGTM", "PRCP", "SNOW", "SNWD", "TAVG", "TMAX", "TMIN",
+        "TSUN", *(code.upper() for code in typecodes)))
+
+# Rows without a usable ID are skipped, just like rows that are too short. Each crash is located on
+# the grid, which also gives its nearest weather station, and every row is inserted straight into the
+# partition for the crash's year.
+COLLISION_SPEC = DatasetSpec("collision", {
+    "id": Field("COLLISION_ID", integer, required = True),
+    "date": Field(("CRASH DATE", "DATE"), us_date, required = True),
+    "time": Field(("CRASH TIME", "TIME"), clock_time, required = True),
+    "borough": Field("BOROUGH", default = ""),
+    "zip": Field("ZIP CODE", default = ""),
+    "latitude": Field("LATITUDE", coordinate),
+    "longitude": Field("LONGITUDE", coordinate),
+    "on_st": Field("ON STREET NAME", default = ""),
+    "cross_st": Field("CROSS STREET NAME", default = ""),
+    "off_st": Field("OFF STREET NAME", default = ""),
+    "injured_total": Field("NUMBER OF PERSONS INJURED", integer),
+    "killed_total": Field("NUMBER OF PERSONS KILLED", integer),
+    "injured_pedestrians": Field("NUMBER OF PEDESTRIANS INJURED", integer),
+    "killed_pedestrians": Field("NUMBER OF PEDESTRIANS KILLED", integer),
+    "injured_cyclists": Field(("NUMBER OF CYCLIST INJURED", "NUMBER OF CYCLISTS INJURED"), integer),
+    "killed_cyclists": Field(("NUMBER OF CYCLIST KILLED", "NUMBER OF CYCLISTS KILLED"), integer),
+    "injured_motorists": Field(("NUMBER OF MOTORIST INJURED", "NUMBER OF MOTORISTS INJURED"),
+        integer),
+    "killed_motorists": Field(("NUMBER OF MOTORIST KILLED", "NUMBER OF MOTORISTS KILLED"), integer),
+    **{f"contrib_factor{i}": Field(f"CONTRIBUTING FACTOR VEHICLE {i}", default = "")
+        for i in range(1, 6)},
+    **{f"type_vehicle{i}": Field(f"VEHICLE TYPE CODE {i}", default = "") for i in range(1, 6)},
+    "cell": Derived(grid_cell, "latitude", "longitude"),
+    "station": Derived(nearest_station, "cell", cursor = True),
+    "on_street": Derived(street_id, "on_st"),
+    "cross_street": Derived(street_id, "cross_st"),
+    "off_street": Derived(street_id, "off_st"),
+}, (Target("Crash", ("id", "date", "time", "station"), partition, "date"),
+    Target("Location", ("id", "date", "latitude", "longitude", "on_street", "cross_street",
+        "off_street", "cell", "borough", "zip", "on_st", "cross_st", "off_st"), partition, "date"),
+    Target("Injuries", ("id", "date", "injured_total", "injured_pedestrians", "injured_cyclists",
+        "injured_motorists"), partition, "date"),
+    Target("Deaths", ("id", "date", "killed_total", "killed_pedestrians", "killed_cyclists",
+        "killed_motorists"), partition, "date"),
+    Target("VehiclesFactors", ("id", "date", *(f"type_vehicle{i}" for i in range(1, 6)),
+        *(f"contrib_factor{i}" for i in range(1, 6))), partition, "date")), insert_str,
+    after = (Derived(record_checksum, "id", "date"),),
+    layout = ("CRASH DATE", "CRASH TIME", "BOROUGH", "ZIP CODE", "LATITUDE", "LONGITUDE",
+        "LOCATION", "ON STREET NAME", "CROSS STREET NAME", "OFF STREET NAME",
+        "NUMBER OF PERSONS INJURED", "NUMBER OF PERSONS KILLED", "NUMBER OF PEDESTRIANS INJURED",
+        "NUMBER OF PEDESTRIANS KILLED", "NUMBER OF CYCLIST INJURED", "NUMBER OF CYCLIST KILLED",
+        "NUMBER OF MOTORIST INJURED", "NUMBER OF MOTORIST KILLED",
+        *(f"CONTRIBUTING FACTOR VEHICLE {i}" for i in range(1, 6)), "COLLISION_ID",
+        *(f"VEHICLE TYPE CODE {i}" for i in range(1, 6))))
+
+# Executors for rows laid out like the files the specs were written for, e.g. synthetic ones
+insert_station_line = STATION_SPEC.executor()
+insert_weather_line = WEATHER_SPEC.executor()
+insert_collision_line = COLLISION_SPEC.executor()
 
 
 
 ##### Helpers for main() subroutines #####
 
+# Split the string by commas while disregarding commas surrounded by quotes, the same way as the
+# loop of proc_exec(). Only used for header rows; the loop has it inline.
+def csv_split(line: str) -> List[str]:
+    row = re.findall("(\"[^\"]*\"|[^,]+|(?<=,)(?=,)|^(?=,)|(?<=,)$)", line)
+    return [re.sub("  +", " ", col.strip("\"").strip()) for col in row]
+
 def get_connection() -> Tuple[Connection, Cursor]:
     conn = psycopg2.connect("host='localhost' dbname='dbms_final_project' user='dbms_project_user' "
         "password='dbms_password'")
     cur = conn.cursor()
     return conn, cur
 
-def count_lines(mm: mmap, start: int, end: int) -> int:
-    position = start
-    count = 1
-    # ":=" operator only available in Python 3.8
-    while (new_position := mm.find(b"\n", position)) != -1 and new_position < end:
-        count += 1
-        position = new_position + 1
-    # Don't count an empty line at the end of the file
-    if position == end:
-        count -= 1
-    return count
-
 # Create approximately equal sections of the file to give to child processes, "rounded" to the
 # nearest newline.
-def get_boundaries(mm: mmap, start: int, end: int, num_sections: int) -> List[int]:
+def get_boundaries(data_file: WindowedFile, start: int, end: int, num_sections: int) -> List[int]:
     interval = (end - start)/num_sections
-    # Create the list with a preset length
-    boundaries = list(range(num_sections + 1))
-    # Populate the list
-    boundaries[0] = start
-    boundaries[-1] = end
-    n_code = ord("\n")
-    for i in range(1, len(boundaries) - 1):
-        # Find the nearest newline to the next interval & place the boundary after it
-        high = low = round(i*interval)
-        while True:
-            if mm[(high := high + 1)] == n_code:
-                boundaries[i] = high + 1
-                break
-            if mm[(low := low - 1)] == n_code:
-                boundaries[i] = low + 1
-                break
+    boundaries = [start]
+    for i in range(1, num_sections):
+        boundaries.append(data_file.line_start_near(start + round(i*interval), start, end))
+    boundaries.append(end)
     return boundaries
 
 # Determine the correct quantity & unit pairing (e.g. "1 line" or "? lines")
@@ -235,31 +354,37 @@ def duration(seconds: float) -> str:
 ##### Subroutines for main() #####
 
 # CHILD PROCESS: loop over a given section of the memory map
-def proc_exec(name: str, fd_or_size: int, shm_tag: Optional[str], file_start: int, file_end: int,
-        print_lock: Lock, executor: Executor, progress_bar: ProgressBar) -> None:
+def proc_exec(name: str, data_path: Path, open_flags: int, window: int, file_start: int, file_end: int,
+        print_lock: Lock, spec: ResolvedSpec, progress_bar: ProgressBar, dataset: str,
+        metrics_pipe: MetricsPipe, report_interval: float,
+        profile_interval: Optional[float]) -> None:
+    global worker_metrics, worker_checksums
     # I want to avoid unnecessary, messy, interleaved stacktraces
     try:
-        # Obtain the same memory map as in the parent process.
-        if WINDOWS:
-            mm = mmap(-1, fd_or_size, shm_tag, ACCESS_READ)
-        else:
-            mm = mmap(fd_or_size, 0, MAP_SHARED, PROT_READ)
+        worker_metrics = metrics = WorkerMetrics(dataset, name, profile_interval)
+        worker_checksums = ChunkChecksums(dataset, name, file_start, file_end)
+        # Compiled here rather than in the parent, since generated functions can't be pickled
+        executor = spec.compile()
+        stage_seconds = metrics.seconds
+        last_report = perf_counter()
+        # Each process reads its own section through its own window, so the whole of a big file is
+        # never in memory at once
+        data_file = WindowedFile(data_path, open_flags, window)
         # Postgres connection objects
         conn, cur = get_connection()
 
         # LOOP
-        line_start = file_start
         if DEBUG:
             line_num = 1
-        while line_start < file_end:
+        time_read = perf_counter()
+        for raw_line in data_file.lines(file_start, file_end):
             try:
-                # Note that we can't use readline() because there's a chance it could change the
-                # file position for the other processes as well. Not sure though.
-                if (line_end := mm.find(b"\n", line_start, file_end)) == -1:
-                    line_end = file_end
                 # Strip any carriage returns due to Windows-style line endings, then convert to
                 # proper text
-                line = mm[line_start:line_end].rstrip(b"\r").decode()
+                line = raw_line.rstrip(b"\r").decode()
+                metrics.bytes += len(raw_line) + 1
+                time_tokenize = perf_counter()
+                stage_seconds["read"] += time_tokenize - time_read
 
                 # CSV possibilities:
                 # - Quoted string
@@ -272,21 +397,33 @@ def proc_exec(name: str, fd_or_size: int, shm_tag: Optional[str], file_start: in
                 # Remove surrounding quotes & unnecessary whitespace.
                 for i, col in enumerate(row):
                     row[i] = re.sub("  +", " ", col.strip("\"").strip())
-                
+                time_convert = perf_counter()
+                stage_seconds["tokenize"] += time_convert - time_tokenize
+
+                execute_before = stage_seconds["execute"]
                 executor(row, cur)
+                # Whatever the executor didn't spend waiting on the database went to converting
+                time_done = perf_counter()
+                stage_seconds["convert"] += time_done - time_convert \
+                    - (stage_seconds["execute"] - execute_before)
+                metrics.rows += 1
+                if time_done - last_report >= report_interval:
+                    metrics_pipe.send(metrics.snapshot())
+                    last_report = time_done
             except AssertionError:
                 # TO DO: If the row length is less than expected, save the row & try to splice it
                 # with the next one.
                 # For now, just don't insert it, and skip it while still counting it toward the
                 # overall progress.
-                pass
+                metrics.errors += 1
 
             with print_lock:
                 progress_bar()
             # Prepare for the next loop
-            line_start = line_end + 1
             if DEBUG:
                 line_num += 1
+            time_read = perf_counter()
+        data_file.close()
     except Exception as e:
         with print_lock:
             print()
@@ -314,54 +451,98 @@ def proc_exec(name: str, fd_or_size: int, shm_tag: Optional[str], file_start: in
     except:
         exit(2)
 
+    time_start = perf_counter()
+    # The names of the streets the rows were on go in with the rows themselves
+    flush_streets(cur)
     conn.commit() # Only commit on success
-
-# Load the given file into memory & perform the given executor function upon each line of it.
-def process_data(data_path: Path, open_flags: int, shm_tag: Optional[str], num_procs: int,
-        executor: Executor, prog_config: Tuple[int, int]) -> int:
-    # Use os.open instead of the built-in open() to avoid any unnecessary overhead in the creation
-    # of a file object.
-    fd = os.open(data_path, open_flags)
-    # Use a memory map to reduce the number of I/O operations. API differs betwees OSes:
-    if WINDOWS:
-        #assert shm_tag
-        # Obtain underlying file handle from file descriptor
-        os.set_handle_inheritable(get_osfhandle(fd), True)
-        mm = mmap(fd, 0, shm_tag, ACCESS_READ)
+    stage_seconds["commit"] += perf_counter() - time_start
+    metrics.close()
+    metrics_pipe.send(metrics.snapshot())
+    # Only collisions are checksummed, and only once they're committed
+    if worker_checksums.rows + worker_checksums.unchecked > 0:
+        metrics_pipe.send(worker_checksums.snapshot())
+    metrics_pipe.close()
+
+# Pass a message from a child process on to wherever it belongs
+def receive(message: Dict[str, Any], report: MetricsReport, manifest: LoadManifest) -> None:
+    if "ranges" in message:
+        manifest.add(message)
     else:
-        os.set_inheritable(fd, True)
-        mm = mmap(fd, 0, MAP_SHARED, PROT_READ)
-    # Disregard the CSV file's header row by skipping past the first newline.
-    file_start = mm.find(b"\n") + 1
-    file_end = mm.size()
+        report.update(message)
+
+# Read the given file a window at a time & perform the executor compiled from the given spec upon
+# each line of it. The windows of every process together stay under memory_limit bytes.
+def process_data(data_path: Path, open_flags: int, memory_limit: int, num_procs: int,
+        spec: DatasetSpec, prog_config: Tuple[int, int], report: MetricsReport,
+        manifest: LoadManifest) -> int:
+    # Memory mapped windows reduce the number of I/O operations without the whole file being mapped.
+    # Until the child processes start, this process has the whole memory limit to itself.
+    data_file = WindowedFile(data_path, open_flags, window_size(memory_limit, 1))
+    # Find each of the spec's columns in the CSV file's header row, then disregard it by skipping
+    # past the first newline.
+    header, file_start = data_file.first_line()
+    file_end = data_file.size
+    try:
+        resolved = spec.resolve(csv_split(header.rstrip(b"\r").decode()))
+    except ValueError as e:
+        print(f"ERROR: {e}!", file = stderr)
+        exit(1)
+    if absent := resolved.absent():
+        print(f"(no {', '.join(absent)} column{'s' if len(absent) != 1 else ''}; using defaults)")
+    if DEBUG:
+        print("<DEBUG>Executor:", resolved.source()[0], sep = "\n")
 
     # If n = the number of CPU cores, create n processes that each work on 1/n of the total file.
-    num_procs = min(num_procs, line_count := count_lines(mm, file_start, file_end))
-    boundaries = get_boundaries(mm, file_start, file_end, num_procs)
+    num_procs = min(num_procs, line_count := data_file.count_lines(file_start, file_end))
+    boundaries = get_boundaries(data_file, file_start, file_end, num_procs)
+    data_file.close()
+    window = window_size(memory_limit, num_procs)
     if DEBUG:
         print("<DEBUG>Boundaries:", boundaries)
+        print(f"<DEBUG>Window: {window} bytes per process")
     # Create other variables for the child processes.
     print_lock = LockFactory()
     progress_bar = ProgressBar(line_count, *prog_config)
+    # Each child process sends snapshots of its metrics, then its checksums, back through its own pipe
+    pipes = tuple(Pipe(duplex = False) for i in range(num_procs))
     # We avoid the actual Pool class so we can get some more control over what gets sent where.
-    pool = tuple(Process(target = proc_exec, args = (str(i + 1), mm.size() if WINDOWS else fd,
-        shm_tag, boundaries[i], boundaries[i + 1], print_lock, executor, progress_bar),
+    pool = tuple(Process(target = proc_exec, args = (str(i + 1), data_path, open_flags, window,
+        boundaries[i], boundaries[i + 1], print_lock, resolved, progress_bar,
+        data_path.name, pipes[i][1], report.interval, report.profile_interval),
         daemon = True) for i in range(num_procs))
 
     # START PARSING
     progress_bar() # Initial print
     for p in pool:
         p.start()
+    # Only the children write to the pipes, so that reading gives EOFError once they're gone
+    for receiver, sender in pipes:
+        sender.close()
+    receivers = [receiver for receiver, sender in pipes]
 
     try: # Wait for completion of all or failure of one.
         sentinel_map = {p.sentinel: p for p in pool}
-        sentinels = sentinel_map.keys() # Live view: updates with the dict
         while num_procs != 0:
-            for sentinel in wait(sentinels): # wait() is a blocking call
-                if sentinel_map.pop(sentinel).exitcode == 0:
-                    num_procs -= 1
+            for ready in wait([*sentinel_map.keys(), *receivers]): # wait() is a blocking call
+                if ready in receivers:
+                    try:
+                        receive(ready.recv(), report, manifest)
+                    except EOFError:
+                        receivers.remove(ready)
                 else:
-                    exit(1)
+                    # The sentinel can be ready a moment before the exit code is, so wait for it
+                    finished = sentinel_map.pop(ready)
+                    finished.join()
+                    if finished.exitcode != 0:
+                        exit(1)
+                    num_procs -= 1
+        # Pick up the last snapshots, sent just before the processes finished
+        for receiver in receivers:
+            while receiver.poll():
+                try:
+                    receive(receiver.recv(), report, manifest)
+                except EOFError:
+                    break
     except BaseException as e:
         # This section is reached when there's a keyboard interruption or something
         print()
@@ -369,13 +550,12 @@ def process_data(data_path: Path, open_flags: int, shm_tag: Optional[str], num_p
         exit(2)
 
     print()
-    mm.close()
-    os.close(fd)
     return line_count
 
 # Wrapper for processing data files
-def import_dataset(category: str, dataset: Sequence[Path], open_flags: int, shm_tag: Optional[str],
-        num_procs: int, executor: Executor, prog_config: Tuple[int, int]) -> None:
+def import_dataset(category: str, dataset: Sequence[Path], open_flags: int, memory_limit: int,
+        num_procs: int, spec: DatasetSpec, prog_config: Tuple[int, int],
+        report: MetricsReport, manifest: LoadManifest) -> None:
     for d in dataset:
         if not d.exists():
             print(f"ERROR: Data file \"{str(d)}\" does not exist!", file = stderr)
@@ -390,12 +570,14 @@ def import_dataset(category: str, dataset: Sequence[Path], open_flags: int, shm_
         print(f"+++ Parsing \"{data_name}\" +++")
 
         time_start = perf_counter()
-        line_count = process_data(d, open_flags, shm_tag, num_procs, executor, prog_config)
+        line_count = process_data(d, open_flags, memory_limit, num_procs, spec, prog_config, report,
+            manifest)
         time_elapsed = perf_counter() - time_start
 
         print(f"+++ Finished parsing \"{data_name}\" +++")
         print(f"    (processed {{}} in {duration(time_elapsed)})".format(
             plural_check(line_count, "line", "lines")))
+        print(f"    ({stage_summary(report.snapshots(d.name))})")
 
         total_line_count += line_count
     total_time_elapsed = perf_counter() - total_time_start
@@ -424,6 +606,162 @@ def create_schema(schema_path: Path) -> None:
     print("### Finished creating schema ###")
     print(f"    (processed in {duration(time_elapsed)})")
 
+# CHILD PROCESS: index & analyze a share of the partitions
+def proc_partitions(name: str, partitions: List[Tuple[str, str]], print_lock: Lock) -> None:
+    try:
+        conn, cur = get_connection()
+        for table, partition_name in partitions:
+            prepare_partition(table, partition_name, cur)
+            # Commit each partition on its own, so the others aren't held up by its locks
+            conn.commit()
+    except Exception:
+        with print_lock:
+            print()
+            print(f"Process {name}:")
+            print_exc()
+        exit(1)
+    except:
+        exit(2)
+
+# Index & analyze every partition of the collision tables, several at once. Each partition is
+# independent of the others, so this scales with the number of cores rather than being a single
+# pass over every table like the indexes & ANALYZE of post_load.sql.
+def prepare_partitions(num_procs: int) -> None:
+    print("### Indexing & analyzing partitions ###")
+    time_start = perf_counter()
+
+    conn, cur = get_connection()
+    partitions = list_partitions(cur)
+    conn.close()
+    num_procs = max(1, min(num_procs, len(partitions)))
+    print_lock = LockFactory()
+    # Partitions are sorted largest first, so dealing them out in turn evens out the work
+    pool = tuple(Process(target = proc_partitions, args = (str(i + 1), partitions[i::num_procs],
+        print_lock), daemon = True) for i in range(num_procs))
+    for p in pool:
+        p.start()
+    for p in pool:
+        p.join()
+        if p.exitcode != 0:
+            exit(1)
+
+    time_elapsed = perf_counter() - time_start
+    print("### Finished indexing & analyzing partitions ###")
+    print(f"    (processed {{}} in {duration(time_elapsed)})".format(
+        plural_check(len(partitions), "partition", "partitions")))
+
+# Load the given SQL file of indexes & summary tables into memory & run it once the data is in
+def build_summaries(post_load_path: Path) -> None:
+    if not post_load_path.exists():
+        print(f"ERROR: Post-load file \"{str(post_load_path)}\" does not exist!", file = stderr)
+        exit(1)
+
+    print("### Building indexes & summaries ###")
+    time_start = perf_counter()
+
+    conn, cur = get_connection()
+    with open(post_load_path, "r") as post_load_file:
+        cur.execute(post_load_file.read())
+    conn.commit()
+
+    time_elapsed = perf_counter() - time_start
+    print("### Finished building indexes & summaries ###")
+    print(f"    (processed in {duration(time_elapsed)})")
+
+
+# CHILD PROCESS: aggregate a share of the ranges of collision IDs & send them back
+def proc_verify(name: str, tasks: List[Tuple[str, int, int]], results_pipe: MetricsPipe,
+        print_lock: Lock) -> None:
+    try:
+        conn, cur = get_connection()
+        for task in tasks:
+            results_pipe.send((task[0], table_aggregates(cur, task)))
+        conn.close()
+        results_pipe.close()
+    except Exception:
+        with print_lock:
+            print()
+            print(f"Process {name}:")
+            print_exc()
+        exit(1)
+    except:
+        exit(2)
+
+# Check that every collision table holds exactly the rows the loader's workers wrote, comparing the
+# manifest's counts & checksums with aggregates of each table's ranges of IDs, several at once. Only
+# the ranges that differ are then looked at row by row.
+def verify_load(manifest_path: Path, num_procs: int) -> None:
+    if not manifest_path.exists():
+        print(f"ERROR: Manifest \"{str(manifest_path)}\" does not exist!", file = stderr)
+        exit(1)
+
+    print("### Verifying collision tables ###")
+    time_start = perf_counter()
+
+    manifest = LoadManifest.read(manifest_path)
+    expected = manifest.expected()
+    tasks = verify_tasks(expected, num_procs)
+    num_procs = max(1, min(num_procs, len(tasks)))
+    print_lock = LockFactory()
+    pipes = tuple(Pipe(duplex = False) for i in range(num_procs))
+    pool = tuple(Process(target = proc_verify, args = (str(i + 1), tasks[i::num_procs],
+        pipes[i][1], print_lock), daemon = True) for i in range(num_procs))
+    for p in pool:
+        p.start()
+    # Only the children write to the pipes, so that reading gives EOFError once they're done
+    for receiver, sender in pipes:
+        sender.close()
+    actual: Dict[str, Dict[int, Tuple[int, int]]] = {}
+    for receiver, sender in pipes:
+        while True:
+            try:
+                table, aggregates = receiver.recv()
+            except EOFError:
+                break
+            actual.setdefault(table, {}).update(aggregates)
+    for p in pool:
+        p.join()
+        if p.exitcode != 0:
+            exit(1)
+
+    conn, cur = get_connection()
+    problems = 0
+    for table in sorted(actual):
+        for number, problem in compare_ranges(expected, actual[table]):
+            for line in describe(table, number, problem, range_details(cur, table, number),
+                    manifest.writers(number)):
+                print(line, file = stderr)
+            problems += 1
+    conn.close()
+
+    time_elapsed = perf_counter() - time_start
+    print("### Finished verifying collision tables ###")
+    print(f"    (checked {{}} in each of {{}} in {duration(time_elapsed)}; {{}})".format(
+        plural_check(sum(count for count, checksum in expected.values()), "row", "rows"),
+        plural_check(len(actual), "table", "tables"),
+        plural_check(problems, "bad range", "bad ranges")))
+    if manifest.unchecked() > 0:
+        print(f"    ({plural_check(manifest.unchecked(), 'row', 'rows')} with non-ISO dates "
+            "couldn't be checked)")
+    if problems > 0:
+        exit(1)
+
+
+
+# DuckDB reads & converts the CSVs itself, in parallel, so none of the machinery above is needed
+def load_embedded_database(database_path: Path, data_dir: Path, memory_limit_mb: int) -> None:
+    print(f"### Building embedded database \"{str(database_path)}\" ###")
+    time_start = perf_counter()
+    try:
+        timings = load_embedded(database_path, data_dir, (STATION_SPEC, WEATHER_SPEC, COLLISION_SPEC),
+            memory_limit_mb = memory_limit_mb)
+    except (RuntimeError, ValueError) as e:
+        print(f"ERROR: {e}", file = stderr)
+        exit(1)
+    for step, seconds in timings.items():
+        print(f"    {step}: {duration(seconds)}")
+    print(f"### Finished in {duration(perf_counter() - time_start)} ###")
+
 
 
 ##### MAIN #####
@@ -432,6 +770,25 @@ def main() -> None:
     # Note that this is a Path object, not a string of a path
     this_dir = Path(__file__).parent
 
+    parser = ArgumentParser(description = "Load the weather & collision datasets into the database.")
+    parser.add_argument("--embedded", type = Path, metavar = "PATH", help = "build an embedded "
+        "DuckDB database file from the CSVs instead of loading Postgres (needs pip install duckdb)")
+    parser.add_argument("--manifest", type = Path, default = this_dir.joinpath("load_manifest.json"),
+        help = "where the loader writes, & the verifier reads, each worker's collision checksums")
+    parser.add_argument("--verify", action = "store_true", help = "only check the loaded "
+        "collision tables against the manifest of the last load")
+    add_arguments(parser)
+    add_memory_argument(parser)
+    args = parser.parse_args()
+    if args.embedded is not None:
+        load_embedded_database(args.embedded, this_dir.joinpath("datasets"), args.memory_limit)
+        return
+    if args.verify:
+        verify_load(args.manifest, os.cpu_count() or 1)
+        return
+    report = report_from_args(args)
+    manifest = LoadManifest()
+
     open_flags = os.O_RDONLY
     # A few things differ between operating systems
     if WINDOWS:
@@ -440,12 +797,11 @@ def main() -> None:
         # Memory mapping and low-level (relatively) file opening have different implementations
         # between Windows and Unix-based systems.
         #assert hasattr(os, "O_BINARY")
-        open_flags |= os.O_BINARY | os.O_RANDOM
-        shm_tag = f"load_data_mmap_{os.getpid()}"
-    else:
-        if DEBUG:
-            print("<DEBUG>Not running on Windows")
-        shm_tag = None
+        # Every file is read from start to end, which Windows caches for accordingly
+        open_flags |= os.O_BINARY | os.O_SEQUENTIAL
+    elif DEBUG:
+        print("<DEBUG>Not running on Windows")
+    memory_limit = args.memory_limit << 20
 
     ### SET UP TABLES ###
 
@@ -463,13 +819,36 @@ def main() -> None:
     elif DEBUG:
         print(f"<DEBUG>CPU has {num_cores} cores", end = "\n\n")
 
+    # The station list is tiny, so it isn't worth splitting between processes
+    station_data = data_dir.joinpath("stations.csv")
+    if station_data.exists():
+        import_dataset("station", (station_data,), open_flags, memory_limit, 1, STATION_SPEC,
+            (32, 0 if DEBUG else -1), report, manifest)
+    else:
+        print(f"No station list at \"{str(station_data)}\"; using {DEFAULT_STATION[1]} only")
+        conn, cur = get_connection()
+        insert_station_line([DEFAULT_STATION[0], DEFAULT_STATION[1], str(DEFAULT_STATION[2]),
+            str(DEFAULT_STATION[3])], cur)
+        conn.commit()
+    print()
     weather_data = (data_dir.joinpath("weather.csv"),)
-    import_dataset("weather", weather_data, open_flags, shm_tag, num_cores, insert_weather_line,
-        (32, 0 if DEBUG else -1))
+    import_dataset("weather", weather_data, open_flags, memory_limit, num_cores, WEATHER_SPEC,
+        (32, 0 if DEBUG else -1), report, manifest)
     print()
     collision_data = (data_dir.joinpath("Motor_Vehicle_Collisions_-_Crashes.csv"),)
-    import_dataset("collision", collision_data, open_flags, shm_tag, num_cores,
-        insert_collision_line, (48, 2 if DEBUG else 1))
+    import_dataset("collision", collision_data, open_flags, memory_limit, num_cores,
+        COLLISION_SPEC, (48, 2 if DEBUG else 1), report, manifest)
+    report.write()
+    manifest.write(args.manifest)
+    print()
+
+    ## BUILD INDEXES & SUMMARIES ##
+
+    prepare_partitions(num_cores)
+    print()
+    build_summaries(this_dir.joinpath("post_load.sql"))
+    print()
+    verify_load(args.manifest, num_cores)
 
 if __name__ == "__main__":
     main()
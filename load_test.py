@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from math import ceil
+
+import aiohttp
+
+# Requests to pick from: a mix of cheap lookups, ranges and rankings. Dates are filled in at random.
+request_templates = [
+    "/crashes/date?date={date}",
+    "/weather/date?date={date}",
+    "/crashes/series?start={start}&end={end}&bucket=month",
+    "/crashes/hourly?include=WT16",
+    "/crashes/weather?include=WT01,WT16&exclude=WT18",
+    "/crashes/borough",
+    "/rankings/most-common-weather",
+    "/rankings/crashes",
+    "/rankings/deaths?group=pedestrians",
+    "/rankings/injuries?group=cyclists",
+]
+
+
+def percentile(ordered, pct):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    return ordered[min(len(ordered) - 1, max(0, ceil(pct / 100 * len(ordered)) - 1))]
+
+
+def random_request(rng, first_year, last_year):
+    """
+    Fills in one of the request templates with random dates
+    """
+    year = rng.randint(first_year, last_year)
+    day = "{}/{:02d}/{:02d}".format(year, rng.randint(1, 12), rng.randint(1, 28))
+    return rng.choice(request_templates).format(date=day, start="{}/01/01".format(year),
+                                                end="{}/12/31".format(year))
+
+
+async def run_level(base_url, concurrency, duration, rng, first_year, last_year):
+    """
+    Keeps the given number of requests in flight for a while
+    :return: A dict of the level's throughput, latencies and error count
+    """
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def client(session):
+        nonlocal errors
+        while time.monotonic() < deadline:
+            url = base_url + random_request(rng, first_year, last_year)
+            start = time.perf_counter()
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors += 1
+                        continue
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.monotonic()
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        elapsed = time.monotonic() - started
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99), 2) if latencies else None,
+    }
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    results = []
+    for concurrency in args.concurrency:
+        results.append(await run_level(args.url.rstrip("/"), concurrency, args.duration, rng,
+                                       args.first_year, args.last_year))
+        result = results[-1]
+        print("concurrency {:>4}: {:>8} req/s  p50 {:>8} ms  p99 {:>8} ms  ({} requests, {} errors)".format(
+            result["concurrency"], result["throughput"], result["p50_ms"], result["p99_ms"],
+            result["requests"], result["errors"]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure throughput and latency of server.py at "
+                                                 "increasing concurrency.")
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run each level for")
+    parser.add_argument("--first-year", type=int, default=2013)
+    parser.add_argument("--last-year", type=int, default=2019)
+    parser.add_argument("--seed", type=int, default=4380)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# metrics.py
+#
+# Counters & per-stage timings for the loaders. Every worker keeps its own WorkerMetrics, which is
+# cheap enough to update for every row, and hands snapshots of it to a MetricsReport that writes
+# them out as JSON or in the Prometheus text format, both periodically and at the end of a run.
+
+from typing import Any, Dict, List, Optional, Tuple
+from pathlib import Path
+from argparse import ArgumentParser, Namespace
+from collections import Counter
+from time import perf_counter
+import threading
+import json
+import sys
+import os
+
+# The stages every row goes through, in order. Converting covers everything an executor does other
+# than waiting on cur.execute(), e.g. numeric() & integer().
+STAGES = ("read", "tokenize", "convert", "execute", "commit")
+
+# Type alias
+Snapshot = Dict[str, Any]
+
+
+
+##### Per-worker collection #####
+
+# Samples the stack of the thread that created it every few milliseconds. Much cheaper than tracing
+# every call, and still enough to see which functions the time goes to.
+class SamplingProfiler:
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{Path(frame.f_code.co_filename).name}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            # Outermost call first, as in the "folded" format flame graph tools read
+            self.samples[";".join(reversed(stack))] += 1
+
+    # The most sampled stacks, along with their sample counts
+    def top(self, count: int = 50) -> Dict[str, int]:
+        return dict(self.samples.most_common(count))
+
+class WorkerMetrics:
+    def __init__(self, dataset: str, worker: str, profile_interval: Optional[float] = None) -> None:
+        self.dataset = dataset
+        self.worker = worker
+        # Updated directly by the loaders' hot loops
+        self.seconds = dict.fromkeys(STAGES, 0.)
+        self.rows = 0
+        self.bytes = 0
+        self.errors = 0
+        self.started = perf_counter()
+        self.profiler = None
+        if profile_interval is not None:
+            self.profiler = SamplingProfiler(profile_interval)
+            self.profiler.start()
+
+    def snapshot(self) -> Snapshot:
+        snapshot = {"dataset": self.dataset, "worker": self.worker, "rows": self.rows,
+            "bytes": self.bytes, "errors": self.errors,
+            "elapsed_seconds": perf_counter() - self.started, "seconds": dict(self.seconds)}
+        if self.profiler is not None:
+            snapshot["profile"] = self.profiler.top()
+        return snapshot
+
+    def close(self) -> None:
+        if self.profiler is not None:
+            self.profiler.stop()
+
+
+
+##### Reporting #####
+
+# Sum the counters & stage timings of several snapshots
+def totals(snapshots: List[Snapshot]) -> Snapshot:
+    return {"workers": len(snapshots), "rows": sum(s["rows"] for s in snapshots),
+        "bytes": sum(s["bytes"] for s in snapshots), "errors": sum(s["errors"] for s in snapshots),
+        "seconds": {stage: sum(s["seconds"][stage] for s in snapshots) for stage in STAGES}}
+
+# One line summary of where the time went, e.g. for printing after each file
+def stage_summary(snapshots: List[Snapshot]) -> str:
+    total = totals(snapshots)
+    stages = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in total["seconds"].items())
+    return f"{stages} across {total['workers']} worker{'s' if total['workers'] != 1 else ''}; " \
+        f"{total['errors']} skipped"
+
+def prometheus_text(snapshots: List[Snapshot]) -> str:
+    def labels(snapshot: Snapshot, **extra: str) -> str:
+        pairs = {"dataset": snapshot["dataset"], "worker": snapshot["worker"], **extra}
+        return ",".join(f'{name}="{value}"' for name, value in pairs.items())
+
+    lines = ["# HELP loader_stage_seconds_total Time spent in each stage of loading rows.",
+        "# TYPE loader_stage_seconds_total counter"]
+    for snapshot in snapshots:
+        for stage in STAGES:
+            lines.append(f"loader_stage_seconds_total{{{labels(snapshot, stage = stage)}}} "
+                f"{snapshot['seconds'][stage]}")
+    for name, key, kind, description in (
+            ("loader_rows_total", "rows", "counter", "Rows loaded."),
+            ("loader_bytes_total", "bytes", "counter", "Bytes of input read."),
+            ("loader_errors_total", "errors", "counter", "Rows skipped as malformed."),
+            ("loader_elapsed_seconds", "elapsed_seconds", "gauge", "Time since the worker started.")):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for snapshot in snapshots:
+            lines.append(f"{name}{{{labels(snapshot)}}} {snapshot[key]}")
+    return "\n".join(lines) + "\n"
+
+# Collects the latest snapshot of every worker & writes them to a file, in the Prometheus text
+# format if its name ends in .prom, as JSON otherwise. Without a path, nothing is written, but the
+# snapshots are still kept for stage_summary().
+class MetricsReport:
+    def __init__(self, path: Optional[Path] = None, interval: float = 10.,
+            profile_interval: Optional[float] = None) -> None:
+        self.path = path
+        self.interval = interval
+        self.profile_interval = profile_interval
+        self.workers: Dict[Tuple[str, str], Snapshot] = {}
+        self._last_write = perf_counter()
+
+    def update(self, snapshot: Snapshot) -> None:
+        self.workers[(snapshot["dataset"], snapshot["worker"])] = snapshot
+        if perf_counter() - self._last_write >= self.interval:
+            self.write()
+
+    def snapshots(self, dataset: Optional[str] = None) -> List[Snapshot]:
+        return [s for s in self.workers.values() if dataset is None or s["dataset"] == dataset]
+
+    def write(self) -> None:
+        self._last_write = perf_counter()
+        if self.path is None:
+            return
+        snapshots = self.snapshots()
+        if self.path.suffix == ".prom":
+            text = prometheus_text(snapshots)
+        else:
+            text = json.dumps({"totals": totals(snapshots), "workers": snapshots}, indent = 2)
+        # Write to the side & swap it in, so that whatever is watching the file never sees half of it
+        temporary_path = self.path.with_name(self.path.name + ".tmp")
+        temporary_path.write_text(text)
+        os.replace(temporary_path, self.path)
+
+# Command line options shared by both loaders
+def add_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument("--metrics", type = Path, help = "write per-stage timings & counters to "
+        "this file during & after the run (Prometheus text if it ends in .prom, JSON otherwise)")
+    parser.add_argument("--metrics-interval", type = float, default = 10.,
+        help = "seconds between updates of the metrics file")
+    parser.add_argument("--profile", type = float, nargs = "?", const = 0.005, metavar = "SECONDS",
+        help = "also sample each worker's stack this often (default 0.005) & include the most "
+        "common stacks in the JSON metrics")
+
+def report_from_args(args: Namespace) -> MetricsReport:
+    return MetricsReport(args.metrics, args.metrics_interval, args.profile)
@@ -0,0 +1,162 @@
+-- Indexes and summary tables, built once all of the data has been loaded. Building them in one go
+-- afterwards is much faster than keeping them up to date row by row during the import.
+
+-- Crash Dates
+
+-- Crashes aren't stored in date order, so a BRIN index would be of little use here. The loader
+-- builds these on each partition beforehand (see PARTITION_INDEXES), which are then adopted here.
+CREATE INDEX IF NOT EXISTS crash_date_idx ON Crash ("date");
+CREATE INDEX IF NOT EXISTS crash_station_date_idx ON Crash (station, "date");
+
+-- Both summaries are rebuilt from scratch on every load, so they always match the crash tables
+TRUNCATE CrashCube;
+INSERT INTO CrashCube
+SELECT c0."date", extract(hour FROM c0."time"), COALESCE(l0.borough, ''), c0.station, COUNT(*),
+    SUM(i0.total), SUM(i0.pedestrians), SUM(i0.cyclists), SUM(i0.motorists),
+    SUM(d0.total), SUM(d0.pedestrians), SUM(d0.cyclists), SUM(d0.motorists)
+FROM Crash c0
+JOIN Location l0 ON l0.id = c0.id AND l0."date" = c0."date"
+JOIN Injuries i0 ON i0.id = c0.id AND i0."date" = c0."date"
+JOIN Deaths d0 ON d0.id = c0.id AND d0."date" = c0."date"
+WHERE c0."date" IS NOT NULL
+GROUP BY c0."date", extract(hour FROM c0."time"), COALESCE(l0.borough, ''), c0.station;
+
+CREATE INDEX IF NOT EXISTS crashcube_date_idx ON CrashCube ("date", hour, borough);
+
+TRUNCATE CrashDaily;
+INSERT INTO CrashDaily
+SELECT "date", borough, station, SUM(crashes),
+    SUM(injured_total), SUM(injured_pedestrians), SUM(injured_cyclists), SUM(injured_motorists),
+    SUM(killed_total), SUM(killed_pedestrians), SUM(killed_cyclists), SUM(killed_motorists)
+FROM CrashCube
+GROUP BY "date", borough, station;
+
+-- Crash Facts
+
+TRUNCATE CrashFact;
+TRUNCATE VehicleFactorStats;
+-- The joined crashes are read once, both into CrashFact and to total the vehicle types & contributing
+-- factors of each weather type, so the second doesn't need a pass over the collision tables of its own
+WITH facts AS MATERIALIZED (
+    SELECT c0."time", l0.latitude, l0.longitude, c0.id, c0."date", l0.cell, w0.mask, p0.precip,
+        p0.snow, p0.snowdepth, n0.avgwind, t0.maxtemp, t0.mintemp,
+        i0.total AS injured_total, i0.pedestrians AS injured_pedestrians,
+        i0.cyclists AS injured_cyclists, i0.motorists AS injured_motorists,
+        d0.total AS killed_total, d0.pedestrians AS killed_pedestrians,
+        d0.cyclists AS killed_cyclists, d0.motorists AS killed_motorists,
+        COALESCE(l0.borough, '') AS borough, c0.station,
+        v0.type_vehicle1, v0.type_vehicle2, v0.type_vehicle3, v0.type_vehicle4, v0.type_vehicle5,
+        v0.contrib_factor1, v0.contrib_factor2, v0.contrib_factor3, v0.contrib_factor4,
+        v0.contrib_factor5
+    FROM Crash c0
+    JOIN Location l0 ON l0.id = c0.id AND l0."date" = c0."date"
+    JOIN Injuries i0 ON i0.id = c0.id AND i0."date" = c0."date"
+    JOIN Deaths d0 ON d0.id = c0.id AND d0."date" = c0."date"
+    LEFT JOIN VehiclesFactors v0 ON v0.id = c0.id AND v0."date" = c0."date"
+    LEFT JOIN Temperature t0 ON t0.station = c0.station AND t0."date" = c0."date"
+    LEFT JOIN Precipitation p0 ON p0.station = c0.station AND p0."date" = c0."date"
+    LEFT JOIN Wind n0 ON n0.station = c0.station AND n0."date" = c0."date"
+    LEFT JOIN Wtypes w0 ON w0.station = c0.station AND w0."date" = c0."date"
+), inserted AS (
+    INSERT INTO CrashFact
+    SELECT "time", latitude, longitude, id, "date", cell, mask, precip, snow, snowdepth, avgwind,
+        maxtemp, mintemp, injured_total, injured_pedestrians, injured_cyclists, injured_motorists,
+        killed_total, killed_pedestrians, killed_cyclists, killed_motorists, borough, station
+    FROM facts
+    ORDER BY "date"
+)
+-- Every crash counts once for each distinct vehicle type & factor it lists, both in any weather
+-- and in each weather type of its day
+INSERT INTO VehicleFactorStats
+SELECT v0.kind, w0.weather, v0.name, COUNT(*), SUM(f0.injured_total), SUM(f0.killed_total)
+FROM facts f0
+CROSS JOIN LATERAL (
+    SELECT DISTINCT x0.kind, upper(x0.name)
+    FROM (VALUES ('vehicle', f0.type_vehicle1), ('vehicle', f0.type_vehicle2),
+        ('vehicle', f0.type_vehicle3), ('vehicle', f0.type_vehicle4), ('vehicle', f0.type_vehicle5),
+        ('factor', f0.contrib_factor1), ('factor', f0.contrib_factor2),
+        ('factor', f0.contrib_factor3), ('factor', f0.contrib_factor4),
+        ('factor', f0.contrib_factor5)) x0(kind, name)
+    WHERE x0.name <> ''
+) v0(kind, name)
+CROSS JOIN LATERAL (
+    SELECT 0
+    UNION ALL
+    SELECT 1 << b0.bit FROM generate_series(0, 12) b0(bit) WHERE f0.mask & (1 << b0.bit) <> 0
+) w0(weather)
+GROUP BY v0.kind, w0.weather, v0.name;
+
+-- Unlike Crash, the facts are written in date order, so a BRIN index covers them in a few pages
+CREATE INDEX IF NOT EXISTS crashfact_date_idx ON CrashFact USING BRIN ("date");
+CREATE INDEX IF NOT EXISTS crashfact_cell_idx ON CrashFact (cell);
+
+-- Every date keeps 5% of its crashes (at least one), so every day is represented in estimates
+TRUNCATE CrashSample;
+INSERT INTO CrashSample
+SELECT "date", stratum_size, mask, injured_total, injured_pedestrians, injured_cyclists,
+    injured_motorists, killed_total, killed_pedestrians, killed_cyclists, killed_motorists, borough
+FROM (
+    SELECT f0.*, COUNT(*) OVER (PARTITION BY f0."date") AS stratum_size,
+        row_number() OVER (PARTITION BY f0."date" ORDER BY random()) AS drawn
+    FROM CrashFact f0
+    WHERE f0."date" IS NOT NULL
+) s0
+WHERE drawn <= ceil(stratum_size * 0.05)
+ORDER BY "date";
+
+-- Crash Locations
+
+CREATE INDEX IF NOT EXISTS location_cell_idx ON Location (cell);
+
+TRUNCATE CellDaily;
+INSERT INTO CellDaily
+SELECT c0."date", l0.cell, c0.station, COUNT(*), SUM(i0.total), SUM(d0.total)
+FROM Crash c0
+JOIN Location l0 ON l0.id = c0.id AND l0."date" = c0."date"
+JOIN Injuries i0 ON i0.id = c0.id AND i0."date" = c0."date"
+JOIN Deaths d0 ON d0.id = c0.id AND d0."date" = c0."date"
+WHERE c0."date" IS NOT NULL AND l0.cell IS NOT NULL
+GROUP BY c0."date", l0.cell, c0.station;
+
+-- Intersections
+
+-- One pass over the crashes, each counted once for its borough & once for every borough, both in
+-- any weather and in each weather type of its day
+TRUNCATE IntersectionStats;
+INSERT INTO IntersectionStats
+SELECT street_a, street_b, weather, COUNT(*), SUM(injured_total), SUM(killed_total),
+    COALESCE(borough, '*')
+FROM (
+    SELECT LEAST(l0.on_street, l0.cross_street) AS street_a,
+        GREATEST(l0.on_street, l0.cross_street) AS street_b, w0.weather, f0.injured_total,
+        f0.killed_total, f0.borough
+    FROM Location l0
+    JOIN CrashFact f0 ON f0.id = l0.id AND f0."date" = l0."date"
+    CROSS JOIN LATERAL (
+        SELECT 0
+        UNION ALL
+        SELECT 1 << b0.bit FROM generate_series(0, 12) b0(bit) WHERE f0.mask & (1 << b0.bit) <> 0
+    ) w0(weather)
+    WHERE l0.on_street <> l0.cross_street
+) i0
+GROUP BY GROUPING SETS ((street_a, street_b, weather, borough), (street_a, street_b, weather));
+
+-- Each top-K query reads the first K entries of one of these
+CREATE INDEX IF NOT EXISTS intersection_crashes_idx ON IntersectionStats (borough, weather, crashes DESC);
+CREATE INDEX IF NOT EXISTS intersection_injured_idx ON IntersectionStats (borough, weather, injured DESC);
+CREATE INDEX IF NOT EXISTS intersection_killed_idx ON IntersectionStats (borough, weather, killed DESC);
+
+-- Weather Types
+
+-- Lets combination queries find matching days with an index-only scan
+CREATE INDEX IF NOT EXISTS wtypes_mask_idx ON Wtypes (mask, "date", station);
+
+-- Data Generation
+
+TRUNCATE DataGeneration;
+INSERT INTO DataGeneration VALUES (txid_current(), now());
+
+-- The partitions of the collision tables have already been analyzed by the loader, one process per
+-- partition, so only the other tables are left
+ANALYZE Station, Street, Weather, Wind, Precipitation, Temperature, Wtypes, CrashFact, CrashSample,
+    CrashCube, CrashDaily, CellDaily, IntersectionStats, VehicleFactorStats, DataGeneration;
@@ -0,0 +1,179 @@
+# reconcile.py
+#
+# Checks that a load put exactly one row of every collision it parsed into each of the five collision
+# tables, without counting whole tables or joining them to each other. Every worker of the loader
+# keeps a row count & checksum of the collisions it wrote for each range of IDs, which the parent
+# gathers into a manifest; afterwards each table gives the same aggregates for a range of IDs from
+# its primary key alone, and any range whose numbers differ is looked at in detail.
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from pathlib import Path
+from datetime import date
+import json
+from psycopg2.extensions import cursor as Cursor
+
+# The tables every parsed collision has exactly one row in
+COLLISION_TABLES = ("crash", "location", "injuries", "deaths", "vehiclesfactors")
+# Collision IDs are checked in ranges of 2**RANGE_BITS, small enough that a bad range can be looked
+# at row by row and large enough that the manifest of the whole dataset stays around a thousand ranges
+RANGE_BITS = 12
+# Each row's checksum is a hash of its ID & date modulo a prime under 2**31, so that every step fits
+# in a BIGINT on the server. Checksums are summed, so the order rows were written in doesn't matter.
+MODULUS = 2147483647
+ID_FACTOR = 1000003
+MIX_FACTOR = 1103515245
+# The same as row_checksum(), in SQL
+CHECKSUM_SQL = (f'((CAST(id AS BIGINT) % {MODULUS} + {MODULUS}) % {MODULUS} * {ID_FACTOR} '
+    f'+ ("date" - DATE \'0001-01-01\')) % {MODULUS} * {MIX_FACTOR} % {MODULUS}')
+# Most IDs listed for each bad range
+MAX_LISTED_IDS = 20
+
+# Type aliases
+Aggregates = Dict[int, Tuple[int, int]]
+Task = Tuple[str, int, int]
+
+def row_checksum(collision_id: int, day: date) -> int:
+    # Days since 0001-01-01, like "date" - DATE '0001-01-01'
+    return ((collision_id % MODULUS)*ID_FACTOR + day.toordinal() - 1) % MODULUS*MIX_FACTOR % MODULUS
+
+def id_range(range_number: int) -> Tuple[int, int]:
+    return range_number << RANGE_BITS, ((range_number + 1) << RANGE_BITS) - 1
+
+
+
+##### Per-worker collection #####
+
+# Row counts & checksums of the collisions one worker wrote, by range of IDs. Only sent to the
+# parent once the worker has committed, so it never counts rows that were rolled back.
+class ChunkChecksums:
+    def __init__(self, dataset: str, worker: str, file_start: int = 0, file_end: int = 0) -> None:
+        self.dataset = dataset
+        self.worker = worker
+        self.file_start = file_start
+        self.file_end = file_end
+        self.ranges: Dict[int, List[int]] = {}
+        self.rows = 0
+        # Rows whose date isn't in ISO format, which Postgres might still have accepted but whose
+        # checksum can't be worked out here
+        self.unchecked = 0
+
+    def add(self, collision_id: int, c_date: str) -> None:
+        try:
+            day = date.fromisoformat(c_date)
+        except ValueError:
+            self.unchecked += 1
+            return
+        counts = self.ranges.setdefault(collision_id >> RANGE_BITS, [0, 0])
+        counts[0] += 1
+        counts[1] += row_checksum(collision_id, day)
+        self.rows += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"dataset": self.dataset, "worker": self.worker, "file_start": self.file_start,
+            "file_end": self.file_end, "rows": self.rows, "unchecked": self.unchecked,
+            "ranges": {str(number): counts for number, counts in sorted(self.ranges.items())}}
+
+# Every worker's checksums from a load, as written to & read back from a JSON file
+class LoadManifest:
+    def __init__(self, chunks: Optional[List[Dict[str, Any]]] = None) -> None:
+        self.chunks = chunks if chunks is not None else []
+
+    def add(self, chunk: Dict[str, Any]) -> None:
+        self.chunks.append(chunk)
+
+    def write(self, path: Path) -> None:
+        path.write_text(json.dumps({"range_bits": RANGE_BITS, "chunks": self.chunks}, indent = 1))
+
+    @classmethod
+    def read(cls, path: Path) -> "LoadManifest":
+        manifest = json.loads(path.read_text())
+        if manifest["range_bits"] != RANGE_BITS:
+            raise ValueError(f"manifest uses ranges of 2**{manifest['range_bits']} IDs, "
+                f"not 2**{RANGE_BITS}")
+        return cls(manifest["chunks"])
+
+    # What every collision table should hold, summed over every worker
+    def expected(self) -> Aggregates:
+        totals: Dict[int, List[int]] = {}
+        for chunk in self.chunks:
+            for number, (count, checksum) in chunk["ranges"].items():
+                counts = totals.setdefault(int(number), [0, 0])
+                counts[0] += count
+                counts[1] += checksum
+        return {number: (count, checksum) for number, (count, checksum) in totals.items()}
+
+    # The workers that wrote collisions in a range, to tell which part of the file it came from
+    def writers(self, number: int) -> List[str]:
+        return [f"{chunk['dataset']} bytes {chunk['file_start']}-{chunk['file_end']} "
+            f"(worker {chunk['worker']})" for chunk in self.chunks if str(number) in chunk["ranges"]]
+
+    def unchecked(self) -> int:
+        return sum(chunk["unchecked"] for chunk in self.chunks)
+
+
+
+##### Server-side aggregates #####
+
+# Split the ranges of IDs between the given number of tasks per table. The first & last task of each
+# table are open ended, so rows outside every expected range are still seen.
+def verify_tasks(expected: Aggregates, num_tasks: int) -> List[Task]:
+    numbers = sorted(expected)
+    if len(numbers) == 0:
+        numbers = [0]
+    first, last = numbers[0], numbers[-1] + 1
+    step = max(1, -(-(last - first)//num_tasks))
+    bounds = list(range(first, last, step)) + [last]
+    bounds[0], bounds[-1] = -(1 << (31 - RANGE_BITS)), 1 << (31 - RANGE_BITS)
+    return [(table, bounds[i], bounds[i + 1]) for table in COLLISION_TABLES
+        for i in range(len(bounds) - 1)]
+
+# Row count & checksum of every range of IDs in [first, last) of a table. The ranges are read from
+# the tables' primary keys, one partition after another, so no table is scanned whole or joined.
+def table_aggregates(cur: Cursor, task: Task) -> Aggregates:
+    table, first, last = task
+    cur.execute(f"SELECT id >> {RANGE_BITS}, COUNT(*), SUM({CHECKSUM_SQL}) FROM {table} "
+        "WHERE id >= %s AND id < %s GROUP BY 1", (first << RANGE_BITS, last << RANGE_BITS))
+    return {number: (count, int(checksum)) for number, count, checksum in cur.fetchall()}
+
+# Every range of a table whose aggregates differ from the manifest's, as (range, problem)
+def compare_ranges(expected: Aggregates, actual: Aggregates) -> List[Tuple[int, str]]:
+    problems = []
+    for number in sorted(set(expected) | set(actual)):
+        (expected_count, expected_sum), (count, checksum) = \
+            expected.get(number, (0, 0)), actual.get(number, (0, 0))
+        if count < expected_count:
+            problems.append((number, f"{expected_count - count} missing of {expected_count} rows"))
+        elif count > expected_count:
+            problems.append((number, f"{count - expected_count} extra rows on top of "
+                f"{expected_count}"))
+        elif checksum != expected_sum:
+            problems.append((number, f"{count} rows, but not the ones that were written"))
+    return problems
+
+# IDs in one bad range of a table that it holds more than once, and that other collision tables hold
+# but it doesn't. Only the rows of that range are read.
+def range_details(cur: Cursor, table: str, number: int) -> Dict[str, List[int]]:
+    first, last = id_range(number)
+    cur.execute(f"SELECT id FROM {table} WHERE id BETWEEN %s AND %s GROUP BY id "
+        f"HAVING COUNT(*) > 1 ORDER BY id LIMIT {MAX_LISTED_IDS}", (first, last))
+    duplicated = [row[0] for row in cur.fetchall()]
+    others = " UNION ".join(f"SELECT id FROM {other} WHERE id BETWEEN %(first)s AND %(last)s"
+        for other in COLLISION_TABLES if other != table)
+    cur.execute(f"SELECT id FROM ({others}) o0 EXCEPT SELECT id FROM {table} "
+        f"WHERE id BETWEEN %(first)s AND %(last)s ORDER BY id LIMIT {MAX_LISTED_IDS}",
+        {"first": first, "last": last})
+    missing = [row[0] for row in cur.fetchall()]
+    return {"duplicated": duplicated, "missing": missing}
+
+# Describe each bad range, e.g. to print after verifying
+def describe(table: str, number: int, problem: str, details: Dict[str, List[int]],
+        writers: Iterable[str]) -> List[str]:
+    first, last = id_range(number)
+    lines = [f"{table}: IDs {first}-{last}: {problem}"]
+    for kind, ids in details.items():
+        if ids:
+            lines.append(f"    {kind}: {', '.join(str(i) for i in ids)}"
+                f"{', ...' if len(ids) == MAX_LISTED_IDS else ''}")
+    for writer in writers:
+        lines.append(f"    written by {writer}")
+    return lines
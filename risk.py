@@ -0,0 +1,167 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from analytics import count_columns
+from database import check_group, typecodes, weather_mask
+
+# The measures a rate can be taken of, and the count column each one reads for a group
+measures = {
+    "crashes": lambda group: "crashes",
+    "injuries": lambda group: "injured_" + group,
+    "deaths": lambda group: "killed_" + group,
+}
+
+
+class WeatherRisk:
+    """
+    Normalizes the weather rankings by how often each weather type occurs. Every rate is a count
+    per weather-day (one station on one date), compared with the same rate on clear days (no
+    weather types at all) as a rate ratio. Confidence intervals come from resampling the days with
+    replacement; each batch of resamples is a single matrix product over the per-day arrays of a
+    WeatherAnalytics, and batches run on several threads at once.
+    """
+
+    def __init__(self, analytics, resamples=2000, confidence=0.95, workers=4, batch_size=250, seed=None):
+        """
+        Constructor for the statistics
+        :param analytics: The WeatherAnalytics holding the per-day arrays
+        :param resamples: How many bootstrap resamples to draw
+        :param confidence: The coverage of the confidence intervals, e.g. 0.95
+        :param workers: How many batches of resamples may run at the same time
+        :param batch_size: How many resamples are drawn in each batch
+        :param seed: Seed for the resamples, so that intervals can be reproduced
+        """
+        if not 0 < confidence < 1:
+            raise ValueError("Confidence must be between 0 and 1")
+        self._analytics = analytics
+        self._resamples = resamples
+        self._confidence = confidence
+        self._workers = workers
+        self._batch_size = batch_size
+        self._seed = seed
+
+    def _days(self, measure, group):
+        """
+        Gathers the days the collision data covers
+        :param measure: One of "crashes", "injuries" or "deaths"
+        :param group: The group whose injuries or deaths are counted
+        :return: The weather bitmask and the measured count of each day
+        """
+        if measure not in measures:
+            raise ValueError("Unknown measure: {}".format(measure))
+        group = check_group(group)
+
+        days = self._analytics.snapshot()
+        dates, masks, counts = days.dates, days.masks, days.counts
+        # Days before or after the collision data would look like days without any crashes
+        has_crashes = counts[:, 0] > 0
+        if not has_crashes.any():
+            raise ValueError("There is no collision data to measure")
+        covered = (dates >= dates[has_crashes].min()) & (dates <= dates[has_crashes].max())
+        values = counts[covered, count_columns.index(measures[measure](group))]
+        return np.asarray(masks[covered]), values.astype(np.float64)
+
+    def _resample(self, selections, values):
+        """
+        Draws the bootstrap resamples of the rate on each selection of days
+        :param selections: A days x selections matrix, 1 where a day belongs to a selection
+        :param values: The measured count of each day
+        :return: A resamples x selections matrix of rates (NaN where a resample had no such days)
+        """
+        # Days in each selection, then the measure summed over them, for all selections at once
+        columns = np.hstack([selections, selections*values[:, None]])
+        day_count = len(values)
+        batches = [min(self._batch_size, self._resamples - start)
+                   for start in range(0, self._resamples, self._batch_size)]
+        seeds = np.random.SeedSequence(self._seed).spawn(len(batches))
+
+        def batch(size, seed):
+            # How many times each day was drawn in each resample
+            weights = np.random.default_rng(seed).multinomial(day_count, np.full(day_count, 1/day_count),
+                                                              size=size)
+            sums = weights.astype(np.float64) @ columns
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return sums[:, selections.shape[1]:] / sums[:, :selections.shape[1]]
+
+        # NumPy releases the GIL for the matrix products, so threads are enough
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            return np.vstack(list(executor.map(batch, batches, seeds)))
+
+    def _interval(self, samples):
+        """
+        Percentile confidence interval of each column of bootstrap samples
+        :return: [low, high] pairs, None where no resample had a value
+        """
+        tail = (1 - self._confidence) / 2 * 100
+        intervals = []
+        for column in samples.T:
+            column = column[np.isfinite(column)]
+            if len(column) == 0:
+                intervals.append(None)
+            else:
+                intervals.append([float(np.percentile(column, tail)), float(np.percentile(column, 100 - tail))])
+        return intervals
+
+    def _rates(self, selections, values):
+        """
+        Rates, rate ratios against clear days, and their intervals for each selection of days
+        :param selections: A days x selections matrix whose first column is the clear days
+        :param values: The measured count of each day
+        :return: One dict per selection after the clear days, plus the dict of the clear days
+        """
+        days = selections.sum(axis=0)
+        totals = selections.T @ values
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rates = totals / days
+            ratios = rates / rates[0]
+            samples = self._resample(selections, values)
+            sample_ratios = samples / samples[:, :1]
+        rate_intervals = self._interval(samples)
+        ratio_intervals = self._interval(sample_ratios)
+
+        results = []
+        for i in range(selections.shape[1]):
+            results.append({"days": int(days[i]), "total": int(totals[i]),
+                            "per_day": float(rates[i]) if days[i] else None,
+                            "per_day_ci": rate_intervals[i],
+                            "rate_ratio": float(ratios[i]) if np.isfinite(ratios[i]) else None,
+                            "rate_ratio_ci": ratio_intervals[i]})
+        return results[1:], results[0]
+
+    def weather_rates(self, measure="crashes", group="total"):
+        """
+        The rate of a measure per weather-day for every weather type, against clear days
+        :param measure: One of "crashes", "injuries" or "deaths"
+        :param group: The group whose injuries or deaths are counted
+        :return: A dict with the "clear" days' rate and a "weather" list of rates, one dict per
+        weather type holding its "code", "days", "total", "per_day" and "rate_ratio", the last two
+        with a [low, high] "_ci", in descending order of rate ratio
+        """
+        masks, values = self._days(measure, group)
+        flags = (masks[:, None] >> np.arange(len(typecodes))) & 1
+        selections = np.hstack([(masks == 0)[:, None], flags]).astype(np.float64)
+        weather, clear = self._rates(selections, values)
+        for code, rate in zip(typecodes, weather):
+            rate["code"] = code
+        weather.sort(key=lambda rate: -1 if rate["rate_ratio"] is None else rate["rate_ratio"], reverse=True)
+        return {"clear": clear, "weather": weather}
+
+    def combination_rate(self, include=(), exclude=(), measure="crashes", group="total"):
+        """
+        The rate of a measure per weather-day on the days that had all of the included weather
+        types and none of the excluded ones, against clear days
+        :param include: Weather type codes that must all have occurred
+        :param exclude: Weather type codes that must not have occurred
+        :param measure: One of "crashes", "injuries" or "deaths"
+        :param group: The group whose injuries or deaths are counted
+        :return: A dict of the combination's "days", "total", "per_day" and "rate_ratio", the last
+        two with a [low, high] "_ci", and the "clear" days' rate
+        """
+        include_mask, exclude_mask = weather_mask(include), weather_mask(exclude)
+        masks, values = self._days(measure, group)
+        selected = ((masks & include_mask) == include_mask) & ((masks & exclude_mask) == 0)
+        selections = np.column_stack([masks == 0, selected]).astype(np.float64)
+        (rate,), clear = self._rates(selections, values)
+        rate["clear"] = clear
+        return rate
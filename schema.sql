@@ -1,36 +1,57 @@
 -- Weather Tables
 
 -- Avoid duplicates when loading data into tables
+DROP TABLE IF EXISTS Station CASCADE;
+CREATE TABLE Station (
+    station VARCHAR(15) PRIMARY KEY,
+    name VARCHAR(63),
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION
+);
+
+-- Stations are deliberately not a foreign key, so weather from a station missing from the station
+-- list still loads (it just never becomes the nearest station to a crash)
 DROP TABLE IF EXISTS Weather CASCADE;
 CREATE TABLE Weather (
     station VARCHAR(15),
-    "date" DATE PRIMARY KEY
+    "date" DATE,
+    PRIMARY KEY (station, "date")
 );
 
 DROP TABLE IF EXISTS Wind CASCADE;
 CREATE TABLE Wind (
-    "date" DATE PRIMARY KEY REFERENCES Weather,
-    avgwind NUMERIC(4,2)
+    station VARCHAR(15),
+    "date" DATE,
+    avgwind REAL,
+    PRIMARY KEY (station, "date"),
+    FOREIGN KEY (station, "date") REFERENCES Weather
 );
 
 DROP TABLE IF EXISTS Precipitation CASCADE;
 CREATE TABLE Precipitation (
-    "date" DATE PRIMARY KEY REFERENCES Weather,
-    precip NUMERIC(4,2),
-    snow NUMERIC(4,2),
-    snowdepth NUMERIC(4,2)
+    station VARCHAR(15),
+    "date" DATE,
+    precip REAL,
+    snow REAL,
+    snowdepth REAL,
+    PRIMARY KEY (station, "date"),
+    FOREIGN KEY (station, "date") REFERENCES Weather
 );
 
 DROP TABLE IF EXISTS Temperature CASCADE;
 CREATE TABLE Temperature (
-    "date" DATE PRIMARY KEY REFERENCES Weather,
+    station VARCHAR(15),
+    "date" DATE,
     maxtemp SMALLINT,
-    mintemp SMALLINT
+    mintemp SMALLINT,
+    PRIMARY KEY (station, "date"),
+    FOREIGN KEY (station, "date") REFERENCES Weather
 );
 
 DROP TABLE IF EXISTS Wtypes CASCADE;
 CREATE TABLE Wtypes (
-    "date" DATE PRIMARY KEY REFERENCES Weather,
+    station VARCHAR(15),
+    "date" DATE,
     -- Some weather types ommitted due to never occuring in NYC (I.E volcanic ash)
     WT01 SMALLINT,
     WT02 SMALLINT,
@@ -44,7 +65,11 @@ CREATE TABLE Wtypes (
     WT16 SMALLINT,
     WT18 SMALLINT,
     WT19 SMALLINT,
-    WT22 SMALLINT
+    WT22 SMALLINT,
+    -- All of the above packed into one integer: bit 0 is WT01, bit 1 is WT02, ..., bit 12 is WT22
+    mask INTEGER,
+    PRIMARY KEY (station, "date"),
+    FOREIGN KEY (station, "date") REFERENCES Weather
 );
 
 /*
@@ -56,48 +81,83 @@ CREATE TABLE Typecode (
 */
 
 
+-- Every street name in the collision data, spelled one way. IDs are derived from the names by the
+-- loaders (see streets.py).
+DROP TABLE IF EXISTS Street CASCADE;
+CREATE TABLE Street (
+    id BIGINT PRIMARY KEY,
+    name VARCHAR(63)
+);
+
+
 -- Collision Tables
 
+-- Every collision table is partitioned by the year of the crash, so queries on a range of dates
+-- only read the years they need and a whole year can be detached at once. The date is part of
+-- every key, since Postgres only enforces uniqueness within a partition.
+--
+-- IDs are the integer COLLISION_IDs of the collision data, and the fixed-width columns of each
+-- table come first, widest first, so that rows don't need any padding to keep them aligned.
 DROP TABLE IF EXISTS Crash CASCADE;
 CREATE TABLE Crash (
-    id VARCHAR(15) PRIMARY KEY,
+    id INTEGER,
     "date" DATE,
-    "time" TIME
-);
+    "time" TIME,
+    -- The weather station nearest to the crash, whose weather the crash is attributed to
+    station VARCHAR(15),
+    PRIMARY KEY (id, "date")
+) PARTITION BY RANGE ("date");
 
+-- The 1:1 tables carry the date of their crash so that they can be partitioned the same way
 DROP TABLE IF EXISTS Location CASCADE;
 CREATE TABLE Location (
-    id VARCHAR(15) PRIMARY KEY REFERENCES Crash,
+    id INTEGER,
+    "date" DATE,
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION,
+    -- IDs in Street of on_st, cross_st & off_st once normalized (see streets.py), NULL if blank
+    on_street BIGINT,
+    cross_street BIGINT,
+    off_street BIGINT,
+    -- Number of the grid cell the crash is in (see grid.py), NULL if the location is unknown
+    cell INTEGER,
     borough VARCHAR(31),
     zip VARCHAR(7),
-    latitude NUMERIC(9,6),
-    longitude NUMERIC(9,6),
     on_st VARCHAR(63),
     cross_st VARCHAR(63),
-    off_st VARCHAR(63)
-);
+    off_st VARCHAR(63),
+    PRIMARY KEY (id, "date"),
+    FOREIGN KEY (id, "date") REFERENCES Crash
+) PARTITION BY RANGE ("date");
 
 DROP TABLE IF EXISTS Injuries CASCADE;
 CREATE TABLE Injuries (
-    id VARCHAR(15) PRIMARY KEY REFERENCES Crash,
+    id INTEGER,
+    "date" DATE,
     total SMALLINT,
     pedestrians SMALLINT,
     cyclists SMALLINT,
-    motorists SMALLINT
-);
+    motorists SMALLINT,
+    PRIMARY KEY (id, "date"),
+    FOREIGN KEY (id, "date") REFERENCES Crash
+) PARTITION BY RANGE ("date");
 
 DROP TABLE IF EXISTS Deaths CASCADE;
 CREATE TABLE Deaths (
-    id VARCHAR(15) PRIMARY KEY REFERENCES Crash,
+    id INTEGER,
+    "date" DATE,
     total SMALLINT,
     pedestrians SMALLINT,
     cyclists SMALLINT,
-    motorists SMALLINT
-);
+    motorists SMALLINT,
+    PRIMARY KEY (id, "date"),
+    FOREIGN KEY (id, "date") REFERENCES Crash
+) PARTITION BY RANGE ("date");
 
 DROP TABLE IF EXISTS VehiclesFactors CASCADE;
 CREATE TABLE VehiclesFactors (
-    id VARCHAR(15) PRIMARY KEY REFERENCES Crash,
+    id INTEGER,
+    "date" DATE,
     type_vehicle1 VARCHAR(63),
     type_vehicle2 VARCHAR(63),
     type_vehicle3 VARCHAR(63),
@@ -107,5 +167,189 @@ CREATE TABLE VehiclesFactors (
     contrib_factor2 VARCHAR(63),
     contrib_factor3 VARCHAR(63),
     contrib_factor4 VARCHAR(63),
-    contrib_factor5 VARCHAR(63)
+    contrib_factor5 VARCHAR(63),
+    PRIMARY KEY (id, "date"),
+    FOREIGN KEY (id, "date") REFERENCES Crash
+) PARTITION BY RANGE ("date");
+
+-- One partition per year of every collision table, named e.g. crash_2019, plus a default
+-- partition (e.g. crash_default) for any crash outside of those years
+CREATE OR REPLACE FUNCTION create_year_partitions(first_year INTEGER, last_year INTEGER)
+RETURNS VOID AS $$
+DECLARE
+    parent TEXT;
+    year INTEGER;
+BEGIN
+    FOREACH parent IN ARRAY ARRAY['crash', 'location', 'injuries', 'deaths', 'vehiclesfactors'] LOOP
+        FOR year IN first_year..last_year LOOP
+            EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                parent || '_' || year, parent, make_date(year, 1, 1), make_date(year + 1, 1, 1));
+        END LOOP;
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I DEFAULT', parent || '_default',
+            parent);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- The collision data starts in July 2012
+SELECT create_year_partitions(2012, 2030);
+
+-- Detaches a year from every collision table, leaving it as five ordinary tables (e.g. crash_2013)
+-- that can be archived or dropped without touching the other years. The 1:1 tables go first, and
+-- lose their foreign keys, since a crash can't be detached while rows still reference it.
+CREATE OR REPLACE FUNCTION detach_year_partitions(year INTEGER)
+RETURNS VOID AS $$
+DECLARE
+    child TEXT;
+    constraint_name TEXT;
+BEGIN
+    FOREACH child IN ARRAY ARRAY['location', 'injuries', 'deaths', 'vehiclesfactors'] LOOP
+        EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', child, child || '_' || year);
+        FOR constraint_name IN SELECT conname FROM pg_constraint
+                WHERE conrelid = (child || '_' || year)::regclass AND contype = 'f' LOOP
+            EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I', child || '_' || year, constraint_name);
+        END LOOP;
+    END LOOP;
+    EXECUTE format('ALTER TABLE crash DETACH PARTITION %I', 'crash_' || year);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Summary Tables (filled in by post_load.sql once the data above has been loaded)
+
+-- Changes every time post_load.sql runs, so in-memory copies of the data know to reload
+DROP TABLE IF EXISTS DataGeneration CASCADE;
+CREATE TABLE DataGeneration (
+    generation BIGINT,
+    loaded_at TIMESTAMP
+);
+
+-- Every crash with its casualty counts and the weather at its nearest station on the day, copied
+-- from the tables above so that whole-history scans need no joins. Fixed-width columns come first,
+-- widest first, to avoid padding.
+DROP TABLE IF EXISTS CrashFact CASCADE;
+CREATE TABLE CrashFact (
+    "time" TIME,
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION,
+    id INTEGER,
+    "date" DATE,
+    cell INTEGER,
+    -- Wtypes.mask of the day, NULL if the station has no weather for it
+    mask INTEGER,
+    precip REAL,
+    snow REAL,
+    snowdepth REAL,
+    avgwind REAL,
+    maxtemp SMALLINT,
+    mintemp SMALLINT,
+    injured_total SMALLINT,
+    injured_pedestrians SMALLINT,
+    injured_cyclists SMALLINT,
+    injured_motorists SMALLINT,
+    killed_total SMALLINT,
+    killed_pedestrians SMALLINT,
+    killed_cyclists SMALLINT,
+    killed_motorists SMALLINT,
+    borough VARCHAR(31),
+    station VARCHAR(15)
+);
+
+-- A sample of CrashFact stratified by date: a fixed share of each day's crashes, drawn at random,
+-- along with how many crashes the day had in all. Rankings estimated from it need a twentieth of
+-- the reads of an exact answer.
+DROP TABLE IF EXISTS CrashSample CASCADE;
+CREATE TABLE CrashSample (
+    "date" DATE,
+    -- Crashes on the date in CrashFact, of which this row is one of the sampled
+    stratum_size INTEGER,
+    mask INTEGER,
+    injured_total SMALLINT,
+    injured_pedestrians SMALLINT,
+    injured_cyclists SMALLINT,
+    injured_motorists SMALLINT,
+    killed_total SMALLINT,
+    killed_pedestrians SMALLINT,
+    killed_cyclists SMALLINT,
+    killed_motorists SMALLINT,
+    borough VARCHAR(31)
+);
+
+-- Crash, injury & death counts of every intersection (two streets, in order of ID) in each borough
+-- and in each weather, for the top-K queries of Database.dangerous_intersections()
+DROP TABLE IF EXISTS IntersectionStats CASCADE;
+CREATE TABLE IntersectionStats (
+    street_a BIGINT,
+    street_b BIGINT,
+    -- The weather type's bit of Wtypes.mask, 0 for crashes in any weather
+    weather INTEGER,
+    crashes INTEGER,
+    injured INTEGER,
+    killed INTEGER,
+    -- '*' for crashes in every borough
+    borough VARCHAR(31)
+);
+
+-- Crashes listing each vehicle type or contributing factor (upper case), with their injuries & deaths,
+-- in any weather and in each weather type
+DROP TABLE IF EXISTS VehicleFactorStats CASCADE;
+CREATE TABLE VehicleFactorStats (
+    -- 'vehicle' or 'factor'
+    kind VARCHAR(7),
+    -- The weather type's bit of Wtypes.mask, 0 for crashes in any weather
+    weather INTEGER,
+    name VARCHAR(63),
+    crashes INTEGER,
+    injured INTEGER,
+    killed INTEGER,
+    PRIMARY KEY (kind, weather, name)
+);
+
+-- Counts for every combination of date, hour of the day, borough and nearest weather station that
+-- had a crash
+DROP TABLE IF EXISTS CrashCube CASCADE;
+CREATE TABLE CrashCube (
+    "date" DATE,
+    hour SMALLINT,
+    borough VARCHAR(31),
+    station VARCHAR(15),
+    crashes INTEGER,
+    injured_total INTEGER,
+    injured_pedestrians INTEGER,
+    injured_cyclists INTEGER,
+    injured_motorists INTEGER,
+    killed_total INTEGER,
+    killed_pedestrians INTEGER,
+    killed_cyclists INTEGER,
+    killed_motorists INTEGER
+);
+
+-- CrashCube rolled up over the hours of the day
+DROP TABLE IF EXISTS CrashDaily CASCADE;
+CREATE TABLE CrashDaily (
+    "date" DATE,
+    borough VARCHAR(31),
+    station VARCHAR(15),
+    crashes INTEGER,
+    injured_total INTEGER,
+    injured_pedestrians INTEGER,
+    injured_cyclists INTEGER,
+    injured_motorists INTEGER,
+    killed_total INTEGER,
+    killed_pedestrians INTEGER,
+    killed_cyclists INTEGER,
+    killed_motorists INTEGER,
+    PRIMARY KEY ("date", borough, station)
+);
+
+DROP TABLE IF EXISTS CellDaily CASCADE;
+CREATE TABLE CellDaily (
+    "date" DATE,
+    cell INTEGER,
+    -- Every cell has a single nearest station
+    station VARCHAR(15),
+    crashes INTEGER,
+    injured INTEGER,
+    killed INTEGER,
+    PRIMARY KEY ("date", cell)
 );
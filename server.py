@@ -0,0 +1,285 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from aiohttp import web
+
+from database import default_station
+from embedded import open_database
+from export import json_value
+import telemetry
+
+
+##### Query parameters #####
+
+def codes(value):
+    """
+    Parses a comma separated list, e.g. of weather type codes
+    """
+    return tuple(code.strip() for code in value.split(",") if code.strip())
+
+
+def text(value):
+    return value
+
+
+def day(value):
+    """
+    Parses a YYYY/MM/DD or YYYY-MM-DD date, so that a malformed one is a bad request rather than an
+    error from the database
+    :return: The date as YYYY-MM-DD, which every backend reads
+    """
+    for date_format in ("%Y/%m/%d", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value.strip(), date_format).date().isoformat()
+        except ValueError:
+            pass
+    raise ValueError("not a date: {}".format(value))
+
+
+def days(value):
+    """
+    Parses a comma separated list of dates
+    """
+    return tuple(day(date) for date in codes(value))
+
+
+# name -> (converter, default). A default of ... means the parameter is required.
+def param(name, converter=text, default=...):
+    return name, converter, default
+
+
+# Every endpoint: path -> (Database method, its parameters in the order the method takes them)
+endpoints = {
+    "/crashes/date": ("crashes_by_date", [param("date", day)]),
+    "/weather/date": ("weather_by_date", [param("date", day), param("station", text, default_station)]),
+    "/crashes/dates": ("crashes_by_dates", [param("dates", days)]),
+    "/weather/dates": ("weather_by_dates", [param("dates", days), param("station", text, default_station)]),
+    "/crashes/series": ("crash_series", [param("start", day), param("end", day), param("bucket", text, "day"),
+                                         param("borough", text, None), param("group", text, "total")]),
+    "/crashes/rollup": ("crash_rollup", [param("by", codes, ("borough",)), param("start", day, None),
+                                         param("end", day, None), param("include", codes, ()),
+                                         param("exclude", codes, ()), param("borough", text, None),
+                                         param("group", text, "total")]),
+    "/crashes/hourly": ("hourly_profile", [param("include", codes, ()), param("exclude", codes, ()),
+                                           param("borough", text, None), param("start", day, None),
+                                           param("end", day, None), param("group", text, "total")]),
+    "/crashes/weather": ("crashes_in_weather", [param("include", codes, ()), param("exclude", codes, ()),
+                                                param("group", text, "total")]),
+    "/crashes/near": ("crashes_near", [param("latitude", float), param("longitude", float),
+                                       param("radius", float), param("start", day, None),
+                                       param("end", day, None)]),
+    "/crashes/box": ("crashes_in_box", [param("south", float), param("west", float), param("north", float),
+                                        param("east", float), param("start", day, None),
+                                        param("end", day, None)]),
+    "/crashes/heatmap": ("crash_heatmap", [param("start", day, None), param("end", day, None),
+                                           param("include", codes, ()), param("exclude", codes, ())]),
+    "/crashes/borough": ("crashes_by_borough", []),
+    "/intersections/dangerous": ("dangerous_intersections", [param("borough", text, None),
+                                                             param("weather", text, None),
+                                                             param("by", text, "crashes"),
+                                                             param("limit", int, 10)]),
+    "/rankings/most-common-weather": ("most_common_weather", [param("station", text, default_station)]),
+    "/rankings/crashes": ("crashes_by_weather", []),
+    "/rankings/deaths": ("deadliest_weather", [param("group", text, "total")]),
+    "/rankings/injuries": ("most_injuries_weather", [param("group", text, "total")]),
+    "/rankings/factors": ("top_contributing_factors", [param("weather", text, None), param("by", text, "crashes"),
+                                                        param("limit", int, 10)]),
+    "/rankings/vehicles": ("top_vehicle_types", [param("weather", text, None), param("by", text, "crashes"),
+                                                 param("limit", int, 10)]),
+    "/rankings/estimate": ("estimate_ranking", [param("ranking"), param("group", text, "total"),
+                                                param("confidence", float, 0.95)]),
+}
+
+
+##### Service #####
+
+class QueryService:
+    """
+    Runs Database queries for HTTP handlers. The blocking queries run on a thread per pooled
+    connection; identical queries that arrive while one is already running wait for its answer
+    instead of running again, and answers are cached until they expire or the data is reloaded.
+    """
+
+    def __init__(self, database, workers, cache_seconds=60, generation_check_seconds=10, cache_entries=10000):
+        """
+        Constructor for the service
+        :param database: The Database to query, whose pool should hold at least workers connections
+        :param workers: How many queries may run at the same time
+        :param cache_seconds: How long an answer is served from the cache
+        :param generation_check_seconds: How often to check whether the data has been reloaded
+        :param cache_entries: The most answers cached at once; the least recently used go first
+        """
+        self._database = database
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._cache_seconds = cache_seconds
+        self._generation_check_seconds = generation_check_seconds
+        self._cache_entries = cache_entries
+        # key -> (expiry, answer), least recently used first
+        self._cache = OrderedDict()
+        self._cache_swept = time.monotonic()
+        self._in_flight = {}
+        self._generation = None
+        self._generation_checked = 0
+        self.stats = {"queries": 0, "coalesced": 0, "cache_hits": 0}
+
+    def query_stats(self):
+        return self._database.query_stats()
+
+    def close(self):
+        self._executor.shutdown()
+        self._database.close()
+
+    async def _run(self, method, args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, lambda: getattr(self._database, method)(*args))
+
+    async def _check_generation(self):
+        """
+        Empties the cache if the data has been reloaded since it was filled
+        :return: None
+        """
+        now = time.monotonic()
+        if now - self._generation_checked < self._generation_check_seconds:
+            return
+        self._generation_checked = now
+        result = await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._database.execute_query, "SELECT generation FROM DataGeneration")
+        generation = result[1][0][0] if result[1] else None
+        if generation != self._generation:
+            self._generation = generation
+            self._cache.clear()
+
+    def _store(self, key, body):
+        """
+        Caches an answer, first dropping every expired one (at most once per cache_seconds, which is
+        as often as any can expire) and then the least recently used ones beyond cache_entries
+        :return: None
+        """
+        now = time.monotonic()
+        if now - self._cache_swept >= self._cache_seconds:
+            self._cache_swept = now
+            for expired in [k for k, (expiry, _) in self._cache.items() if expiry <= now]:
+                del self._cache[expired]
+        self._cache[key] = (now + self._cache_seconds, body)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_entries:
+            self._cache.popitem(last=False)
+
+    async def query(self, method, args):
+        """
+        Answers a query from the cache, from an identical query already running, or by running it
+        :param method: The name of the Database method
+        :param args: Its arguments
+        :return: The encoded JSON answer
+        """
+        await self._check_generation()
+        key = (method, args)
+
+        cached = self._cache.get(key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                self.stats["cache_hits"] += 1
+                return cached[1]
+            del self._cache[key]
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(in_flight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        self.stats["queries"] += 1
+        try:
+            body = json.dumps(await self._run(method, args), default=json_value)
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody else may be waiting, in which case the exception would otherwise be reported
+            # as never retrieved
+            future.exception()
+            raise
+        else:
+            self._store(key, body)
+            future.set_result(body)
+            return body
+        finally:
+            del self._in_flight[key]
+
+
+def make_handler(service, method, params):
+    """
+    Builds the request handler of one endpoint
+    :param service: The QueryService to answer with
+    :param method: The name of the Database method
+    :param params: The endpoint's parameters
+    :return: the handler
+    """
+    async def handler(request):
+        args = []
+        for name, converter, default in params:
+            if name in request.query:
+                try:
+                    args.append(converter(request.query[name]))
+                except ValueError:
+                    raise web.HTTPBadRequest(text="Invalid {}: {}".format(name, request.query[name]))
+            elif default is ...:
+                raise web.HTTPBadRequest(text="Missing parameter: {}".format(name))
+            else:
+                args.append(default)
+        try:
+            body = await service.query(method, tuple(args))
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        return web.Response(text=body, content_type="application/json")
+    return handler
+
+
+def make_app(service):
+    """
+    Builds the aiohttp application with a route for every endpoint
+    :param service: The QueryService to answer with
+    :return: the application
+    """
+    app = web.Application()
+    for path, (method, params) in endpoints.items():
+        app.router.add_get(path, make_handler(service, method, params))
+
+    async def stats(request):
+        return web.json_response(service.stats)
+    app.router.add_get("/stats", stats)
+
+    async def query_stats(request):
+        return web.json_response(service.query_stats())
+    app.router.add_get("/stats/queries", query_stats)
+
+    async def close_service(app):
+        service.close()
+    app.on_cleanup.append(close_service)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the crash and weather queries over HTTP as JSON.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=8, help="database connections / concurrent queries")
+    parser.add_argument("--cache-seconds", type=float, default=60, help="how long answers are cached")
+    parser.add_argument("--cache-entries", type=int, default=10000, help="most answers cached at once")
+    parser.add_argument("--embedded", metavar="PATH",
+                        help="query this DuckDB file from load_data_async.py --embedded instead of Postgres")
+    telemetry.add_arguments(parser)
+    args = parser.parse_args()
+
+    service = QueryService(open_database(args.embedded, args.workers, **telemetry.database_options(args)),
+                           args.workers, args.cache_seconds, cache_entries=args.cache_entries)
+    web.run_app(make_app(service), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
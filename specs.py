@@ -0,0 +1,167 @@
+# specs.py
+#
+# Declarative descriptions of the CSV datasets the loaders read: which column of the file each value
+# comes from (by its header, not its position), how it's converted, what a missing value means, and
+# which columns of which tables it's inserted into. A spec is resolved against the header of the file
+# actually being loaded, then compiled into a Python function written out for that one layout, with
+# every position, conversion & insert spelled out, so reading columns by name costs nothing per row.
+
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+from psycopg2.extensions import cursor as Cursor
+import re
+
+# Type aliases
+Converter = Callable[[str], Any]
+Executor = Callable[[List[str], Cursor], None]
+Inserter = Callable[..., None]
+Router = Callable[[str, Any, Cursor], str]
+
+# A value read from one column of the file. The column is found by the first of its headers that the
+# file has, compared ignoring case & runs of spaces, so a renamed column can be given its old name
+# too. Null rules: a required value whose column is missing, or that converts to None, makes the row
+# malformed; an optional value whose column is missing is always its default.
+class Field:
+    def __init__(self, headers: Union[str, Sequence[str]], convert: Optional[Converter] = None,
+            required: bool = False, default: Any = None) -> None:
+        self.headers = (headers,) if isinstance(headers, str) else tuple(headers)
+        # None keeps the text as it is
+        self.convert = convert
+        self.required = required
+        self.default = default
+
+# A value worked out from values named earlier in the spec, e.g. the grid cell of a crash from its
+# coordinates. With cursor = True, the row's cursor is passed after them.
+class Derived:
+    def __init__(self, function: Callable[..., Any], *args: str, cursor: bool = False) -> None:
+        self.function = function
+        self.args = args
+        self.cursor = cursor
+
+# One row of a table per line of the file, from the named values in column order. A router, given
+# the table, the value named by route_by & the cursor, picks the table (e.g. partition) to insert into.
+class Target:
+    def __init__(self, table: str, columns: Sequence[str], route: Optional[Router] = None,
+            route_by: Optional[str] = None) -> None:
+        self.table = table
+        self.columns = tuple(columns)
+        self.route = route
+        self.route_by = route_by
+
+def normalize_header(header: str) -> str:
+    return " ".join(header.strip().strip("\"").upper().split())
+
+class DatasetSpec:
+    def __init__(self, name: str, values: Dict[str, Union[Field, Derived]], targets: Sequence[Target],
+            insert: Inserter, after: Sequence[Derived] = (), layout: Sequence[str] = ()) -> None:
+        self.name = name
+        self.values = values
+        self.targets = tuple(targets)
+        # Called as insert(cur, table, *values) for every target
+        self.insert = insert
+        # Called once a line's rows are all inserted
+        self.after = tuple(after)
+        # The header of the file the spec was first written for, used for rows with no header of
+        # their own, e.g. synthetic ones
+        self.layout = tuple(layout)
+        # Values are worked out in order, so each may only be derived from the ones before it
+        known: List[str] = []
+        for value_name, value in values.items():
+            if isinstance(value, Derived) and (unknown := [a for a in value.args if a not in known]):
+                raise ValueError(f"{name}: {value_name} is derived from unknown values {unknown}")
+            known.append(value_name)
+        for after in self.after:
+            if unknown := [arg for arg in after.args if arg not in values]:
+                raise ValueError(f"{name}: {after.function.__name__} uses unknown values {unknown}")
+        for target in self.targets:
+            unknown = [column for column in target.columns + ((target.route_by,)
+                if target.route_by else ()) if column not in values]
+            if unknown:
+                raise ValueError(f"{self.name}: {target.table} uses unknown values {unknown}")
+
+    # Find the column of every field in a file's header. Raises ValueError if a required field's
+    # column isn't there.
+    def resolve(self, header: Sequence[str]) -> "ResolvedSpec":
+        columns: Dict[str, int] = {}
+        for i, column in enumerate(header):
+            columns.setdefault(normalize_header(column), i)
+        positions: Dict[str, Optional[int]] = {}
+        missing = []
+        for name, value in self.values.items():
+            if not isinstance(value, Field):
+                continue
+            found = [columns[h] for h in map(normalize_header, value.headers) if h in columns]
+            positions[name] = found[0] if found else None
+            if not found and value.required:
+                missing.append(" or ".join(f"\"{h}\"" for h in value.headers))
+        if missing:
+            raise ValueError(f"the {self.name} file has no {', '.join(missing)} column")
+        return ResolvedSpec(self, positions, len(header))
+
+    # The same spec inserting through another function, e.g. another loader's, & calling the given
+    # functions instead once a line's rows are all inserted
+    def rebind(self, insert: Inserter, after: Sequence[Derived] = ()) -> "DatasetSpec":
+        return DatasetSpec(self.name, self.values, self.targets, insert, after, self.layout)
+
+    # An executor for rows laid out like the spec's own layout
+    def executor(self) -> Executor:
+        return self.resolve(self.layout).compile()
+
+# A spec along with the position of each of its fields in one file. Holds only plain data & the
+# spec, so it can be handed to a child process & compiled there.
+class ResolvedSpec:
+    def __init__(self, spec: DatasetSpec, positions: Dict[str, Optional[int]], width: int) -> None:
+        self.spec = spec
+        self.positions = positions
+        self.width = width
+
+    # Fields the spec has but the file doesn't, which will always be their default
+    def absent(self) -> List[str]:
+        return [name for name, position in self.positions.items() if position is None]
+
+    # Python source of the executor, along with the objects it refers to by name
+    def source(self) -> Tuple[str, Dict[str, Any]]:
+        spec = self.spec
+        namespace: Dict[str, Any] = {"insert": spec.insert}
+        def local(name: str) -> str:
+            return "v_" + re.sub(r"\W", "_", name)
+        def bind(prefix: str, obj: Any) -> str:
+            key = f"{prefix}{len(namespace)}"
+            namespace[key] = obj
+            return key
+
+        lines = [f"def {re.sub(r'[^0-9A-Za-z_]', '_', spec.name)}_executor(row, cur):"]
+        # The loaders' tokenizer gives one extra, empty column whenever a line's last one isn't blank
+        lines.append(f"    if len(row) != {self.width} and (len(row) != {self.width + 1} "
+            f"or len(row[{self.width}]) != 0):")
+        lines.append(f"        raise AssertionError(f\"{{len(row)}} columns instead of {self.width}\")")
+        for name, value in spec.values.items():
+            if isinstance(value, Derived):
+                args = [local(arg) for arg in value.args] + (["cur"] if value.cursor else [])
+                lines.append(f"    {local(name)} = {bind('f', value.function)}({', '.join(args)})")
+                continue
+            position = self.positions[name]
+            if position is None:
+                lines.append(f"    {local(name)} = {bind('d', value.default)}")
+                continue
+            read = f"row[{position}]"
+            if value.convert is not None:
+                read = f"{bind('c', value.convert)}({read})"
+            lines.append(f"    {local(name)} = {read}")
+            # Text is never None, so only converted values need checking
+            if value.required and value.convert is not None:
+                lines.append(f"    if {local(name)} is None:")
+                lines.append(f"        raise AssertionError({repr(name + ' is missing')})")
+        for target in spec.targets:
+            table = repr(target.table)
+            if target.route is not None:
+                table = f"{bind('r', target.route)}({table}, {local(target.route_by)}, cur)"
+            lines.append(f"    insert(cur, {table}, {', '.join(local(c) for c in target.columns)})")
+        for after in spec.after:
+            args = [local(arg) for arg in after.args] + (["cur"] if after.cursor else [])
+            lines.append(f"    {bind('f', after.function)}({', '.join(args)})")
+        return "\n".join(lines) + "\n", namespace
+
+    def compile(self) -> Executor:
+        source, namespace = self.source()
+        exec(compile(source, f"<{self.spec.name} spec>", "exec"), namespace)
+        return namespace[source[len("def "):source.index("(")]]
@@ -0,0 +1,75 @@
+# streets.py
+#
+# Street names in the collision data are typed in by hand, so the same street turns up as
+# "BROADWAY", "Broadway " and "B'WAY", or "EAST 42ND ST" and "E 42 STREET". The loaders reduce each
+# name to one spelling & give every spelling a fixed ID, which Location stores next to the name as
+# typed and the Street table maps back to the spelling.
+
+from typing import Dict, Optional
+from functools import lru_cache
+from hashlib import blake2b
+import re
+from psycopg2.extensions import cursor as Cursor
+
+# Street types, which come last in a name
+SUFFIXES = {"AV": "AVENUE", "AVE": "AVENUE", "AVEN": "AVENUE", "AVN": "AVENUE", "BLVD": "BOULEVARD",
+    "BL": "BOULEVARD", "BRG": "BRIDGE", "CIR": "CIRCLE", "CT": "COURT", "DR": "DRIVE",
+    "EXPWY": "EXPRESSWAY", "EXPY": "EXPRESSWAY", "EXWY": "EXPRESSWAY", "HWY": "HIGHWAY",
+    "LN": "LANE", "PKWY": "PARKWAY", "PKY": "PARKWAY", "PL": "PLACE", "PLZ": "PLAZA",
+    "RD": "ROAD", "SQ": "SQUARE", "ST": "STREET", "STR": "STREET", "TER": "TERRACE",
+    "TPKE": "TURNPIKE", "TNPK": "TURNPIKE"}
+# Compass directions, which come first
+DIRECTIONS = {"E": "EAST", "W": "WEST", "N": "NORTH", "S": "SOUTH"}
+# Whole names with a well known shorthand
+ALIASES = {"BWAY": "BROADWAY", "BDWY": "BROADWAY", "BRDWY": "BROADWAY", "FDR": "FDR DRIVE",
+    "BQE": "BROOKLYN QUEENS EXPRESSWAY"}
+
+ORDINAL = re.compile(r"^(\d+)(?:ST|ND|RD|TH)$")
+
+# The one spelling of a street name, or None if there's no name. Names repeat constantly, so the
+# answers are cached.
+@lru_cache(maxsize = 65536)
+def normalize_street(name: str) -> Optional[str]:
+    words = name.upper().replace(".", "").replace("'", "").replace(",", " ").split()
+    if len(words) == 0:
+        return None
+    # "42ND" and "42" are the same street
+    words = [ORDINAL.sub(r"\1", word) for word in words]
+    if len(words) > 1:
+        if words[0] in DIRECTIONS:
+            words[0] = DIRECTIONS[words[0]]
+        # "ST NICHOLAS AVENUE" is a saint, "WEST ST" a street
+        elif words[0] == "ST":
+            words[0] = "SAINT"
+        if words[-1] in SUFFIXES:
+            words[-1] = SUFFIXES[words[-1]]
+    normalized = " ".join(words)
+    return ALIASES.get(normalized, normalized)
+
+# ID of a normalized street name. IDs come from the name alone, so every loader process agrees on
+# them without asking the database; at 64 bits, two of the city's streets sharing one is vanishingly
+# unlikely.
+def street_key(normalized: str) -> int:
+    return int.from_bytes(blake2b(normalized.encode(), digest_size = 8).digest(), "big", signed = True)
+
+# Street names seen by a loader process that haven't been written to the Street table yet, by ID
+pending_streets: Dict[int, str] = {}
+
+# ID of the street a raw name refers to, or None if there's no name
+def street_id(name: str) -> Optional[int]:
+    normalized = normalize_street(name)
+    if normalized is None:
+        return None
+    key = street_key(normalized)
+    pending_streets.setdefault(key, normalized)
+    return key
+
+# Write the street names seen since the last call to the Street table, as part of the caller's
+# transaction. Other processes may be writing some of the same names, so they're written in order of
+# ID: each process then waits for the others in the same order, and none can deadlock.
+def flush_streets(cur: Cursor) -> None:
+    if len(pending_streets) == 0:
+        return
+    cur.executemany("INSERT INTO Street VALUES (%s, %s) ON CONFLICT (id) DO NOTHING",
+        sorted(pending_streets.items()))
+    pending_streets.clear()
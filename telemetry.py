@@ -0,0 +1,166 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+latency_buckets = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf")]
+
+
+class QueryStats:
+    """
+    Everything recorded about one named query
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.wait_ms = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.histogram = [0] * len(latency_buckets)
+
+    def percentile(self, pct):
+        """
+        Estimates a latency percentile from the histogram
+        :param pct: The percentile, e.g. 99
+        :return: The latency interpolated within the bucket the percentile falls in, never more
+        than the slowest call
+        """
+        rank = pct / 100 * self.calls
+        seen = 0
+        lower = 0
+        for bound, count in zip(latency_buckets, self.histogram):
+            if count and seen + count >= rank:
+                if bound == float("inf"):
+                    return round(self.max_ms, 3)
+                return round(min(lower + (bound - lower) * (rank - seen) / count, self.max_ms), 3)
+            seen += count
+            lower = bound
+        return None
+
+    def as_dict(self):
+        return {"calls": self.calls, "errors": self.errors,
+                "mean_ms": round(self.total_ms / self.calls, 3) if self.calls else None,
+                "p50_ms": self.percentile(50), "p95_ms": self.percentile(95), "p99_ms": self.percentile(99),
+                "max_ms": round(self.max_ms, 3), "total_ms": round(self.total_ms, 3),
+                "wait_ms": round(self.wait_ms, 3), "rows": self.rows, "bytes": self.bytes,
+                "histogram": {("+Inf" if bound == float("inf") else str(bound)): count
+                              for bound, count in zip(latency_buckets, self.histogram)}}
+
+
+class QueryTelemetry:
+    """
+    Collects latency histograms, row and byte counts and connection wait times per query name, and
+    appends every query slower than a threshold to a slow-query log (JSON Lines). Safe to share
+    between threads.
+    """
+
+    def __init__(self, slow_query_ms=None, slow_query_log=None, explain_slow=False):
+        """
+        Constructor for the telemetry
+        :param slow_query_ms: Queries slower than this are logged, None to never log
+        :param slow_query_log: The file slow queries are appended to
+        :param explain_slow: Whether to include the EXPLAIN plan of each slow query in the log
+        """
+        self.slow_query_ms = slow_query_ms
+        self.slow_query_log = slow_query_log
+        self.explain_slow = explain_slow
+        self._queries = {}
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+
+    def is_slow(self, latency_ms):
+        return self.slow_query_ms is not None and latency_ms >= self.slow_query_ms
+
+    def record(self, name, latency_ms, wait_ms, rows=0, size=0, failed=False):
+        """
+        Adds one call of a query to its statistics
+        :param name: The name of the query
+        :param latency_ms: How long the query took once it had a connection
+        :param wait_ms: How long it waited for a connection from the pool
+        :param rows: How many rows it returned
+        :param size: Roughly how many bytes it returned, measured in text form
+        :param failed: Whether the query raised an error
+        :return: None
+        """
+        with self._lock:
+            stats = self._queries.get(name)
+            if stats is None:
+                stats = self._queries[name] = QueryStats()
+            stats.calls += 1
+            stats.errors += failed
+            stats.total_ms += latency_ms
+            stats.max_ms = max(stats.max_ms, latency_ms)
+            stats.wait_ms += wait_ms
+            stats.rows += rows
+            stats.bytes += size
+            stats.histogram[bisect_left(latency_buckets, latency_ms)] += 1
+
+    def log_slow(self, name, query, args, latency_ms, rows, plan=None):
+        """
+        Appends a slow query, with its parameters and optionally its plan, to the slow-query log
+        :return: None
+        """
+        if self.slow_query_log is None:
+            return
+        entry = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "name": name, "latency_ms": round(latency_ms, 3),
+                 "rows": rows, "params": list(args), "query": " ".join(query.split())}
+        if plan is not None:
+            entry["plan"] = plan
+        line = json.dumps(entry, default=str)
+        with self._log_lock:
+            with open(self.slow_query_log, "a") as log_file:
+                log_file.write(line + "\n")
+
+    def stats(self):
+        """
+        The statistics of every query recorded so far
+        :return: A dict of query name -> statistics, slowest in total first
+        """
+        with self._lock:
+            ordered = sorted(self._queries.items(), key=lambda item: item[1].total_ms, reverse=True)
+            return {name: stats.as_dict() for name, stats in ordered}
+
+    def reset(self):
+        with self._lock:
+            self._queries.clear()
+
+    def dump(self, path):
+        """
+        Writes the statistics of every query to a JSON file
+        :param path: The file to write
+        :return: None
+        """
+        with open(path, "w") as stats_file:
+            json.dump(self.stats(), stats_file, indent=2)
+
+
+def result_size(rows):
+    """
+    Roughly how many bytes a result took to send, counting each value in its text form
+    """
+    return sum(len(str(value)) for row in rows for value in row if value is not None)
+
+
+def add_arguments(parser):
+    """
+    Adds the slow-query log options shared by the menu, batch mode and the server
+    :param parser: The ArgumentParser to add them to
+    :return: None
+    """
+    parser.add_argument("--slow-query-ms", type=float, metavar="MS",
+                        help="log queries that take at least this long, with their parameters")
+    parser.add_argument("--slow-query-log", default="slow_queries.jsonl",
+                        help="file slow queries are appended to (default slow_queries.jsonl)")
+    parser.add_argument("--explain-slow", action="store_true", help="also log the plan of each slow query")
+
+
+def database_options(args):
+    """
+    The Database keyword arguments for the options added by add_arguments()
+    """
+    return {"slow_query_ms": args.slow_query_ms, "slow_query_log": args.slow_query_log,
+            "explain_slow": args.explain_slow}
@@ -0,0 +1,144 @@
+# windows.py
+#
+# Reads a file through a window of a few megabytes that slides along it, rather than mapping all of
+# it at once. The kernel is told each window will be read sequentially and asked for the next one
+# ahead of time, and each window is unmapped & dropped from the page cache once it's been read, so a
+# file many times the size of RAM loads with a flat memory footprint instead of evicting the
+# database's buffers from the same machine.
+
+from typing import Generator, Iterator, Optional, Tuple
+from pathlib import Path
+from argparse import ArgumentParser
+import mmap as mmap_module
+from mmap import mmap, ALLOCATIONGRANULARITY, ACCESS_READ
+import os
+
+# Default ceiling on the memory all of a load's windows take up together
+DEFAULT_MEMORY_LIMIT_MB = 256
+# Windows are never smaller than this, however low the ceiling or many the readers
+MIN_WINDOW = max(1 << 20, ALLOCATIONGRANULARITY)
+# How far either side of a position to look for a line ending at first
+BOUNDARY_SEARCH = 1 << 16
+
+# Hints aren't available everywhere (e.g. on Windows), in which case they're skipped
+HAS_FADVISE = hasattr(os, "posix_fadvise")
+MADV_SEQUENTIAL = getattr(mmap_module, "MADV_SEQUENTIAL", None)
+
+# Size of each window when the given number of readers share a memory ceiling. Each reader holds its
+# current window and has the next one being read ahead, so it gets two windows' worth.
+def window_size(memory_limit: int, num_readers: int) -> int:
+    size = memory_limit//(2*max(1, num_readers))
+    return max(MIN_WINDOW, size - size % ALLOCATIONGRANULARITY)
+
+class WindowedFile:
+    def __init__(self, path: Path, open_flags: int, window: int) -> None:
+        self.fd = os.open(path, open_flags)
+        self.size = os.fstat(self.fd).st_size
+        self.window = window
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    # Map the window starting at the given offset, which must be a multiple of ALLOCATIONGRANULARITY
+    def _map(self, offset: int, length: int) -> mmap:
+        mm = mmap(self.fd, length, access = ACCESS_READ, offset = offset)
+        if MADV_SEQUENTIAL is not None:
+            mm.madvise(MADV_SEQUENTIAL)
+        return mm
+
+    # Tell the kernel how a range of the file is going to be used, if it listens
+    def _advise(self, offset: int, length: int, advice: str) -> None:
+        if HAS_FADVISE and length > 0:
+            os.posix_fadvise(self.fd, offset, length, getattr(os, advice))
+
+    # Every window covering [start, end) in order, as (mapping, its offset, its length). Each window
+    # after the first is read ahead while the one before it is being used, and each is dropped from
+    # the page cache once the caller moves on. resume, when given, says where in the file the next
+    # window should pick up, e.g. at the start of a line the last window cut in two.
+    def _windows(self, start: int, end: int) -> Generator[Tuple[mmap, int, int], Optional[int], None]:
+        self._advise(start, end - start, "POSIX_FADV_SEQUENTIAL")
+        position = start
+        window = self.window
+        while position < end:
+            offset = position - position % ALLOCATIONGRANULARITY
+            length = min(window, end - offset)
+            self._advise(offset + length, min(window, end - offset - length), "POSIX_FADV_WILLNEED")
+            with self._map(offset, length) as mm:
+                resume = yield mm, offset, length
+            resume = offset + length if resume is None else resume
+            # A line longer than the whole window: try again with a bigger one
+            window = window*2 if resume == position else self.window
+            # Only whole pages before where the next window picks up can go
+            self._advise(offset, resume - resume % ALLOCATIONGRANULARITY - offset,
+                "POSIX_FADV_DONTNEED")
+            position = resume
+
+    # Every line starting in [start, end), without its line ending. A line still going at end is
+    # cut off there, which is what a boundary from line_start_near() avoids.
+    def lines(self, start: int, end: int) -> Iterator[bytes]:
+        windows = self._windows(start, end)
+        resume = None
+        try:
+            while True:
+                mm, offset, length = windows.send(resume)
+                local = (resume if resume is not None else start) - offset
+                last = offset + length >= end
+                while (newline := mm.find(b"\n", local, length)) != -1:
+                    yield mm[local:newline]
+                    local = newline + 1
+                if last and local < length:
+                    yield mm[local:length]
+                    local = length
+                resume = offset + local
+        except StopIteration:
+            return
+
+    # Number of lines starting in [start, end), not counting an empty line at the very end
+    def count_lines(self, start: int, end: int) -> int:
+        count = 0
+        last_byte = None
+        for mm, offset, length in self._windows(start, end):
+            local = max(0, start - offset)
+            count += mm[local:length].count(b"\n")
+            last_byte = mm[length - 1:length]
+        if last_byte is not None and last_byte != b"\n":
+            count += 1
+        return count
+
+    # The start of the line nearest to a position, looking only a little way either side of it
+    # first, so that splitting a file between workers reads hardly any of it
+    def line_start_near(self, position: int, start: int, end: int) -> int:
+        reach = BOUNDARY_SEARCH
+        while True:
+            low, high = max(start, position - reach), min(end, position + reach)
+            offset = low - low % ALLOCATIONGRANULARITY
+            with self._map(offset, high - offset) as mm:
+                before = mm.rfind(b"\n", low - offset, position - offset)
+                after = mm.find(b"\n", position - offset, high - offset)
+            self._advise(offset, high - offset, "POSIX_FADV_DONTNEED")
+            candidates = [offset + i + 1 for i in (before, after) if i != -1]
+            if candidates:
+                return min(candidates, key = lambda candidate: abs(candidate - position))
+            if low == start and high == end:
+                return end
+            reach *= 2
+
+    # The first line of the file & where the line after it starts
+    def first_line(self) -> Tuple[bytes, int]:
+        reach = BOUNDARY_SEARCH
+        while True:
+            length = min(self.size, reach)
+            if length == 0:
+                return b"", 0
+            with self._map(0, length) as mm:
+                newline = mm.find(b"\n")
+                if newline != -1 or length == self.size:
+                    end = newline if newline != -1 else length
+                    return mm[:end], end + 1 if newline != -1 else length
+            reach *= 2
+
+# Command line option shared by both loaders
+def add_memory_argument(parser: ArgumentParser) -> None:
+    parser.add_argument("--memory-limit", type = int, default = DEFAULT_MEMORY_LIMIT_MB,
+        metavar = "MB", help = "most memory the windows of the data files being read may take up "
+        f"together, in megabytes (default {DEFAULT_MEMORY_LIMIT_MB})")